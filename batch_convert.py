@@ -0,0 +1,204 @@
+'''
+This script converts many legacy files (.pt2, .pt3, .ht2 and .ht3, possibly compressed, see compressed_io.py)
+to .ptu files in parallel, with a pool of processes.
+Each worker process compiles the header template once and reuses it for all its files.
+A manifest (json file) records the size, modification time and content hash of every converted
+file, so running the conversion again only converts the new or modified files.
+The hash is computed while the file is converted, from the chunks of the copy, so a file is read once.
+
+Usage:
+python batch_convert.py data/ other/*.pt2 --jobs 8 --header picoharp_ptu_header_parameter.npz
+'''
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tttr_mode_to_ptu import load_header_template, COPY_CHUNK_SIZE
+from pt2_to_ptu import convert_to_ptu, ptu_filename
+from legacy_header import LEGACY_EXTENSIONS
+from compressed_io import open_file, iter_chunks, COMPRESSION_EXTENSIONS
+from instrumentation import EVENTS_ENVIRONMENT_VARIABLE, add_environment_hook
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MANIFEST = 'pt2_to_ptu_manifest.json'
+# Number of converted files between two saves of the manifest
+MANIFEST_SAVE_INTERVAL = 50
+# Extensions of the files converted in the given directories
+CONVERTED_EXTENSIONS = tuple(extension + compression for extension in LEGACY_EXTENSIONS
+                             for compression in ('',) + tuple(COMPRESSION_EXTENSIONS))
+
+
+def find_legacy_files(paths, recursive=False):
+    '''
+    Expand a list of files, directories (all the files with CONVERTED_EXTENSIONS inside) and glob patterns
+    into a sorted list of files, without duplicates.
+    '''
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            matches = []
+            for extension in CONVERTED_EXTENSIONS:
+                pattern = os.path.join(path, '**', '*' + extension) if recursive else \
+                    os.path.join(path, '*' + extension)
+                matches += glob.glob(pattern, recursive=recursive)
+        else:
+            matches = glob.glob(path, recursive=recursive)
+        files.update(os.path.abspath(match) for match in matches if os.path.isfile(match))
+    return sorted(files)
+
+
+def file_hash(filename, chunk_size=COPY_CHUNK_SIZE):
+    '''
+    sha256 of the content of a file (uncompressed, for a compressed file), read in chunks of chunk_size bytes.
+    '''
+    digest = hashlib.sha256()
+    with open_file(filename) as file:
+        for chunk in iter_chunks(file, chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(manifest):
+    if manifest is None or not os.path.exists(manifest):
+        return {}
+    with open(manifest, 'r') as file:
+        return json.load(file)
+
+
+def save_manifest(manifest, entries):
+    temporary = manifest + '.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(entries, file, indent=1, sort_keys=True)
+    os.replace(temporary, manifest)
+
+
+def is_up_to_date(originalfile, entry, header):
+    '''
+    True if originalfile was already converted with the same header and has not changed since.
+    The content hash is only computed when the size matches but the modification time does not,
+    the modification time of entry is then updated so the hash is not computed again next time.
+    '''
+    if entry is None or entry['header'] != header or not os.path.exists(entry['output']):
+        return False
+    stat = os.stat(originalfile)
+    if stat.st_size != entry['size']:
+        return False
+    if stat.st_mtime_ns == entry['mtime_ns']:
+        return True
+    if file_hash(originalfile) != entry['sha256']:
+        return False
+    entry['mtime_ns'] = stat.st_mtime_ns
+    return True
+
+
+def _init_worker(header):
+    # compile the header template once per worker process
+    if header is not None:
+        load_header_template(header)
+    add_environment_hook()
+
+
+def _convert_one(originalfile, header):
+    stat = os.stat(originalfile)
+    # the content is hashed from the chunks of the conversion, not read again
+    digest = hashlib.sha256()
+    convert_to_ptu(originalfile, isprint=False, header=header, observer=digest.update)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha256': digest.hexdigest(), 'header': header,
+            'output': ptu_filename(originalfile)}
+
+
+def batch_convert_pt2_to_ptu(paths, jobs=None, header=None, manifest=DEFAULT_MANIFEST, recursive=False,
+                             force=False):
+    '''
+    Input:
+    1. paths: list of legacy files (.pt2, .pt3, .ht2 or .ht3, possibly compressed), directories or glob patterns.
+    2. jobs: default: None, i.e. one process per CPU. Number of worker processes.
+    3. header: default: None, i.e. the default header of the format of each file.
+       Example header file to be modified, see convert_to_ptu.
+    4. manifest: default: DEFAULT_MANIFEST. json file recording the converted files. None to disable skipping.
+    5. recursive: default: False. If True, also search the subdirectories of the given directories.
+    6. force: default: False. If True, convert all the files, even the ones up to date in the manifest.
+
+    Output:
+    dict with the lists of 'converted', 'skipped' and 'failed' files (failed: (file, error message)).
+    '''
+    if header is not None:
+        header = os.path.abspath(header)
+    entries = load_manifest(manifest)
+    result = {'converted': [], 'skipped': [], 'failed': []}
+    todo = []
+    for originalfile in find_legacy_files(paths, recursive=recursive):
+        if not force and is_up_to_date(originalfile, entries.get(originalfile), header):
+            result['skipped'].append(originalfile)
+        else:
+            todo.append(originalfile)
+    if not todo:
+        if manifest is not None:
+            save_manifest(manifest, entries)
+        return result
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(header,)) as executor:
+            futures = {executor.submit(_convert_one, originalfile, header): originalfile
+                       for originalfile in todo}
+            for future in as_completed(futures):
+                originalfile = futures[future]
+                try:
+                    entries[originalfile] = future.result()
+                except Exception as error:
+                    entries.pop(originalfile, None)
+                    result['failed'].append((originalfile, repr(error)))
+                    continue
+                result['converted'].append(originalfile)
+                if manifest is not None and len(result['converted']) % MANIFEST_SAVE_INTERVAL == 0:
+                    save_manifest(manifest, entries)
+    finally:
+        if manifest is not None:
+            save_manifest(manifest, entries)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert legacy PicoQuant files to .ptu files in parallel.')
+    parser.add_argument('paths', nargs='+', help='.pt2, .pt3, .ht2 or .ht3 files, directories or glob patterns')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--header', default=None,
+                        help='.npz header file used for the .ptu files (default: the one of each format)')
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST,
+                        help='json file recording the converted files')
+    parser.add_argument('--no-manifest', action='store_true',
+                        help='do not read nor write the manifest')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='also search the subdirectories of the given directories')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='convert all the files, even the ones already up to date')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='also log the timing of each stage')
+    parser.add_argument('--events', default=None,
+                        help='json lines file receiving the timing events of all the stages')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(message)s')
+    if args.events is not None:
+        # the worker processes add the hook from the environment
+        os.environ[EVENTS_ENVIRONMENT_VARIABLE] = os.path.abspath(args.events)
+    add_environment_hook()
+    result = batch_convert_pt2_to_ptu(args.paths, jobs=args.jobs, header=args.header,
+                                      manifest=None if args.no_manifest else args.manifest,
+                                      recursive=args.recursive, force=args.force)
+    logger.info('Converted %d, skipped %d, failed %d files', len(result['converted']),
+                len(result['skipped']), len(result['failed']))
+    for originalfile, error in result['failed']:
+        logger.error('Failed %s: %s', originalfile, error)
+    return 1 if result['failed'] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
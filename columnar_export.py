@@ -0,0 +1,332 @@
+'''
+This script exports the time tags of a .ptu file (or of a legacy .pt2, .pt3, .ht2, .ht3 file)
+to columnar, compressed datasets in HDF5 or Parquet, so they only need to be decoded once.
+Columns: timestamp (int64, ps), channel (uint8), marker (bool) and, in T3 mode, dtime (uint16).
+The header tags are stored as attributes (HDF5) or as json in the schema metadata (Parquet).
+
+The records are decoded chunk by chunk and grouped into row groups covering fixed time ranges,
+so readers can load only the columns and time ranges they need (see read_columnar).
+Memory is bounded by a few row groups. Compression runs in other threads than the decoding:
+in HDF5 the chunks are compressed in parallel by a thread pool and written with write_direct_chunk,
+in Parquet the row groups are compressed and written by pyarrow in a writer thread.
+h5py and pyarrow are only needed for the corresponding format.
+'''
+
+import json
+import os
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from ptu_reader import open_time_tags
+from tttr_decoder import iter_decode, DECODE_CHUNK_RECORDS
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Time range covered by each row group (ps)
+ROW_GROUP_DURATION_PS = 10**12
+# Largest number of rows of a row group, longer ones are split
+MAX_ROW_GROUP_ROWS = 1 << 22
+# Number of rows of each HDF5 chunk
+HDF5_CHUNK_ROWS = 1 << 18
+# Number of row groups waiting to be written
+QUEUE_SIZE = 2
+
+FORMATS = {'.h5': 'hdf5', '.hdf5': 'hdf5', '.parquet': 'parquet', '.pq': 'parquet'}
+
+
+def iter_row_groups(decoded_chunks, row_group_duration_ps=ROW_GROUP_DURATION_PS,
+                    max_rows=MAX_ROW_GROUP_ROWS):
+    '''
+    Regroup decoded chunks (see tttr_decoder.iter_decode) into row groups:
+    a row group ends at the first record past a multiple of row_group_duration_ps,
+    or after max_rows rows.
+    '''
+    pending = []
+    pending_rows = 0
+    boundary = None
+    for decoded in decoded_chunks:
+        timestamp = decoded['timestamp']
+        n = timestamp.shape[0]
+        start = 0
+        while start < n:
+            if boundary is None:
+                boundary = (int(timestamp[start]) // row_group_duration_ps + 1) * row_group_duration_ps
+            stop = start + int(np.searchsorted(timestamp[start:], boundary, side='left'))
+            stop = min(stop, start + max_rows - pending_rows)
+            if stop > start:
+                pending.append({key: value[start:stop] for key, value in decoded.items()})
+                pending_rows += stop - start
+            start = stop
+            if start < n:
+                if pending:
+                    yield {key: np.concatenate([part[key] for part in pending]) for key in pending[0]}
+                    pending = []
+                    pending_rows = 0
+                if timestamp[start] >= boundary:
+                    boundary = None
+    if pending:
+        yield {key: np.concatenate([part[key] for part in pending]) for key in pending[0]}
+
+
+def _pipeline(items, consume, queue_size=QUEUE_SIZE):
+    '''
+    Call consume on each item in a separate thread, with at most queue_size items waiting.
+    '''
+    pending = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def worker():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            if not errors:
+                try:
+                    consume(item)
+                except BaseException as error:
+                    errors.append(error)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    try:
+        for item in items:
+            if errors:
+                break
+            pending.put(item)
+    finally:
+        pending.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _flat_attributes(tags, prefix=''):
+    '''
+    Header tags as a flat dict of scalars, lists of fields (legacy boards, channels) being indexed.
+    '''
+    attributes = {}
+    for name, value in tags.items():
+        if isinstance(value, list):
+            for j, item in enumerate(value):
+                if isinstance(item, dict):
+                    attributes.update(_flat_attributes(item, '{0}{1}({2})_'.format(prefix, name, j)))
+                else:
+                    attributes['{0}{1}({2})'.format(prefix, name, j)] = item
+        elif isinstance(value, (np.generic,)):
+            attributes[prefix + name] = value.item()
+        else:
+            attributes[prefix + name] = value
+    return attributes
+
+
+def _encode_chunk(array, chunk_rows, level):
+    '''
+    Bytes of an HDF5 chunk with the shuffle and deflate filters, padded to chunk_rows rows.
+    '''
+    if array.shape[0] < chunk_rows:
+        array = np.concatenate([array, np.zeros(chunk_rows - array.shape[0], dtype=array.dtype)])
+    data = np.ascontiguousarray(array).view(np.uint8)
+    if array.dtype.itemsize > 1:
+        data = np.ascontiguousarray(data.reshape(-1, array.dtype.itemsize).T)
+    return zlib.compress(data.tobytes(), level)
+
+
+class _HDF5Writer:
+    '''
+    Append row groups to chunked, compressed HDF5 datasets. Chunks are compressed
+    in parallel by a thread pool (zlib releases the GIL) and written with write_direct_chunk.
+    '''
+
+    def __init__(self, outputfile, dtypes, attributes, chunk_rows, level, threads):
+        if h5py is None:
+            raise ImportError('h5py is required to export to HDF5')
+        self.file = h5py.File(outputfile, 'w')
+        self.chunk_rows = chunk_rows
+        self.level = level
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        for name, dtype in dtypes.items():
+            self.file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype,
+                                     chunks=(chunk_rows,), shuffle=True, compression='gzip',
+                                     compression_opts=level)
+        for name, value in attributes.items():
+            self.file.attrs[name] = value
+        self.carry = {name: np.zeros(0, dtype=dtype) for name, dtype in dtypes.items()}
+        self.rows = 0
+        self.row_groups = []
+
+    def write(self, group):
+        n = group['timestamp'].shape[0]
+        self.row_groups.append((int(group['timestamp'].min()), int(group['timestamp'].max()),
+                                self.rows + self.carry['timestamp'].shape[0], n))
+        columns = {name: np.concatenate([self.carry[name], group[name]]) for name in self.carry}
+        full = columns['timestamp'].shape[0] // self.chunk_rows * self.chunk_rows
+        self._write_chunks({name: column[:full] for name, column in columns.items()})
+        self.carry = {name: column[full:] for name, column in columns.items()}
+
+    def _write_chunks(self, columns):
+        n = columns['timestamp'].shape[0]
+        if n == 0:
+            return
+        starts = range(0, n, self.chunk_rows)
+        encoded = {name: [self.pool.submit(_encode_chunk, column[start:start + self.chunk_rows],
+                                           self.chunk_rows, self.level) for start in starts]
+                   for name, column in columns.items()}
+        for name, chunks in encoded.items():
+            dataset = self.file[name]
+            dataset.resize((self.rows + n,))
+            for start, chunk in zip(starts, chunks):
+                dataset.id.write_direct_chunk((self.rows + start,), chunk.result())
+        self.rows += n
+
+    def close(self):
+        try:
+            self._write_chunks(self.carry)
+            row_groups = self.file.create_dataset(
+                'row_groups', data=np.array(self.row_groups, dtype=np.int64).reshape(-1, 4))
+            row_groups.attrs['columns'] = 'timestamp_min,timestamp_max,first_row,n_rows'
+        finally:
+            self.pool.shutdown()
+            self.file.close()
+
+
+class _ParquetWriter:
+    '''
+    Write each row group as a Parquet row group.
+    '''
+
+    def __init__(self, outputfile, dtypes, attributes, compression, level):
+        if pa is None:
+            raise ImportError('pyarrow is required to export to Parquet')
+        self.schema = pa.schema([(name, pa.from_numpy_dtype(dtype)) for name, dtype in dtypes.items()],
+                                metadata={b'ptu_header': json.dumps(attributes, default=str).encode()})
+        self.writer = pq.ParquetWriter(outputfile, self.schema, compression=compression,
+                                       compression_level=level)
+
+    def write(self, group):
+        table = pa.Table.from_arrays([pa.array(group[name]) for name in self.schema.names],
+                                     schema=self.schema)
+        self.writer.write_table(table, row_group_size=table.num_rows)
+
+    def close(self):
+        self.writer.close()
+
+
+def export_columnar(inputfile, outputfile, fileformat=None, row_group_duration_ps=ROW_GROUP_DURATION_PS,
+                    max_row_group_rows=MAX_ROW_GROUP_ROWS, compression_level=None, threads=None,
+                    chunk_records=DECODE_CHUNK_RECORDS, hdf5_chunk_rows=HDF5_CHUNK_ROWS):
+    '''
+    Input:
+    1. inputfile: .ptu (or .pt2, .pt3, .ht2, .ht3) file to export.
+    2. outputfile: HDF5 (.h5, .hdf5) or Parquet (.parquet, .pq) file to be written.
+    3. fileformat: default: None, i.e. from the extension of outputfile. 'hdf5' or 'parquet'.
+    4. row_group_duration_ps: default: ROW_GROUP_DURATION_PS (1 s). Time range of each row group.
+    5. max_row_group_rows: default: MAX_ROW_GROUP_ROWS. Longer row groups are split.
+    6. compression_level: default: None, i.e. 4 for HDF5 (gzip) and 3 for Parquet (zstd).
+    7. threads: default: None, i.e. one per CPU. Number of compression threads (HDF5).
+    8. chunk_records: default: DECODE_CHUNK_RECORDS. Number of records decoded at once.
+    9. hdf5_chunk_rows: default: HDF5_CHUNK_ROWS. Number of rows of each HDF5 chunk.
+
+    Output:
+    Number of rows written.
+    HDF5: one dataset per column, the header tags as attributes of the file and the dataset
+    row_groups: (timestamp_min, timestamp_max, first_row, n_rows) of each row group.
+    Parquet: one column per column, one row group per time range, the header tags as json
+    in the schema metadata (key 'ptu_header').
+    '''
+    if fileformat is None:
+        extension = os.path.splitext(outputfile)[1].lower()
+        if extension not in FORMATS:
+            raise ValueError('Unknown output format {0}'.format(extension))
+        fileformat = FORMATS[extension]
+    source = open_time_tags(inputfile)
+    dtypes = {'timestamp': np.dtype(np.int64), 'channel': np.dtype(np.uint8),
+              'marker': np.dtype(bool)}
+    if source['resolution'] is not None:
+        dtypes['dtime'] = np.dtype(np.uint16)
+    attributes = _flat_attributes(source['tags'])
+    attributes['rec_type'] = int(source['rec_type'])
+    if fileformat == 'hdf5':
+        writer = _HDF5Writer(outputfile, dtypes, attributes, hdf5_chunk_rows,
+                             4 if compression_level is None else compression_level, threads)
+    elif fileformat == 'parquet':
+        writer = _ParquetWriter(outputfile, dtypes, attributes, 'zstd',
+                                3 if compression_level is None else compression_level)
+    else:
+        raise ValueError('Unknown output format {0}'.format(fileformat))
+    chunks = iter_decode(source['records'], source['rec_type'], source['global_resolution'],
+                         source['resolution'], chunk_records)
+    groups = ({name: group[name] for name in dtypes}
+              for group in iter_row_groups(chunks, row_group_duration_ps, max_row_group_rows))
+    rows = [0]
+
+    def consume(group):
+        writer.write(group)
+        rows[0] += group['timestamp'].shape[0]
+
+    try:
+        _pipeline(groups, consume)
+    finally:
+        writer.close()
+    return rows[0]
+
+
+def read_columnar(filename, columns=None, t0=None, t1=None):
+    '''
+    Read the columns (default: all) of the rows with t0 <= timestamp < t1 (ps) from a file written by export_columnar.
+    Only the row groups overlapping the time range are read.
+    Output:
+    dict of arrays.
+    '''
+    extension = os.path.splitext(filename)[1].lower()
+    if FORMATS.get(extension) == 'parquet':
+        if pq is None:
+            raise ImportError('pyarrow is required to read Parquet')
+        filters = []
+        if t0 is not None:
+            filters.append(('timestamp', '>=', t0))
+        if t1 is not None:
+            filters.append(('timestamp', '<', t1))
+        read_columns = None if columns is None else sorted(set(columns) | {'timestamp'})
+        table = pq.read_table(filename, columns=read_columns, filters=filters or None)
+        data = {name: table.column(name).to_numpy() for name in table.column_names}
+    else:
+        if h5py is None:
+            raise ImportError('h5py is required to read HDF5')
+        with h5py.File(filename, 'r') as file:
+            names = [name for name in file if name != 'row_groups'] if columns is None else list(columns)
+            row_groups = file['row_groups'][:]
+            selected = np.ones(row_groups.shape[0], dtype=bool)
+            if t0 is not None:
+                selected &= row_groups[:, 1] >= t0
+            if t1 is not None:
+                selected &= row_groups[:, 0] < t1
+            if not selected.any():
+                return {name: file[name][:0] for name in names}
+            first = int(row_groups[selected, 2].min())
+            last = int((row_groups[selected, 2] + row_groups[selected, 3]).max())
+            data = {name: file[name][first:last] for name in set(names) | {'timestamp'}}
+        keep = np.ones(data['timestamp'].shape[0], dtype=bool)
+        if t0 is not None:
+            keep &= data['timestamp'] >= t0
+        if t1 is not None:
+            keep &= data['timestamp'] < t1
+        data = {name: value[keep] for name, value in data.items()}
+    if columns is not None:
+        data = {name: data[name] for name in columns}
+    return data
+
+
+if __name__ == "__main__":
+    export_columnar('test.ptu', 'test.parquet')
+    print(read_columnar('test.parquet', columns=['timestamp', 'channel'], t0=0, t1=10**11))
@@ -0,0 +1,400 @@
+'''
+This script includes functions to read and write compressed time tag files transparently.
+gzip (.gz) uses the standard library, zstd (.zst) the optional zstandard package.
+Compressed files are always streamed: they are never decompressed to disk nor read whole in memory.
+zstd compression runs on several threads.
+
+zstd files can also be written in the seekable format (https://github.com/facebook/zstd/tree/dev/contrib/seekable_format):
+the data is cut into independent frames of SEEKABLE_FRAME_SIZE bytes, followed by a seek table
+in a skippable frame. Such files are still valid zstd files for any zstd decoder, and the records
+can be read at any position by decompressing a single frame (see RecordStream).
+
+Usage:
+with open_file('data.pt2.zst') as inputfile:  # compression detected from the content
+    ...
+with open_file('data.ptu.zst', 'wb', seekable=True) as outputfile:  # compression from the extension
+    ...
+'''
+
+import bisect
+import gzip
+import io
+import os
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+# Number of zstd compression threads, -1 for one per CPU
+ZSTD_THREADS = -1
+# Uncompressed size of the frames of the seekable format
+SEEKABLE_FRAME_SIZE = 4 * 1024 * 1024
+SEEK_TABLE_FRAME_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER = struct.Struct('<IBI')
+# Size of the reads of the streaming readers
+STREAM_READ_SIZE = 1024 * 1024
+# ISIZE field at the end of a gzip member: uncompressed size modulo 2^32
+GZIP_TRAILER_SIZE = struct.Struct('<I')
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError('zstandard is required to read and write .zst files')
+
+
+def compression_from_extension(filename):
+    '''
+    'gzip', 'zstd' or None, from the extension of filename.
+    '''
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(str(filename))[1].lower())
+
+
+def strip_compression_extension(filename):
+    '''
+    filename without its compression extension, e.g. data.pt2.zst -> data.pt2.
+    '''
+    if compression_from_extension(filename) is None:
+        return filename
+    return os.path.splitext(filename)[0]
+
+
+def detect_compression(filename):
+    '''
+    'gzip', 'zstd' or None, from the first bytes of the file.
+    '''
+    with open(filename, 'rb') as file:
+        magic = file.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+
+def is_plain_file(file):
+    '''
+    True if the open file object reads or writes the bytes of a file as they are (not compressed),
+    so its file descriptor can be used directly (kernel copy, memory map).
+    '''
+    return isinstance(file, (io.FileIO, io.BufferedReader, io.BufferedWriter, io.BufferedRandom))
+
+
+def read_seek_table(file):
+    '''
+    Seek table of a zstd file in the seekable format, or None if the file has none.
+    Output:
+    list of (compressed size, uncompressed size) of the frames.
+    '''
+    end = file.seek(0, os.SEEK_END)
+    if end < SEEK_TABLE_FOOTER.size + 8:
+        return None
+    file.seek(end - SEEK_TABLE_FOOTER.size)
+    n_frames, descriptor, magic = SEEK_TABLE_FOOTER.unpack(file.read(SEEK_TABLE_FOOTER.size))
+    if magic != SEEKABLE_MAGIC:
+        return None
+    entry_size = 12 if descriptor & 0x80 else 8
+    table_size = n_frames * entry_size + SEEK_TABLE_FOOTER.size
+    file.seek(end - table_size - 8)
+    frame_magic, frame_size = struct.unpack('<II', file.read(8))
+    if frame_magic != SEEK_TABLE_FRAME_MAGIC or frame_size != table_size:
+        raise ValueError('Corrupted seek table')
+    table = file.read(n_frames * entry_size)
+    return [struct.unpack_from('<II', table, j * entry_size) for j in range(n_frames)]
+
+
+class SeekableZstdWriter(io.RawIOBase):
+    '''
+    Write a zstd file in the seekable format. Frames are compressed in parallel
+    by a pool of threads and written in order, at most 2 frames per thread are kept in memory.
+    '''
+
+    def __init__(self, filename, level=ZSTD_LEVEL, threads=ZSTD_THREADS,
+                 frame_size=SEEKABLE_FRAME_SIZE):
+        _require_zstandard()
+        super().__init__()
+        self.name = filename
+        self.file = open(filename, 'wb')
+        self.level = level
+        self.frame_size = frame_size
+        workers = os.cpu_count() if threads < 0 else max(threads, 1)
+        self.max_pending = 2 * workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.local = threading.local()
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.frames = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def _compress(self, data):
+        # compressors are not thread safe: one per thread
+        if not hasattr(self.local, 'compressor'):
+            self.local.compressor = zstandard.ZstdCompressor(level=self.level)
+        return self.local.compressor.compress(data), len(data)
+
+    def _submit(self, data):
+        self.pending.append(self.executor.submit(self._compress, data))
+        while len(self.pending) >= self.max_pending:
+            self._write_frame()
+
+    def _write_frame(self):
+        frame, size = self.pending.popleft().result()
+        self.file.write(frame)
+        self.frames.append((len(frame), size))
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self.buffer += data
+        while len(self.buffer) >= self.frame_size:
+            self._submit(bytes(self.buffer[:self.frame_size]))
+            del self.buffer[:self.frame_size]
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self._write_frame()
+            table = b''.join(struct.pack('<II', *frame) for frame in self.frames)
+            table += SEEK_TABLE_FOOTER.pack(len(self.frames), 0, SEEKABLE_MAGIC)
+            self.file.write(struct.pack('<II', SEEK_TABLE_FRAME_MAGIC, len(table)) + table)
+        finally:
+            self.executor.shutdown()
+            self.file.close()
+            super().close()
+
+
+class SeekableZstdReader(io.RawIOBase):
+    '''
+    Read a zstd file in the seekable format with random access:
+    seeking only decompresses the frame holding the new position.
+    '''
+
+    def __init__(self, filename, seek_table=None):
+        _require_zstandard()
+        super().__init__()
+        self.name = filename
+        self.file = open(filename, 'rb')
+        if seek_table is None:
+            seek_table = read_seek_table(self.file)
+            if seek_table is None:
+                self.file.close()
+                raise ValueError('{0} is not a seekable zstd file'.format(filename))
+        compressed = [0]
+        uncompressed = [0]
+        for compressed_size, uncompressed_size in seek_table:
+            compressed.append(compressed[-1] + compressed_size)
+            uncompressed.append(uncompressed[-1] + uncompressed_size)
+        self.compressed_offsets = compressed
+        self.offsets = uncompressed
+        self.size = uncompressed[-1]
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.position = 0
+        self.frame_index = -1
+        self.frame = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position {0}'.format(offset))
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def _load_frame(self, j):
+        if j != self.frame_index:
+            self.file.seek(self.compressed_offsets[j])
+            data = self.file.read(self.compressed_offsets[j + 1] - self.compressed_offsets[j])
+            self.frame = self.decompressor.decompress(
+                data, max_output_size=self.offsets[j + 1] - self.offsets[j])
+            self.frame_index = j
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(buffer) and self.position < self.size:
+            j = bisect.bisect_right(self.offsets, self.position) - 1
+            self._load_frame(j)
+            start = self.position - self.offsets[j]
+            n = min(len(buffer) - filled, len(self.frame) - start)
+            buffer[filled:filled + n] = self.frame[start:start + n]
+            filled += n
+            self.position += n
+        return filled
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+
+def open_file(filename, mode='rb', compression='auto', level=None, threads=ZSTD_THREADS,
+              seekable=False, frame_size=SEEKABLE_FRAME_SIZE):
+    '''
+    Input:
+    1. filename: file to open.
+    2. mode: default: 'rb'. 'rb' or 'wb'.
+    3. compression: default: 'auto', i.e. detected from the content of the file (read)
+       or from its extension (write). 'gzip', 'zstd' or None.
+    4. level: default: None, i.e. GZIP_LEVEL or ZSTD_LEVEL. Compression level.
+    5. threads: default: ZSTD_THREADS. Number of zstd compression threads, -1 for one per CPU.
+    6. seekable: default: False. If True, zstd files are written in the seekable format.
+    7. frame_size: default: SEEKABLE_FRAME_SIZE. Uncompressed size of the frames of the seekable format.
+
+    Output:
+    Binary file object. The files read in the seekable format, and the files that are not compressed,
+    support random access, the other compressed files are read sequentially.
+    '''
+    if mode not in ('rb', 'wb'):
+        raise ValueError("mode must be 'rb' or 'wb', not {0!r}".format(mode))
+    if compression == 'auto':
+        compression = detect_compression(filename) if mode == 'rb' else \
+            compression_from_extension(filename)
+    if compression is None:
+        return open(filename, mode)
+    if compression == 'gzip':
+        return gzip.open(filename, mode, compresslevel=GZIP_LEVEL if level is None else level)
+    if compression != 'zstd':
+        raise ValueError('Unknown compression {0!r}'.format(compression))
+    _require_zstandard()
+    level = ZSTD_LEVEL if level is None else level
+    if mode == 'wb':
+        if seekable:
+            return SeekableZstdWriter(filename, level, threads, frame_size)
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        return compressor.stream_writer(open(filename, 'wb'), closefd=True)
+    with open(filename, 'rb') as file:
+        seek_table = read_seek_table(file)
+    if seek_table is not None:
+        return SeekableZstdReader(filename, seek_table)
+    return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True,
+                                                      closefd=True)
+
+
+def iter_chunks(file, chunk_size=STREAM_READ_SIZE):
+    '''
+    Yield the content of an open file from its current position, in chunks of at most chunk_size bytes.
+    '''
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _gzip_trailer_size(filename):
+    '''
+    Uncompressed size of a gzip file from the ISIZE field of its trailer, None if it cannot be trusted.
+    ISIZE is the size modulo 2^32 of the last member only: the files of less than 4 GiB are assumed to hold
+    a single member (as written by open_file and the gzip tool) of less than 4 GiB of content,
+    the larger ones are decompressed to be counted.
+    '''
+    size = os.path.getsize(filename)
+    if size >= 1 << 32 or size < 18:
+        return None
+    with open(filename, 'rb') as file:
+        file.seek(size - GZIP_TRAILER_SIZE.size)
+        return GZIP_TRAILER_SIZE.unpack(file.read(GZIP_TRAILER_SIZE.size))[0]
+
+
+def uncompressed_size(filename, exact=False):
+    '''
+    Size of the content of a file, compressed or not.
+    Immediate for plain and seekable zstd files, and for gzip files read from their trailer
+    (see _gzip_trailer_size). The other compressed files are decompressed (but not stored),
+    as are all the gzip files if exact is True, e.g. for a file made of several concatenated members.
+    '''
+    if not exact and detect_compression(filename) == 'gzip':
+        size = _gzip_trailer_size(filename)
+        if size is not None:
+            return size
+    with open_file(filename) as file:
+        if isinstance(file, (SeekableZstdReader, io.BufferedReader)):
+            return file.seek(0, os.SEEK_END)
+        return sum(len(chunk) for chunk in iter_chunks(file))
+
+
+class RecordStream:
+    '''
+    Records (uint32) of a compressed file, starting at offset (bytes) of the uncompressed content.
+    Behaves like the np.memmap of an uncompressed file for len, shape and slices (step 1):
+    each slice is read and decompressed on demand. Slicing is fast at any position for files in the
+    seekable zstd format, sequential slices are fast for all the formats.
+    '''
+
+    def __init__(self, filename, offset=0, n_records=None):
+        self.filename = filename
+        self.offset = offset
+        if n_records is None:
+            n_records = max(uncompressed_size(filename) - offset, 0) // 4
+        self.shape = (n_records,)
+        self.dtype = np.dtype('<u4')
+        self.file = open_file(filename)
+        self.random_access = isinstance(self.file, SeekableZstdReader)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError('RecordStream only supports slices')
+        start, stop, step = key.indices(self.shape[0])
+        if step != 1:
+            raise ValueError('RecordStream only supports slices with a step of 1')
+        position = self.offset + 4 * start
+        if not self.random_access and position < self.file.tell():
+            # the streams cannot seek backwards (gzip does it the same way): start again from the beginning
+            self.file.close()
+            self.file = open_file(self.filename)
+        self.file.seek(position)
+        data = self.file.read(4 * max(stop - start, 0))
+        return np.frombuffer(data, dtype='<u4')
+
+    def close(self):
+        self.file.close()
+
+
+def open_records(filename, offset):
+    '''
+    Records (uint32) of a file from offset (bytes): a np.memmap for an uncompressed file,
+    a RecordStream for a compressed file.
+    '''
+    if detect_compression(filename) is not None:
+        return RecordStream(filename, offset)
+    n_records = max(os.path.getsize(filename) - offset, 0) // 4
+    if n_records == 0:
+        return np.zeros(0, dtype='<u4')
+    return np.memmap(filename, dtype='<u4', mode='r', offset=offset, shape=(n_records,))
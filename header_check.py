@@ -0,0 +1,233 @@
+'''
+This script includes functions to check the header values of a time tags file against the time tags themselves.
+The number of records, the acquisition time and the mean count rates are derived from the data
+with a chunked, vectorized pass over the records: the photons of each channel are counted without
+decoding their times, and the check can run in the same pass as the copy of the records (see RecordSummary).
+Aborted acquisitions often leave stale values in the header, which makes other readers
+read past the end of the file or stop early.
+'''
+
+import os
+import numpy as np
+from tttr_mode_to_ptu import rtPicoHarpT2, rtPicoHarpT3
+from tttr_decoder import TTTRDecoder, is_t3, as_records, DECODE_CHUNK_RECORDS
+from compressed_io import open_file
+from instrumentation import stage
+
+# Number of records at the end of each chunk decoded for the time of the last record
+SUMMARY_TAIL_RECORDS = 4096
+# Relative difference above which a header value is reported as a mismatch
+ACQUISITION_TIME_TOLERANCE = 0.01
+RATE_TOLERANCE = 0.1
+
+
+def _iter_record_chunks(filename, records_offset, chunk_records):
+    """
+    Yield the complete records of a file from records_offset, chunk_records at a time.
+    The records are read into a single reusable buffer, so the memory used does not depend on the
+    file size, and each chunk is only valid until the next one. Compressed files are decompressed on the fly.
+    filename can also be a buffer (bytes, memoryview, np.ndarray, ...) holding the file content,
+    the records are then views into it.
+    """
+    if not isinstance(filename, (str, os.PathLike)):
+        view = memoryview(filename).cast("B")
+        num_records = max(view.nbytes - records_offset, 0) // 4
+        records = np.frombuffer(view, dtype="<u4", count=num_records, offset=records_offset)
+        for start in range(0, num_records, chunk_records):
+            yield records[start:start + chunk_records]
+        return
+    buffer = memoryview(bytearray(4 * chunk_records))
+    filled = 0
+    with open_file(filename) as inputfile:
+        inputfile.seek(records_offset)
+        while True:
+            n = inputfile.readinto(buffer[filled:])
+            filled += n or 0
+            if filled < len(buffer) and n:
+                continue
+            # a partial record is kept for the next chunk, and dropped at the end of the file
+            end = filled - filled % 4
+            if end:
+                yield as_records(buffer[:end])
+            if not n:
+                return
+            buffer[:filled - end] = buffer[end:filled]
+            filled -= end
+
+
+class RecordSummary:
+    '''
+    Input:
+    1. rec_type, global_resolution, resolution: see tttr_decoder.TTTRDecoder.
+
+    Header values derived from the time tags, added chunk by chunk with update, so they can be
+    derived while the records are copied (see pt2_to_ptu.convert_to_ptu). result gives the same
+    output as derive_header_values.
+    The photons are counted without decoding their times (see TTTRDecoder.count_channels),
+    only the last SUMMARY_TAIL_RECORDS records of each chunk are decoded, for the time of the last record.
+    '''
+
+    def __init__(self, rec_type, global_resolution, resolution=None):
+        self.decoder = TTTRDecoder(rec_type, global_resolution, resolution if is_t3(rec_type) else None)
+        self.counts = np.zeros(256, dtype=np.int64)
+        self.last = 0
+        self.num_records = 0
+        self._rest = b""
+
+    def update(self, buffer):
+        '''
+        Add the records of buffer (any bytes-like object). A partial record at its end is kept
+        for the next call.
+        '''
+        data = memoryview(buffer).cast("B")
+        if self._rest:
+            data = memoryview(self._rest + data.tobytes())
+        end = len(data) - len(data) % 4
+        self._rest = data[end:].tobytes()
+        records = as_records(data[:end])
+        decoder = self.decoder
+        self.num_records += records.shape[0]
+        oflcorrection = decoder.oflcorrection
+        split = max(records.shape[0] - SUMMARY_TAIL_RECORDS, 0)
+        counts, n_events = decoder.count_channels(records[:split])
+        decoded = decoder.decode(records[split:])
+        if not decoded["timestamp"].shape[0] and n_events:
+            # no photon nor marker in the tail: the last one is further back
+            decoder.reset(oflcorrection)
+            decoded = decoder.decode(records)
+            counts[:] = 0
+        self.counts += counts
+        self.counts += np.bincount(decoded["channel"][~decoded["marker"]], minlength=256)
+        if decoded["timestamp"].shape[0]:
+            self.last = max(self.last, int(decoded["timestamp"].max()))
+
+    def result(self):
+        '''
+        Output: see derive_header_values.
+        '''
+        duration_s = self.last / 1e12
+        channel_counts = {int(channel): int(self.counts[channel]) for channel in np.flatnonzero(self.counts)}
+        channel_rates = {channel: (count / duration_s if duration_s > 0 else 0.0)
+                         for channel, count in channel_counts.items()}
+        return {'num_records': int(self.num_records),
+                'acquisition_time_ms': int(np.ceil(self.last / 1e9)),
+                'channel_counts': channel_counts, 'channel_rates': channel_rates}
+
+
+def derive_header_values(filename, records_offset, rec_type, global_resolution, resolution=None,
+                         chunk_records=DECODE_CHUNK_RECORDS):
+    '''
+    Input:
+    1. filename: file with the time tags starting at records_offset (bytes), or buffer with its content.
+       Compressed files are decompressed on the fly, records_offset is then an offset in the uncompressed content.
+    2. rec_type, global_resolution, resolution: see tttr_decoder.TTTRDecoder.
+    3. chunk_records: default: DECODE_CHUNK_RECORDS. Number of records read at once.
+
+    Output:
+    dict with:
+    num_records: number of complete records in the file.
+    acquisition_time_ms: time of the last record (ms), rounded up.
+    channel_counts: number of photons (markers excluded) on each channel, as numbered by the decoder.
+    channel_rates: mean count rate (counts/s) of each channel over the acquisition time.
+    '''
+    summary = RecordSummary(rec_type, global_resolution, resolution)
+    for records in _iter_record_chunks(filename, records_offset, chunk_records):
+        summary.update(records)
+    return summary.result()
+
+
+def header_rates(rec_type, global_resolution, channel_rates, n_inputs=1):
+    '''
+    Input:
+    1. rec_type, global_resolution: see tttr_decoder.TTTRDecoder.
+    2. channel_rates: mean count rate (counts/s) of each channel, as in the output of derive_header_values.
+    3. n_inputs: default: 1. Number of input channels of the header (TTResult_InputRate(i) or InputRate tags).
+
+    Output:
+    sync_rate, input_rates: the count rates (counts/s) stored in the header, as floats,
+    input_rates being the list of the rates of the n_inputs input channels.
+    In T3 mode the sync rate is the inverse of the sync period (global_resolution).
+    '''
+    t3 = is_t3(rec_type)
+    if t3:
+        sync_rate = 1 / global_resolution
+    else:
+        # in T2 mode, channel 0 is the sync input
+        sync_rate = channel_rates.get(0, 0.0)
+    if rec_type in (rtPicoHarpT2, rtPicoHarpT3):
+        # single input channel, routed to several channels in T3 mode
+        input_rates = [sum(rate for channel, rate in channel_rates.items() if t3 or channel > 0)]
+        input_rates += [0.0] * (n_inputs - 1)
+    else:
+        # input channels numbered from 1 in T2 mode (0 being the sync), from 0 in T3 mode
+        input_rates = [channel_rates.get(j if t3 else j + 1, 0.0) for j in range(n_inputs)]
+    return sync_rate, input_rates
+
+
+def _mismatch(header_value, derived_value, tolerance):
+    if header_value == derived_value:
+        return False
+    return abs(derived_value - header_value) > tolerance * max(abs(header_value), abs(derived_value))
+
+
+def check_legacy_header(originalfile, legacy, chunk_records=DECODE_CHUNK_RECORDS):
+    '''
+    Input:
+    1. originalfile: legacy time tags file (.pt2, .pt3, .ht2 or .ht3), or buffer with its content.
+    2. legacy: its header, as returned by legacy_header.read_legacy_header.
+
+    Output:
+    corrected: dict with num_records, acquisition_time_ms, sync_rate and input_rates (one per input channel),
+    ready to be passed to write_ptuheader: the values of the header, with the mismatches replaced by the values derived from the data.
+    In T3 mode the sync rate cannot be derived and is kept.
+    mismatches: list of (name, header value, derived value) for the values of the header that differ from the data,
+    the input rates being named input_rate(0), input_rate(1), ...
+    '''
+    label = originalfile if isinstance(originalfile, (str, os.PathLike)) else None
+    with stage('header_check', file=label) as event:
+        derived = derive_header_values(originalfile, legacy['records_offset'], legacy['rec_type'],
+                                       legacy['global_resolution'], legacy['resolution'], chunk_records)
+        event['records'] = derived['num_records']
+        event['bytes'] = 4 * derived['num_records']
+    return compare_legacy_header(legacy, derived)
+
+
+def compare_legacy_header(legacy, derived):
+    '''
+    Input:
+    1. legacy: header of a legacy file, as returned by legacy_header.read_legacy_header.
+    2. derived: values derived from its time tags, as returned by derive_header_values.
+
+    Output:
+    corrected, mismatches: see check_legacy_header.
+    '''
+    n_inputs = max(len(legacy['input_rates']), 1)
+    sync_rate, input_rates = header_rates(legacy['rec_type'], legacy['global_resolution'],
+                                          derived['channel_rates'], n_inputs)
+    if is_t3(legacy['rec_type']):
+        # the sync rate cannot be checked against the time tags
+        sync_rate = legacy['sync_rate']
+    header_values = {'num_records': legacy['num_records'],
+                     'acquisition_time_ms': legacy['acquisition_time_ms'],
+                     'sync_rate': legacy['sync_rate'], 'input_rates': list(legacy['input_rates']) or [0]}
+    derived_values = {'num_records': derived['num_records'],
+                      'acquisition_time_ms': derived['acquisition_time_ms'],
+                      'sync_rate': int(round(sync_rate)),
+                      'input_rates': [int(round(rate)) for rate in input_rates]}
+    mismatches = []
+    if header_values['num_records'] != derived_values['num_records']:
+        mismatches.append(('num_records', header_values['num_records'], derived_values['num_records']))
+    for tag, tolerance in (('acquisition_time_ms', ACQUISITION_TIME_TOLERANCE),
+                           ('sync_rate', RATE_TOLERANCE)):
+        if _mismatch(header_values[tag], derived_values[tag], tolerance):
+            mismatches.append((tag, header_values[tag], derived_values[tag]))
+    # the header values within tolerance are kept, e.g. the count rates measured by the instrument
+    corrected = dict(header_values, input_rates=list(header_values['input_rates']))
+    for tag, header_value, derived_value in mismatches:
+        corrected[tag] = derived_value
+    for j, (header_value, derived_value) in enumerate(zip(header_values['input_rates'],
+                                                          derived_values['input_rates'])):
+        if _mismatch(header_value, derived_value, RATE_TOLERANCE):
+            mismatches.append(('input_rate({0})'.format(j), header_value, derived_value))
+            corrected['input_rates'][j] = derived_value
+    return corrected, mismatches
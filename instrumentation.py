@@ -0,0 +1,180 @@
+'''
+This script includes the instrumentation of the conversion functions: timing of each stage
+(header parse, header check, header write, header patch, payload copy, cleanup),
+with the number of bytes moved and of records processed.
+Each stage emits an event (a dict) to the hooks registered with add_hook, and to the
+'instrumentation' logger at DEBUG level. Without hooks and with DEBUG disabled, the cost
+is two clock reads per stage.
+
+Two hooks are provided: JSONLinesHook writes one json line per event,
+StageCounters sums the events per stage.
+With the environment variable TTTR_EVENTS set to a file name, the command line tools
+(batch_convert.py, ptu_catalog.py) and the worker processes of batch_convert and tttr_analysis
+write all the events to that file as json lines (see add_environment_hook).
+
+Example:
+counters = StageCounters()
+add_hook(counters)
+convert_pt2_to_ptu('file.pt2', isprint=False)
+print(counters.as_dict())
+'''
+
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows: the peak memory is not reported
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Environment variable naming a json lines file receiving all the events
+EVENTS_ENVIRONMENT_VARIABLE = 'TTTR_EVENTS'
+
+_hooks = ()
+_hooks_lock = threading.Lock()
+# Hook added by add_environment_hook (inherited by forked processes)
+_environment_hook = None
+
+
+def add_hook(hook):
+    '''
+    Register hook, a callable called with each event (dict with at least 'stage' and 'seconds').
+    Hooks can be called from several threads at once.
+    '''
+    global _hooks
+    with _hooks_lock:
+        _hooks = _hooks + (hook,)
+    return hook
+
+
+def remove_hook(hook):
+    global _hooks
+    with _hooks_lock:
+        _hooks = tuple(registered for registered in _hooks if registered is not hook)
+
+
+def emit(event):
+    '''
+    Send event to the registered hooks and to the logger.
+    '''
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s %s: %.6f s, %s bytes, %s records', event['stage'], event.get('file', ''),
+                     event['seconds'], event.get('bytes'), event.get('records'))
+    for hook in _hooks:
+        hook(event)
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    '''
+    Time the enclosed block as the stage name. Yields the event dict, in which the block
+    can set 'bytes', 'records' or any other field. The event is emitted at the end of
+    the block, also when it raises (with 'error' set).
+    '''
+    event = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield event
+    except BaseException as error:
+        event['error'] = repr(error)
+        raise
+    finally:
+        if _hooks or logger.isEnabledFor(logging.DEBUG):
+            event['stage'] = name
+            event['seconds'] = time.perf_counter() - start
+            event['time'] = time.time()
+            event['pid'] = os.getpid()
+            emit(event)
+
+
+def peak_rss_mb():
+    '''
+    Peak resident memory (MB) of the current process, None where it cannot be measured.
+    '''
+    # on Linux, ru_maxrss is inherited from the parent process across exec, VmHWM is not
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1e3
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kB elsewhere
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+class JSONLinesHook:
+    '''
+    Hook writing each event as a json line to a file (name or open text file).
+    A file given by name is opened in append mode, so several processes can share it.
+    '''
+
+    def __init__(self, file):
+        self.owned = isinstance(file, (str, os.PathLike))
+        self.file = open(file, 'a', buffering=1) if self.owned else file
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+
+
+class StageCounters:
+    '''
+    Hook summing, per stage, the number of calls, seconds, bytes and records.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def __call__(self, event):
+        with self.lock:
+            counter = self.counters.setdefault(event['stage'], {'calls': 0, 'seconds': 0.0,
+                                                                'bytes': 0, 'records': 0})
+            counter['calls'] += 1
+            counter['seconds'] += event['seconds']
+            counter['bytes'] += event.get('bytes') or 0
+            counter['records'] += event.get('records') or 0
+
+    def as_dict(self):
+        with self.lock:
+            return {name: dict(counter) for name, counter in self.counters.items()}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+
+
+def add_environment_hook():
+    '''
+    Register a JSONLinesHook writing to the file named by TTTR_EVENTS, if the variable is set.
+    The hook is added once per process, so this can be called from the command line entry points
+    and again from the initializer of their worker processes.
+    Output:
+    the hook, or None if TTTR_EVENTS is not set.
+    '''
+    global _environment_hook
+    filename = os.environ.get(EVENTS_ENVIRONMENT_VARIABLE)
+    if not filename:
+        return None
+    # forked worker processes already have the hook of their parent
+    if _environment_hook is None:
+        _environment_hook = add_hook(JSONLinesHook(filename))
+    return _environment_hook
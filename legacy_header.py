@@ -0,0 +1,245 @@
+'''
+This script includes a table-driven parser for the headers of the legacy PicoQuant file formats:
+.pt2 and .pt3 (PicoHarp 300, format version 2.0), .ht2 and .ht3 (HydraHarp 400, format versions 1.0 and 2.0).
+Each layout is a table of (field name, struct format) compiled once into a struct.Struct.
+The header is read with a single read and the fixed parts are decoded in one unpack each.
+The variable parts (boards, input channels, imaging header) are located with computed offsets.
+The format (device and T2/T3 mode) is detected from the header itself.
+'''
+
+import struct
+from compressed_io import open_file
+from tttr_mode_to_ptu import (rtPicoHarpT3, rtPicoHarpT2, rtHydraHarpT3, rtHydraHarpT2,
+                              rtHydraHarp2T3, rtHydraHarp2T2)
+
+# Size of the first read, enough for the whole header of usual files
+LEGACY_HEADER_READ_SIZE = 64 * 1024
+# Time tag unit of the PicoHarp in T2 mode (s)
+PICOHARP_T2_RESOLUTION = 4e-12
+
+LEGACY_EXTENSIONS = ('.pt2', '.pt3', '.ht2', '.ht3')
+
+
+def _indexed(fields, count):
+    """
+    Repeat a list of fields count times, adding the index to the names: name(0), name(1), ...
+    """
+    return [('{0}({1})'.format(name, j), fmt) for j in range(count) for name, fmt in fields]
+
+
+class LegacyLayout:
+    '''
+    Table of (field name, struct format), compiled into a little-endian struct.Struct.
+    offsets gives the offset in bytes of each field.
+    '''
+
+    def __init__(self, fields):
+        self.names = [name for name, fmt in fields]
+        self.formats = [fmt for name, fmt in fields]
+        self.offsets = {}
+        offset = 0
+        for name, fmt in fields:
+            self.offsets[name] = offset
+            offset += struct.calcsize('<' + fmt)
+        self.struct = struct.Struct('<' + ''.join(fmt for name, fmt in fields))
+        self.size = self.struct.size
+
+    def unpack_from(self, buffer, offset=0):
+        """
+        Decode the layout at offset of buffer into a dict. Strings are cut at the first null character.
+        """
+        values = self.struct.unpack_from(buffer, offset)
+        return {name: (value.split(b'\0', 1)[0].decode('utf-8', errors='ignore')
+                       if isinstance(value, bytes) else value)
+                for name, value in zip(self.names, values)}
+
+    def pack(self, fields):
+        """
+        Encode a dict of fields with the layout. Missing fields are set to 0 (or an empty string).
+        """
+        values = []
+        for name, fmt in zip(self.names, self.formats):
+            value = fields.get(name)
+            if fmt.endswith('s'):
+                values.append(b'' if value is None else value.encode('utf-8'))
+            else:
+                values.append(0 if value is None else value)
+        return self.struct.pack(*values)
+
+
+TEXT_HEADER = [('Ident', '16s'), ('FormatVersion', '6s'), ('CreatorName', '18s'),
+               ('CreatorVersion', '12s'), ('FileTime', '18s'), ('CRLF', '2s'), ('Comment', '256s')]
+DISPLAY_SETTINGS = (_indexed([('DispCurve_MapTo', 'i'), ('DispCurve_Show', 'i')], 8)
+                    + _indexed([('Param_Start', 'f'), ('Param_Step', 'f'), ('Param_End', 'f')], 3)
+                    + [('RepeatMode', 'i'), ('RepeatsPerCurve', 'i'), ('RepeatTime', 'i'),
+                       ('RepeatWaitTime', 'i'), ('ScriptName', '20s')])
+
+TEXT_LAYOUT = LegacyLayout(TEXT_HEADER)
+
+PICOHARP_LAYOUT = LegacyLayout(
+    TEXT_HEADER
+    + [(name, 'i') for name in ('Curves', 'BitsPerRecord', 'RoutingChannels', 'NumberOfBoards',
+                                'ActiveCurve', 'MeasurementMode', 'SubMode', 'RangeNo', 'Offset',
+                                'AcquisitionTime', 'StopAt', 'StopOnOvfl', 'Restart', 'DispLinLog',
+                                'DispTimeAxisFrom', 'DispTimeAxisTo', 'DispCountAxisFrom',
+                                'DispCountAxisTo')]
+    + DISPLAY_SETTINGS)
+PICOHARP_BOARD_LAYOUT = LegacyLayout(
+    [('HardwareIdent', '16s'), ('HardwareVersion', '8s'), ('HardwareSerial', 'i'),
+     ('SyncDivider', 'i'), ('CFDZeroCross0', 'i'), ('CFDLevel0', 'i'), ('CFDZeroCross1', 'i'),
+     ('CFDLevel1', 'i'), ('Resolution', 'f'), ('RouterModelCode', 'i'), ('RouterEnabled', 'i')]
+    + _indexed([('RtChan_InputType', 'i'), ('RtChan_InputLevel', 'i'), ('RtChan_InputEdge', 'i'),
+                ('RtChan_CFDPresent', 'i'), ('RtChan_CFDLevel', 'i'), ('RtChan_CFDZCross', 'i')], 4))
+PICOHARP_TTTR_LAYOUT = LegacyLayout(
+    [(name, 'i') for name in ('ExtDevices', 'Reserved1', 'Reserved2', 'CntRate0', 'CntRate1',
+                              'StopAfter', 'StopReason', 'Records', 'ImgHdrSize')])
+
+HYDRAHARP_LAYOUT = LegacyLayout(
+    TEXT_HEADER
+    + [(name, 'i') for name in ('NumberOfCurves', 'BitsPerRecord', 'ActiveCurve',
+                                'MeasurementMode', 'SubMode', 'Binning')]
+    + [('Resolution', 'd')]
+    + [(name, 'i') for name in ('Offset', 'AcquisitionTime', 'StopAt', 'StopOnOvfl', 'Restart',
+                                'DispLinLog', 'DispTimeAxisFrom', 'DispTimeAxisTo',
+                                'DispCountAxisFrom', 'DispCountAxisTo')]
+    + DISPLAY_SETTINGS
+    + [('HardwareIdent', '16s'), ('HardwarePartNo', '8s'), ('HardwareSerial', 'i'),
+       ('ModulesPresent', 'i')]
+    + _indexed([('ModuleInfo_ModelCode', 'i'), ('ModuleInfo_VersionCode', 'i')], 10)
+    + [('BaseResolution', 'd'), ('InputsEnabled', 'q')]
+    + [(name, 'i') for name in ('InpChansPresent', 'RefClockSource', 'ExtDevices',
+                                'MarkerSettings', 'SyncDivider', 'SyncCFDLevel',
+                                'SyncCFDZeroCross', 'SyncOffset')])
+HYDRAHARP_CHANNEL_LAYOUT = LegacyLayout(
+    [('InputModuleIndex', 'i'), ('InputCFDLevel', 'i'), ('InputCFDZeroCross', 'i'),
+     ('InputOffset', 'i')])
+HYDRAHARP_TTTR_LAYOUT = LegacyLayout(
+    [('SyncRate', 'i'), ('StopAfter', 'i'), ('StopReason', 'i'), ('ImgHdrSize', 'i'),
+     ('Records', 'q')])
+
+# Record type of each (format, format version)
+RECORD_TYPES = {('pt2', '2.0'): rtPicoHarpT2, ('pt3', '2.0'): rtPicoHarpT3,
+                ('ht2', '1.0'): rtHydraHarpT2, ('ht3', '1.0'): rtHydraHarpT3,
+                ('ht2', '2.0'): rtHydraHarp2T2, ('ht3', '2.0'): rtHydraHarp2T3}
+
+
+def detect_legacy_format(buffer):
+    """
+    Return the format ('pt2', 'pt3', 'ht2' or 'ht3') of a legacy header from its first bytes.
+    """
+    if buffer[:6] == b'PQTTTR':
+        raise ValueError('This is already a ptu file')
+    ident = TEXT_LAYOUT.unpack_from(buffer)['Ident']
+    if ident.startswith('PicoHarp'):
+        layout, device = PICOHARP_LAYOUT, 'pt'
+    elif ident.startswith('HydraHarp'):
+        layout, device = HYDRAHARP_LAYOUT, 'ht'
+    else:
+        raise ValueError('Unknown file identifier {0!r}'.format(ident))
+    mode = struct.unpack_from('<i', buffer, layout.offsets['MeasurementMode'])[0]
+    if mode not in (2, 3):
+        raise ValueError('Measurement mode {0} is not a TTTR mode'.format(mode))
+    return device + str(mode)
+
+
+def read_legacy_header(originalfile, read_size=LEGACY_HEADER_READ_SIZE):
+    '''
+    Input:
+    1. originalfile: .pt2, .pt3, .ht2 or .ht3 file, possibly compressed (see compressed_io.py).
+    2. read_size: default: LEGACY_HEADER_READ_SIZE. Size of the first read of the file.
+
+    Output:
+    dict with:
+    format: 'pt2', 'pt3', 'ht2' or 'ht3'.
+    rec_type: corresponding ptu record type (TTResultFormat_TTTRRecType).
+    records_offset: offset in bytes of the first record.
+    num_records, acquisition_time_ms, file_time (string as in the file), sync_rate, input_rates (list).
+    global_resolution, resolution: as MeasDesc_GlobalResolution and MeasDesc_Resolution in a ptu header (s).
+    fields: all the fields of the header, with the lists 'Boards' (PicoHarp) or 'InpChan' and 'InputRate' (HydraHarp).
+    '''
+    with open_file(originalfile) as inputfile:
+        buffer = inputfile.read(read_size)
+
+        def need(size):
+            nonlocal buffer
+            if len(buffer) < size:
+                buffer += inputfile.read(size - len(buffer))
+                if len(buffer) < size:
+                    raise ValueError('{0}: truncated header'.format(originalfile))
+            return buffer
+
+        return _parse_legacy_header(buffer, need)
+
+
+def decode_legacy_header(buffer):
+    '''
+    In-memory read_legacy_header: parse the header at the start of buffer (bytes, bytearray, memoryview,
+    mmap, np.ndarray, ...), without copying it. See read_legacy_header for the output.
+    '''
+    view = memoryview(buffer).cast('B')
+
+    def need(size):
+        if len(view) < size:
+            raise ValueError('buffer: truncated header')
+        return view
+
+    return _parse_legacy_header(view, need)
+
+
+def _parse_legacy_header(buffer, need):
+    # need(size) returns the buffer holding at least size bytes, or raises ValueError
+    buffer = need(max(PICOHARP_LAYOUT.offsets['MeasurementMode'],
+                      HYDRAHARP_LAYOUT.offsets['MeasurementMode']) + 4)
+    fileformat = detect_legacy_format(buffer)
+    if fileformat.startswith('pt'):
+        buffer = need(PICOHARP_LAYOUT.size)
+        fields = PICOHARP_LAYOUT.unpack_from(buffer)
+        offset = PICOHARP_LAYOUT.size
+        buffer = need(offset + fields['NumberOfBoards'] * PICOHARP_BOARD_LAYOUT.size
+                      + PICOHARP_TTTR_LAYOUT.size)
+        fields['Boards'] = []
+        for j in range(fields['NumberOfBoards']):
+            fields['Boards'].append(PICOHARP_BOARD_LAYOUT.unpack_from(buffer, offset))
+            offset += PICOHARP_BOARD_LAYOUT.size
+        fields.update(PICOHARP_TTTR_LAYOUT.unpack_from(buffer, offset))
+        offset += PICOHARP_TTTR_LAYOUT.size
+        sync_rate = fields['CntRate0']
+        input_rates = [fields['CntRate1']]
+        if fileformat == 'pt2':
+            global_resolution = PICOHARP_T2_RESOLUTION
+        else:
+            global_resolution = 1 / sync_rate if sync_rate > 0 else 0.0
+        resolution = fields['Boards'][0]['Resolution'] * 1e-9 if fields['Boards'] else None
+    else:
+        buffer = need(HYDRAHARP_LAYOUT.size)
+        fields = HYDRAHARP_LAYOUT.unpack_from(buffer)
+        offset = HYDRAHARP_LAYOUT.size
+        channels = fields['InpChansPresent']
+        buffer = need(offset + channels * (HYDRAHARP_CHANNEL_LAYOUT.size + 4)
+                      + HYDRAHARP_TTTR_LAYOUT.size)
+        fields['InpChan'] = []
+        for j in range(channels):
+            fields['InpChan'].append(HYDRAHARP_CHANNEL_LAYOUT.unpack_from(buffer, offset))
+            offset += HYDRAHARP_CHANNEL_LAYOUT.size
+        fields['InputRate'] = list(struct.unpack_from('<{0}i'.format(channels), buffer, offset))
+        offset += 4 * channels
+        fields.update(HYDRAHARP_TTTR_LAYOUT.unpack_from(buffer, offset))
+        offset += HYDRAHARP_TTTR_LAYOUT.size
+        sync_rate = fields['SyncRate']
+        input_rates = fields['InputRate']
+        if fileformat == 'ht2':
+            global_resolution = fields['BaseResolution'] * 1e-12
+        else:
+            global_resolution = 1 / sync_rate if sync_rate > 0 else 0.0
+        resolution = fields['Resolution'] * 1e-12
+    # imaging header, skipped
+    offset += 4 * fields['ImgHdrSize']
+    version = fields['FormatVersion'].strip()
+    if (fileformat, version) not in RECORD_TYPES:
+        raise ValueError('Unsupported {0} format version {1!r}'.format(fileformat, version))
+    return {'format': fileformat, 'rec_type': RECORD_TYPES[(fileformat, version)],
+            'records_offset': offset, 'num_records': fields['Records'],
+            'acquisition_time_ms': fields['AcquisitionTime'], 'file_time': fields['FileTime'],
+            'sync_rate': sync_rate, 'input_rates': input_rates,
+            'global_resolution': global_resolution, 'resolution': resolution,
+            'fields': fields}
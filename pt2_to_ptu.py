@@ -1,7 +1,12 @@
 '''
 This script includes functions to convert .pt2 file to .ptu file.
+Other legacy files (.pt3, .ht2 and .ht3) are converted the same way with convert_to_ptu,
+their format is detected from their header (see legacy_header.py).
+Only a PicoHarp 300 T2 header and a HydraHarp 400 T3 header are shipped, the default header of the other
+modes (and of the HydraHarp files of format version 1.0) is the one of the same device with the record type
+of the file (see PTUHeaderTemplate.with_record_type).
 One needs to make sure the header file used (i.e. the .npz file) is the same mode
-such that they are taken from the same device (e.g. both .pt2 and header .npz files 
+such that they are taken from the same device (e.g. both .pt2 and header .npz files
 are generated from PicoHarp 300).
 Tested on .pt2 file generated from a PicoHarp 300.
 
@@ -10,144 +15,237 @@ Zhe Xian, Koong
 Date: 8th of April 2023. Oxford, UK.
 '''
 
-import os
 import datetime
-from tttr_mode_to_ptu import write_ptuheader, combine_time_tags_header
-import struct
+import logging
+import os
+from tttr_mode_to_ptu import (write_ptuheader, patch_ptuheader, copy_records, load_header_template,
+                              assemble_ptu)
+from legacy_header import read_legacy_header, decode_legacy_header
+from header_check import check_legacy_header, compare_legacy_header, RecordSummary
+from tttr_decoder import is_t3
+from instrumentation import stage
+from compressed_io import open_file, strip_compression_extension
+
+logger = logging.getLogger(__name__)
 
+# Header file used by default for each legacy format, converted to the record type of the file
+DEFAULT_HEADERS = {'pt2': 'picoharp_ptu_header_parameter.npz', 'pt3': 'picoharp_ptu_header_parameter.npz',
+                   'ht2': 'hydraharp_ptu_header_parameter.npz', 'ht3': 'hydraharp_ptu_header_parameter.npz'}
+# Extension added to the .ptu files written with each compression
+COMPRESSED_OUTPUT_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
 
-def convert_pt2_to_ptu(originalfile, isprint=True, header='picoharp_ptu_header_parameter.npz'):
+
+def legacy_file_timestamp(originalfile, legacy):
+    '''
+    Unix time of the creation of a legacy file, from the FileTime of its header
+    (or from the modification time of the file if FileTime cannot be read,
+    None for a file held in memory, i.e. originalfile None).
+    '''
+    try:
+        return datetime.datetime.strptime(legacy['file_time'], "%d/%m/%y %H:%M:%S").timestamp()
+    except ValueError:
+        return None if originalfile is None else os.path.getmtime(originalfile)
+
+
+def ptu_filename(originalfile, compression=None):
+    '''
+    Name of the .ptu file converted from originalfile: its name without the compression extension,
+    with .ptu (and the extension of the compression of the .ptu file, see COMPRESSED_OUTPUT_EXTENSIONS).
+    '''
+    processedfile = os.path.splitext(strip_compression_extension(originalfile))[0] + '.ptu'
+    if compression is not None:
+        processedfile += COMPRESSED_OUTPUT_EXTENSIONS[compression]
+    return processedfile
+
+
+def convert_to_ptu(originalfile, isprint=True, header=None, verify=True, compression=None,
+                   seekable=False, observer=None):
+    '''
+    Input:
+    1. originalfile: .pt2, .pt3, .ht2 or .ht3 file to be converted to .ptu, possibly compressed
+       (e.g. .pt2.gz or .pt2.zst, see compressed_io.py). It is decompressed on the fly.
+    2. isprint: default: True. If true, log the header of the file at INFO level.
+    3. header: default: None, i.e. DEFAULT_HEADERS of the format of the file, with the record type of the file.
+       Example header file to be modified. It must have the same record type as the file.
+       Its resolutions are replaced by the ones of the file.
+    4. verify: default: True. If true, the number of records, acquisition time and count rates of the
+       original header are checked against the time tags, the values that do not match are logged as warnings
+       and replaced by the ones derived from the time tags (see header_check.py). The check runs while the time
+       tags are copied, and the .ptu header is patched afterwards (before the copy for a compressed .ptu file).
+    5. compression: default: None. None, 'gzip' or 'zstd': compression of the .ptu file
+       (named .ptu.gz or .ptu.zst), written in a single pass.
+    6. seekable: default: False. If True, a zstd .ptu file is written in the seekable format,
+       so its time tags can be read at any position (see ptu_reader.py).
+    7. observer: default: None. Called in order with all the (uncompressed) content of the original file
+       while it is converted, e.g. to hash it without reading it again (see batch_convert.py).
+       Each chunk is only valid during the call.
+
+    Output:
+    Original file in .ptu format (see ptu_filename)
+    Returns the list of mismatches (name, original header value, derived value), empty if verify is False.
+
+    Algorithm:
+    1. Read the header of the original file in one read and locate the start of the time tags.
+    2. Write an appropriate .ptu header based on the defined header straight into the .ptu file.
+    3. Stream the time tags from the original file to the end of the .ptu file in fixed-size chunks,
+       without temporary files and with constant memory. Tested with trattoria package. https://github.com/GCBallesteros/trattoria
+    '''
+    with stage('convert', file=originalfile) as event:
+        mismatches = _convert_to_ptu(originalfile, isprint, header, verify, compression, seekable,
+                                     observer, event)
+    return mismatches
+
+
+def _convert_to_ptu(originalfile, isprint, header, verify, compression, seekable, observer, event):
+    with stage('header_parse', file=originalfile) as parse_event:
+        legacy = read_legacy_header(originalfile)
+        parse_event['bytes'] = legacy['records_offset']
+    if isprint and logger.isEnabledFor(logging.INFO):
+        for name, value in legacy['fields'].items():
+            logger.info('%s %s', name, value)
+    # a plain .ptu file is checked while its records are copied and its header patched afterwards,
+    # the header of a compressed one must be right before the records are written
+    single_pass = verify and compression is None
+    header, values, mismatches = _header_values(originalfile, legacy, header, verify and not single_pass)
+    summary = RecordSummary(legacy['rec_type'], legacy['global_resolution'],
+                            legacy['resolution']) if single_pass else None
+    processedfile = ptu_filename(originalfile, compression)
+    observers = [callback for callback in (None if summary is None else summary.update, observer)
+                 if callback is not None]
+    with open_file(originalfile) as inputfile, open_file(processedfile, 'wb', compression=compression,
+                                                         seekable=seekable) as outputfile:
+        # write header
+        write_ptuheader(inputfile=outputfile, acquisition_time_ms=values['acquisition_time_ms'],
+                        timestamp=legacy_file_timestamp(originalfile, legacy),
+                        counts0=values['sync_rate'], counts1=values['input_rates'],
+                        total_records=values['num_records'], header=header,
+                        global_resolution=values['global_resolution'], resolution=values['resolution'])
+        if observer is not None:
+            # the legacy header is not copied
+            inputfile.seek(0)
+            observer(inputfile.read(legacy['records_offset']))
+        # append the time tags after the new header
+        event['bytes'] = copy_records(inputfile, outputfile, offset=legacy['records_offset'],
+                                      observer=_chain(observers))
+        with stage('cleanup', file=processedfile):
+            outputfile.close()
+    if summary is not None:
+        values, mismatches = compare_legacy_header(legacy, summary.result())
+        _log_mismatches(originalfile, mismatches)
+        patch_ptuheader(processedfile, acquisition_time_ms=values['acquisition_time_ms'],
+                        total_records=values['num_records'], counts0=values['sync_rate'],
+                        counts1=values['input_rates'])
+    event['records'] = values['num_records']
+    logger.info('Converted %s to %s', originalfile, processedfile)
+    return mismatches
+
+
+def _chain(observers):
+    # a single observer of copy_records calling all the observers
+    if len(observers) < 2:
+        return observers[0] if observers else None
+
+    def observer(chunk):
+        for callback in observers:
+            callback(chunk)
+    return observer
+
+
+def _header_values(originalfile, legacy, header, verify):
+    '''
+    Header file and values of the .ptu header of a legacy file (or buffer), see convert_to_ptu.
+    Output:
+    header, values (num_records, acquisition_time_ms, sync_rate, input_rates, global_resolution, resolution),
+    mismatches.
+    '''
+    name = originalfile if isinstance(originalfile, (str, os.PathLike)) else 'buffer'
+    if header is None:
+        if legacy['format'] not in DEFAULT_HEADERS:
+            raise ValueError('No default header for .{0} files, a header file must be given'.format(
+                legacy['format']))
+        header = DEFAULT_HEADERS[legacy['format']]
+        template = load_header_template(header)
+        if template.tags.get('TTResultFormat_TTTRRecType') != legacy['rec_type']:
+            header = template.with_record_type(legacy['rec_type'])
+    rec_type = load_header_template(header).tags.get('TTResultFormat_TTTRRecType')
+    if rec_type != legacy['rec_type']:
+        raise ValueError('The record type of {0} ({1:#010x}) does not match the one of {2} ({3:#010x})'.format(
+            header, rec_type, name, legacy['rec_type']))
+    mismatches = []
+    values = {'num_records': legacy['num_records'],
+              'acquisition_time_ms': legacy['acquisition_time_ms'],
+              'sync_rate': legacy['sync_rate'],
+              'input_rates': list(legacy['input_rates']) or None}
+    if verify:
+        values, mismatches = check_legacy_header(originalfile, legacy)
+        _log_mismatches(name, mismatches)
+    # the time tags are only meaningful with the resolutions they were recorded with,
+    # the ones of the header file may come from other settings (T2 records have no resolution)
+    values['global_resolution'] = legacy['global_resolution']
+    values['resolution'] = legacy['resolution'] if is_t3(legacy['rec_type']) else None
+    return header, values, mismatches
+
+
+def _log_mismatches(name, mismatches):
+    for tag, header_value, derived_value in mismatches:
+        logger.warning('%s: %s is %s in the header but %s in the data',
+                       name, tag, header_value, derived_value)
+
+
+def convert_buffer_to_ptu(buffer, header=None, verify=True, out=None):
+    '''
+    In-memory convert_to_ptu, without any file.
+    Input:
+    1. buffer: content of a .pt2, .pt3, .ht2 or .ht3 file (bytes, bytearray, memoryview, mmap, np.ndarray, ...).
+       It is read in place, not copied.
+    2. header, verify: see convert_to_ptu.
+    3. out: default: None. Writable buffer receiving the .ptu content, e.g. the buf of a
+       multiprocessing.shared_memory.SharedMemory. Its size must be at least ptu_size(records, header),
+       the records being everything after the legacy header.
+
+    Output:
+    ptu: the .ptu content as a bytearray if out is None, else the number of bytes written to out.
+    mismatches: see convert_to_ptu.
+    '''
+    with stage('convert') as event:
+        with stage('header_parse') as parse_event:
+            legacy = decode_legacy_header(buffer)
+            parse_event['bytes'] = legacy['records_offset']
+        header, values, mismatches = _header_values(buffer, legacy, header, verify)
+        records = memoryview(buffer).cast('B')[legacy['records_offset']:]
+        ptu = assemble_ptu(records, acquisition_time_ms=values['acquisition_time_ms'],
+                           total_records=values['num_records'],
+                           timestamp=legacy_file_timestamp(None, legacy),
+                           counts0=values['sync_rate'], counts1=values['input_rates'],
+                           header=header, out=out, global_resolution=values['global_resolution'],
+                           resolution=values['resolution'])
+        event['bytes'] = records.nbytes
+        event['records'] = values['num_records']
+    return ptu, mismatches
+
+
+def convert_pt2_to_ptu(originalfile, isprint=True, header='picoharp_ptu_header_parameter.npz',
+                       verify=True, compression=None, seekable=False, observer=None):
     '''
     Input:
     1. originalfile: .pt2 file to be converted to .ptu
-    2. isprint: default: True. If true, print the header of the file.
+    2. isprint: default: True. If true, log the header of the file at INFO level.
     3. header: default: 'picoharp_ptu_header_parameter.npz' in the picoquant_tttr_to_ptu folder. Example header file to be modified.
+    4. verify: default: True. If true, check and correct the header values from the time tags.
+    5. compression, seekable: default: None, False. Compression of the .ptu file.
+    6. observer: default: None. See convert_to_ptu.
 
     Output:
     Original file in .ptu format
 
-    Algorithm:
-    1. Read the original file and extract the header files and the time tags.
-    2. Save the timetags file and create an appropriate header file for .ptu file based on the defined header.
-    3. Combined the new header file with the time tags into a .ptu file. Tested with trattoria package. https://github.com/GCBallesteros/trattoria
+    See convert_to_ptu.
     '''
-    dataitem = ['Numberofcurves', 'Bitsperrecord', 'Routingchannels', 'Numberofboards',
-                'Activecurve', 'Measurementmode', 'Submode', 'Rangeno', 'Offset', 'Acquisitiontime_ms',
-                'Stopat', 'Stoponovfl', 'Restart', 'Displaylinlog', 'Displaytimeaxisfrom',
-                'Displaytimeaxisto', 'Displaycountaxisfrom', 'Displaycountaxisto']
-    dataitem_t2_header = ['Extdevices', 'Reserved', 'Reserved', 'Inprate0',
-                          'Inprate1', 'Stopafter_ms', 'Stopreason', 'Numrecords',
-                          'Imghdrsize']
-    dataitem_boards = ['Hardwareident', 'Hardwareversion', 'Hardwareserial',
-                       'Sync divider', 'CFDzerocross0', 'CFDlevel0',
-                       'CFDzerocross1', 'CFDlevel1', 'Resolution_ns',
-                       'Routermodelcode', 'Routermodelenabled']
-
-    tagIdx = []
-    header_description = {}
-    headerfile = originalfile[:-4]+'_header.bin'
-    timetagsfile = originalfile[:-4]+'_timetags.bin'
-    processedfile = originalfile[:-4]+'.ptu'
-    with open(originalfile, "rb") as inputfile:
-        ident = inputfile.read(16).decode("utf-8").strip('\0')
-        formatversion = inputfile.read(6).decode("utf-8").strip('\0')
-        creatorname = inputfile.read(18).decode("utf-8").strip('\0')
-        creatorversion = inputfile.read(12).decode("utf-8").strip('\0')
-        filetime = inputfile.read(18).decode("utf-8").strip('\0')
-        crlf = inputfile.read(2).decode("utf-8").strip('\0')
-        comment = inputfile.read(256).decode("utf-8").strip('\0')
-        header_description['File_CreatingTime'] = filetime
-        if isprint:
-            print(ident, formatversion, creatorname, creatorversion, filetime)
-            print(comment)
-        for j in range(len(dataitem)):
-            tagIdx.append(struct.unpack("<i", inputfile.read(4))[0])
-            header_description[dataitem[j]] = tagIdx[-1]
-            if dataitem[j] == 'Numberofboards':
-                numberofboards = tagIdx[-1]
-            if isprint:
-                print(dataitem[j], tagIdx[-1])
-        for j in range(8):
-            mapto = struct.unpack("<i", inputfile.read(4))[0]
-            displaycurve = struct.unpack("<i", inputfile.read(4))[0]
-        for j in range(3):
-            start = struct.unpack("<f", inputfile.read(4))[0]
-            step = struct.unpack("<f", inputfile.read(4))[0]
-            end = struct.unpack("<f", inputfile.read(4))[0]
-        repeatmode = struct.unpack("<i", inputfile.read(4))[0]
-        repeatspercurve = struct.unpack("<i", inputfile.read(4))[0]
-        repeattime = struct.unpack("<i", inputfile.read(4))[0]
-        repeatwaittime = struct.unpack("<i", inputfile.read(4))[0]
-        scriptname = inputfile.read(20).decode("utf-8").strip('\0')
-        for j in range(numberofboards):
-            tagIdx.append(inputfile.read(16).decode("utf-8").strip('\0'))
-            tagIdx.append(inputfile.read(8).decode("utf-8").strip('\0'))
-            tagIdx.append(struct.unpack("<i", inputfile.read(4))[0])
-            tagIdx.append(struct.unpack("<i", inputfile.read(4))[0])
-            tagIdx.append(struct.unpack("<i", inputfile.read(4))[0])
-            tagIdx.append(struct.unpack("<i", inputfile.read(4))[0])
-            tagIdx.append(struct.unpack("<i", inputfile.read(4))[0])
-            tagIdx.append(struct.unpack("<i", inputfile.read(4))[0])
-            tagIdx.append(struct.unpack("<f", inputfile.read(4))[0])
-            tagIdx.append(struct.unpack("<i", inputfile.read(4))[0])
-            tagIdx.append(struct.unpack("<i", inputfile.read(4))[0])
-            header_description[dataitem_boards[0]] = tagIdx[-11]
-            header_description[dataitem_boards[1]] = tagIdx[-10]
-            header_description[dataitem_boards[2]] = tagIdx[-9]
-            header_description[dataitem_boards[3]] = tagIdx[-8]
-            header_description[dataitem_boards[4]] = tagIdx[-7]
-            header_description[dataitem_boards[5]] = tagIdx[-6]
-            header_description[dataitem_boards[6]] = tagIdx[-5]
-            header_description[dataitem_boards[7]] = tagIdx[-4]
-            header_description[dataitem_boards[8]] = tagIdx[-3]
-            header_description[dataitem_boards[9]] = tagIdx[-2]
-            header_description[dataitem_boards[10]] = tagIdx[-1]
-            if isprint:
-                print(dataitem_boards[0], tagIdx[-11])
-                print(dataitem_boards[1], tagIdx[-10])
-                print(dataitem_boards[2], tagIdx[-9])
-                print(dataitem_boards[3], tagIdx[-8])
-                print(dataitem_boards[4], tagIdx[-7])
-                print(dataitem_boards[5], tagIdx[-6])
-                print(dataitem_boards[6], tagIdx[-5])
-                print(dataitem_boards[7], tagIdx[-4])
-                print(dataitem_boards[8], tagIdx[-3])
-                print(dataitem_boards[9], tagIdx[-2])
-                print(dataitem_boards[10], tagIdx[-1])
-            for j in range(4):
-                inputtype = struct.unpack("<i", inputfile.read(4))[0]
-                inputlevel = struct.unpack("<i", inputfile.read(4))[0]
-                inputedge = struct.unpack("<i", inputfile.read(4))[0]
-                cfdpresent = struct.unpack("<i", inputfile.read(4))[0]
-                cfdlevel = struct.unpack("<i", inputfile.read(4))[0]
-                cfdzcross = struct.unpack("<i", inputfile.read(4))[0]
-        for j in range(len(dataitem_t2_header)):
-            tagIdx.append(struct.unpack("<i", inputfile.read(4))[0])
-            header_description[dataitem_t2_header[j]] = tagIdx[-1]
-            if isprint:
-                print(dataitem_t2_header[j], tagIdx[-1])
-        for j in range(int(tagIdx[-1])):
-            reserved = struct.unpack("<L", inputfile.read(4))[0]
-        # time tags
-        timetags = inputfile.read()
-        with open(timetagsfile, "wb") as file:
-            file.write(timetags)
-    # write header
-    write_ptuheader(inputfile=headerfile, acquisition_time_ms=header_description['Acquisitiontime_ms'],
-                    timestamp=datetime.datetime.strptime(
-                        header_description['File_CreatingTime'], "%d/%m/%y %H:%M:%S").timestamp(),
-                    counts0=header_description['Inprate0'], counts1=header_description['Inprate1'],
-                    total_records=header_description['Numrecords'], header=header)
-
-    # combine the new header with timetags file
-    combine_time_tags_header(headerfile=headerfile,
-                             timetags=timetagsfile, outputfile=processedfile)
-    os.remove(headerfile)
-    os.remove(timetagsfile)
-    print('Converted {0} to {1}'.format(originalfile, processedfile))
+    return convert_to_ptu(originalfile, isprint=isprint, header=header, verify=verify,
+                          compression=compression, seekable=seekable, observer=observer)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     originalfile = r'C:\Users\ZakKoong\Desktop\etp032023a_000.pt2'
     convert_pt2_to_ptu(originalfile, isprint=True,
                        header='picoharp_ptu_header_parameter.npz')
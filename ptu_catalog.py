@@ -0,0 +1,288 @@
+'''
+This script includes a catalog of the .ptu files of directory trees: the main header values of each file
+(device, record type, creation time, acquisition time, number of records, ...) are stored in a
+SQLite database, to find runs without opening the files.
+Only the first HEADER_READ_SIZE bytes of each file are read (see scan_ptuheader), from a pool of threads.
+Updating the catalog only reads the files that are new or whose size or modification time changed
+since the last update, and removes the files that no longer exist.
+Compressed .ptu files (.ptu.gz, .ptu.zst, see compressed_io.py) are cataloged too.
+
+Usage:
+python ptu_catalog.py update data/ other/ --catalog ptu_catalog.sqlite
+python ptu_catalog.py find --device HydraHarp --min-records 1000000 --after 2023-01-01
+'''
+
+import argparse
+import datetime
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from tttr_mode_to_ptu import scan_ptuheader, tdatetime_to_timestamp
+from compressed_io import strip_compression_extension
+from instrumentation import stage, add_environment_hook
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CATALOG = 'ptu_catalog.sqlite'
+# Number of threads reading headers (the scan mostly waits for the file system)
+DEFAULT_SCAN_THREADS = 16
+# Number of files read by a thread at once
+SCAN_BATCH_SIZE = 64
+
+# Columns of the catalog filled from the header, with the header tag of each
+CATALOG_TAGS = {
+    'device': 'HW_Type',
+    'serial': 'HW_SerialNo',
+    'software': 'CreatorSW_Name',
+    'comment': 'File_Comment',
+    'created': 'File_CreatingTime',
+    'rec_type': 'TTResultFormat_TTTRRecType',
+    'mode': 'Measurement_Mode',
+    'acquisition_time_ms': 'MeasDesc_AcquisitionTime',
+    'num_records': 'TTResult_NumberOfRecords',
+    'global_resolution': 'MeasDesc_GlobalResolution',
+    'resolution': 'MeasDesc_Resolution',
+    'sync_rate': 'TTResult_SyncRate',
+}
+COLUMNS = ('path', 'size', 'mtime_ns') + tuple(CATALOG_TAGS) + ('header_end', 'error')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    device TEXT,
+    serial TEXT,
+    software TEXT,
+    comment TEXT,
+    created REAL,
+    rec_type INTEGER,
+    mode INTEGER,
+    acquisition_time_ms INTEGER,
+    num_records INTEGER,
+    global_resolution REAL,
+    resolution REAL,
+    sync_rate INTEGER,
+    header_end INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS files_device ON files (device);
+CREATE INDEX IF NOT EXISTS files_created ON files (created);
+CREATE INDEX IF NOT EXISTS files_num_records ON files (num_records);
+'''
+
+
+def is_ptu_file(filename):
+    return strip_compression_extension(filename).lower().endswith('.ptu')
+
+
+def iter_ptu_files(directory):
+    '''
+    Yield (path, size, mtime_ns) of the .ptu files (possibly compressed) of a directory tree.
+    '''
+    pending = [os.path.abspath(directory)]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError as error:
+            logger.warning('Cannot list %s: %s', error.filename, error.strerror)
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif is_ptu_file(entry.name) and entry.is_file():
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime_ns
+                except OSError:
+                    continue
+
+
+def scan_file(path, size=None, mtime_ns=None):
+    '''
+    Catalog row (dict keyed by COLUMNS) of a .ptu file. The header values are None and error is set
+    if the header cannot be read.
+    '''
+    row = dict.fromkeys(COLUMNS)
+    row.update(path=path, size=size, mtime_ns=mtime_ns)
+    try:
+        tags, row['header_end'] = scan_ptuheader(path, names=CATALOG_TAGS.values())
+    except (OSError, ValueError, EOFError) as error:
+        row['error'] = str(error)
+        return row
+    for column, name in CATALOG_TAGS.items():
+        # single valued tags may still be stored with index 0
+        row[column] = tags.get(name, tags.get(name + '(0)'))
+    if row['created'] is not None:
+        row['created'] = tdatetime_to_timestamp(row['created'])
+    return row
+
+
+def _scan_files(items):
+    return [scan_file(*item) for item in items]
+
+
+class PTUCatalog:
+    '''
+    Input:
+    1. database: default: DEFAULT_CATALOG. SQLite file of the catalog, created if needed.
+
+    The table files has one row per file, with the columns COLUMNS: path (absolute), size, mtime_ns,
+    the header values of CATALOG_TAGS (created is a unix time), header_end (offset of the first record)
+    and error (why the header could not be read, None otherwise).
+    '''
+
+    def __init__(self, database=DEFAULT_CATALOG):
+        self.database = database
+        self.connection = sqlite3.connect(database)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, directories, jobs=DEFAULT_SCAN_THREADS, force=False):
+        '''
+        Input:
+        1. directories: directory or list of directories to catalog (with their subdirectories).
+        2. jobs: default: DEFAULT_SCAN_THREADS. Number of threads reading the headers.
+        3. force: default: False. If True, read all the headers again, even of the unchanged files.
+
+        Output:
+        dict with the number of files 'scanned', 'unchanged', 'removed' and 'failed' (header not readable).
+        '''
+        if isinstance(directories, (str, os.PathLike)):
+            directories = [directories]
+        with stage('catalog_update', file=self.database) as event:
+            known = {row['path']: (row['size'], row['mtime_ns'])
+                     for row in self.connection.execute('SELECT path, size, mtime_ns FROM files')}
+            todo = []
+            seen = set()
+            for directory in directories:
+                for path, size, mtime_ns in iter_ptu_files(directory):
+                    seen.add(path)
+                    if force or known.get(path) != (size, mtime_ns):
+                        todo.append((path, size, mtime_ns))
+            prefixes = tuple(os.path.join(os.path.abspath(directory), '') for directory in directories)
+            removed = [path for path in known if path.startswith(prefixes) and path not in seen]
+            result = {'scanned': len(todo), 'unchanged': len(seen) - len(todo),
+                      'removed': len(removed), 'failed': 0}
+            insert = 'INSERT OR REPLACE INTO files ({0}) VALUES ({1})'.format(
+                ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+            with ThreadPoolExecutor(max_workers=jobs) as executor, self.connection:
+                self.connection.executemany('DELETE FROM files WHERE path = ?',
+                                            ((path,) for path in removed))
+                # files are given to the threads in batches, a task per file costs as much as a scan
+                tasks = [todo[start:start + SCAN_BATCH_SIZE]
+                         for start in range(0, len(todo), SCAN_BATCH_SIZE)]
+                for rows in executor.map(_scan_files, tasks):
+                    for row in rows:
+                        if row['error'] is not None:
+                            result['failed'] += 1
+                            logger.warning('Cannot read the header of %s: %s', row['path'], row['error'])
+                    self.connection.executemany(insert, [tuple(row[column] for column in COLUMNS)
+                                                         for row in rows])
+            event['records'] = len(todo)
+        return result
+
+    def find(self, device=None, serial=None, rec_type=None, after=None, before=None,
+             min_records=None, max_records=None, min_acquisition_time_ms=None,
+             max_acquisition_time_ms=None, directory=None):
+        '''
+        Input: (all optional, None for no condition)
+        1. device, serial: part of the device name (HW_Type, e.g. 'HydraHarp') or of the serial number.
+        2. rec_type: record type (see tttr_mode_to_ptu.py).
+        3. after, before: creation time, unix time or datetime.
+        4. min_records, max_records: number of records.
+        5. min_acquisition_time_ms, max_acquisition_time_ms: acquisition time (ms).
+        6. directory: only the files in this directory tree.
+
+        Output:
+        list of dicts keyed by COLUMNS, of the files whose header was read, by creation time.
+        '''
+        conditions = ['error IS NULL']
+        parameters = []
+        for column, operator, value in (('device', 'LIKE', device), ('serial', 'LIKE', serial),
+                                        ('rec_type', '=', rec_type), ('created', '>=', after),
+                                        ('created', '<', before), ('num_records', '>=', min_records),
+                                        ('num_records', '<=', max_records),
+                                        ('acquisition_time_ms', '>=', min_acquisition_time_ms),
+                                        ('acquisition_time_ms', '<=', max_acquisition_time_ms)):
+            if value is None:
+                continue
+            if isinstance(value, datetime.datetime):
+                value = value.timestamp()
+            if operator == 'LIKE':
+                value = '%' + value + '%'
+            conditions.append('{0} {1} ?'.format(column, operator))
+            parameters.append(value)
+        if directory is not None:
+            conditions.append('substr(path, 1, ?) = ?')
+            prefix = os.path.join(os.path.abspath(directory), '')
+            parameters += [len(prefix), prefix]
+        query = 'SELECT * FROM files WHERE {0} ORDER BY created, path'.format(' AND '.join(conditions))
+        return [dict(row) for row in self.connection.execute(query, parameters)]
+
+    def failed(self):
+        '''
+        List of (path, error) of the files whose header could not be read.
+        '''
+        return [tuple(row) for row in
+                self.connection.execute('SELECT path, error FROM files WHERE error IS NOT NULL')]
+
+
+def _parse_date(value):
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Catalog the headers of .ptu files in a SQLite database.')
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help='SQLite file of the catalog')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    update = subparsers.add_parser('update', help='add the new and modified files of directories')
+    update.add_argument('directories', nargs='+', help='directories to catalog, with their subdirectories')
+    update.add_argument('-j', '--jobs', type=int, default=DEFAULT_SCAN_THREADS,
+                        help='number of threads reading the headers')
+    update.add_argument('-f', '--force', action='store_true', help='read all the headers again')
+    find = subparsers.add_parser('find', help='list the cataloged files matching conditions')
+    find.add_argument('--device', help='part of the device name, e.g. HydraHarp')
+    find.add_argument('--serial', help='part of the serial number')
+    find.add_argument('--rec-type', type=lambda value: int(value, 0), help='record type, e.g. 0x00010203')
+    find.add_argument('--after', type=_parse_date, help='created at or after this date (ISO format)')
+    find.add_argument('--before', type=_parse_date, help='created before this date (ISO format)')
+    find.add_argument('--min-records', type=int)
+    find.add_argument('--max-records', type=int)
+    find.add_argument('--min-acquisition-time-ms', type=int)
+    find.add_argument('--max-acquisition-time-ms', type=int)
+    find.add_argument('--directory', help='only the files in this directory tree')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    add_environment_hook()
+    catalog = PTUCatalog(args.catalog)
+    try:
+        if args.command == 'update':
+            result = catalog.update(args.directories, jobs=args.jobs, force=args.force)
+            logger.info('Scanned %d, unchanged %d, removed %d, failed %d files', result['scanned'],
+                        result['unchanged'], result['removed'], result['failed'])
+            return 1 if result['failed'] else 0
+        for row in catalog.find(device=args.device, serial=args.serial, rec_type=args.rec_type,
+                                after=args.after, before=args.before, min_records=args.min_records,
+                                max_records=args.max_records,
+                                min_acquisition_time_ms=args.min_acquisition_time_ms,
+                                max_acquisition_time_ms=args.max_acquisition_time_ms,
+                                directory=args.directory):
+            created = datetime.datetime.fromtimestamp(row['created']).isoformat(' ', 'seconds') \
+                if row['created'] is not None else ''
+            print('{0}\t{1}\t{2}\t{3:#010x}\t{4}\t{5}'.format(
+                row['path'], row['device'], created, row['rec_type'] or 0,
+                row['acquisition_time_ms'], row['num_records']))
+        return 0
+    finally:
+        catalog.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
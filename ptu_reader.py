@@ -0,0 +1,215 @@
+'''
+This script includes a reader for .ptu files, giving random access to the records of
+a given time window without scanning the whole file.
+The records are memory-mapped, and a sparse time index (one entry per index_stride records)
+is built once and saved next to the file. When the file has grown since the index was saved
+(e.g. during an acquisition), only the new records are indexed.
+'''
+
+import hashlib
+import os
+import numpy as np
+from tttr_mode_to_ptu import read_ptuheader
+from tttr_decoder import TTTRDecoder, iter_decode, is_t3
+from legacy_header import read_legacy_header
+from compressed_io import open_file, open_records
+
+# Number of records per index entry
+INDEX_STRIDE = 1 << 16
+# Version of the index file layout
+INDEX_VERSION = 2
+
+
+def open_time_tags(filename):
+    '''
+    Memory-map the records of a .ptu file or of a legacy file (.pt2, .pt3, .ht2 or .ht3).
+    Compressed files (see compressed_io.py) are read on demand instead, with random access
+    for zstd files in the seekable format.
+    Output:
+    dict with:
+    tags: header tags (see read_ptuheader), or header fields for a legacy file (see read_legacy_header).
+    rec_type, global_resolution, resolution: see tttr_decoder.TTTRDecoder (resolution is None in T2 mode).
+    records_offset: offset in bytes of the first record.
+    records: np.memmap of the records (uint32), their number taken from the file size
+    (compressed_io.RecordStream for a compressed file).
+    '''
+    with open_file(filename) as file:
+        is_ptu = file.read(6) == b"PQTTTR"
+    if is_ptu:
+        tags, records_offset = read_ptuheader(filename, isprint=False)
+        rec_type = tags["TTResultFormat_TTTRRecType"]
+        global_resolution = tags["MeasDesc_GlobalResolution"]
+        resolution = tags.get("MeasDesc_Resolution")
+    else:
+        legacy = read_legacy_header(filename)
+        tags = legacy["fields"]
+        rec_type = legacy["rec_type"]
+        records_offset = legacy["records_offset"]
+        global_resolution = legacy["global_resolution"]
+        resolution = legacy["resolution"]
+    records = open_records(filename, records_offset)
+    return {"tags": tags, "rec_type": rec_type, "global_resolution": global_resolution,
+            "resolution": resolution if is_t3(rec_type) else None,
+            "records_offset": records_offset, "records": records}
+
+
+class PTUReader:
+    '''
+    Input:
+    1. filename: .ptu file to read.
+    2. index_stride: default: INDEX_STRIDE. Number of records per entry of the time index.
+    3. index_file: default: filename + '.index.npz'. Sidecar file where the time index is cached.
+       If False, the index is only kept in memory.
+
+    Attributes:
+    tags: header tags, as returned by read_ptuheader.
+    header_end: offset of the first record in the file.
+    records: np.memmap of the records (uint32).
+
+    The index holds, for each block of index_stride records, the overflow correction at the start
+    of the block and the smallest and largest timestamps (ps) of the block.
+    The saved index also holds a fingerprint of the indexed records (see _fingerprint), and is
+    rebuilt when the file was replaced by another one.
+    '''
+
+    def __init__(self, filename, index_stride=INDEX_STRIDE, index_file=None):
+        self.filename = filename
+        self.tags, self.header_end = read_ptuheader(filename, isprint=False)
+        self.rec_type = self.tags["TTResultFormat_TTTRRecType"]
+        self.global_resolution = self.tags["MeasDesc_GlobalResolution"]
+        self.resolution = self.tags.get("MeasDesc_Resolution")
+        self.index_stride = index_stride
+        if index_file is None:
+            index_file = os.fspath(filename) + ".index.npz"
+        self.index_file = index_file
+        self.records = None
+        self.refresh()
+
+    def __len__(self):
+        return self.records.shape[0]
+
+    def _decoder(self):
+        return TTTRDecoder(self.rec_type, self.global_resolution,
+                           self.resolution if is_t3(self.rec_type) else None)
+
+    def refresh(self):
+        """
+        Map the records currently in the file and bring the time index up to date.
+        The number of records is taken from the file size, not from TTResult_NumberOfRecords,
+        so files still being written can be read.
+        """
+        self.records = open_records(self.filename, self.header_end)
+        self._update_index()
+
+    def _fingerprint(self, n_records):
+        # hash of the first block and of the last record indexed: appending records keeps them
+        if n_records == 0:
+            return ""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.ascontiguousarray(self.records[:min(n_records, self.index_stride)]))
+        digest.update(np.ascontiguousarray(self.records[n_records - 1:n_records]))
+        return digest.hexdigest()
+
+    def _load_index(self):
+        empty = {"ofl": np.zeros(1, dtype=np.int64), "tmin": np.zeros(0, dtype=np.int64),
+                 "tmax": np.zeros(0, dtype=np.int64), "n_records": 0}
+        if not self.index_file or not os.path.exists(self.index_file):
+            return empty
+        with np.load(self.index_file) as data:
+            index = {key: data[key] for key in data.files}
+        if (int(index["version"]) != INDEX_VERSION
+                or int(index["stride"]) != self.index_stride
+                or int(index["header_end"]) != self.header_end
+                or int(index["n_records"]) > len(self)
+                or str(index["fingerprint"]) != self._fingerprint(int(index["n_records"]))):
+            return empty
+        index["n_records"] = int(index["n_records"])
+        return index
+
+    def _update_index(self):
+        index = self._load_index()
+        n_indexed = index["n_records"]
+        if n_indexed == len(self) and n_indexed > 0:
+            self._index = index
+            return
+        # Restart from the last complete block, the last one may have been partial
+        n_blocks = n_indexed // self.index_stride
+        ofl = list(index["ofl"][:n_blocks + 1])
+        tmin = list(index["tmin"][:n_blocks])
+        tmax = list(index["tmax"][:n_blocks])
+        decoder = self._decoder()
+        decoder.reset(int(ofl[-1]))
+        for start in range(n_blocks * self.index_stride, len(self), self.index_stride):
+            timestamp = decoder.decode(self.records[start:start + self.index_stride])["timestamp"]
+            if timestamp.shape[0]:
+                tmin.append(timestamp.min())
+                tmax.append(timestamp.max())
+            else:
+                tmin.append(np.iinfo(np.int64).max)
+                tmax.append(np.iinfo(np.int64).min)
+            ofl.append(decoder.oflcorrection)
+        self._index = {"ofl": np.array(ofl, dtype=np.int64),
+                       "tmin": np.array(tmin, dtype=np.int64),
+                       "tmax": np.array(tmax, dtype=np.int64),
+                       "n_records": len(self)}
+        if self.index_file:
+            self._save_index()
+
+    def _save_index(self):
+        temporary = self.index_file + ".tmp"
+        with open(temporary, "wb") as file:
+            np.savez(file, version=INDEX_VERSION, stride=self.index_stride,
+                     header_end=self.header_end, n_records=self._index["n_records"],
+                     fingerprint=self._fingerprint(self._index["n_records"]),
+                     ofl=self._index["ofl"], tmin=self._index["tmin"], tmax=self._index["tmax"])
+        os.replace(temporary, self.index_file)
+
+    def block_range(self, t0, t1):
+        """
+        Return the range of blocks (first, last + 1) holding all the records with t0 <= timestamp < t1 (ps).
+        """
+        # Largest timestamp up to each block and smallest timestamp from each block on
+        last = np.maximum.accumulate(self._index["tmax"])
+        first = np.minimum.accumulate(self._index["tmin"][::-1])[::-1]
+        return (int(np.searchsorted(last, t0, side="left")),
+                int(np.searchsorted(first, t1, side="left")))
+
+    def block_info(self, block):
+        """
+        Return (overflow correction at the start, smallest timestamp, largest timestamp) of a block of the index.
+        """
+        return (int(self._index["ofl"][block]), int(self._index["tmin"][block]),
+                int(self._index["tmax"][block]))
+
+    def n_blocks(self):
+        return self._index["tmin"].shape[0]
+
+    def window(self, t0, t1):
+        """
+        Decode the records with t0 <= timestamp < t1, times in ps.
+        Only the blocks of the index overlapping the window are decoded.
+        Output:
+        dict of arrays, as returned by TTTRDecoder.decode.
+        """
+        first_block, end_block = self.block_range(t0, t1)
+        end_block = max(end_block, first_block)
+        decoder = self._decoder()
+        decoder.reset(int(self._index["ofl"][first_block]))
+        decoded = decoder.decode(self.records[first_block * self.index_stride:
+                                              end_block * self.index_stride])
+        selected = (decoded["timestamp"] >= t0) & (decoded["timestamp"] < t1)
+        return {key: value[selected] for key, value in decoded.items()}
+
+    def iter_decode(self, chunk_records=INDEX_STRIDE * 16):
+        """
+        Decode the whole file chunk by chunk, see tttr_decoder.iter_decode.
+        """
+        return iter_decode(self.records, self.rec_type, self.global_resolution,
+                           self.resolution if is_t3(self.rec_type) else None,
+                           chunk_records)
+
+
+if __name__ == "__main__":
+    reader = PTUReader("test.ptu")
+    window = reader.window(0, 100 * 10**9)
+    print('{0} records between 0 and 100 ms'.format(window["timestamp"].shape[0]))
@@ -0,0 +1,191 @@
+'''
+This script includes functions to split a .ptu file into pieces of fixed duration,
+and to merge back-to-back .ptu files into a single one with continuous timestamps.
+Both work in constant memory, on files larger than the RAM:
+the cut points and the end of each file are found with a chunked, vectorized scan of the decoded records,
+and the records are copied in bulk (see copy_records). Each output file gets the header of its source,
+with the number of records and the acquisition time patched (see patch_ptuheader).
+The sources can be compressed (.ptu.gz, .ptu.zst, see compressed_io.py), they are decompressed on the fly.
+The output files are not compressed.
+'''
+
+import math
+import os
+import numpy as np
+from tttr_mode_to_ptu import patch_ptuheader, copy_records, rtPicoHarpT2, rtPicoHarpT3
+from ptu_reader import open_time_tags
+from compressed_io import open_file, strip_compression_extension, compression_from_extension
+from tttr_decoder import (TTTRDecoder, is_t3, DECODE_CHUNK_RECORDS, V1_RECORD_TYPES,
+                          T2WRAPAROUND_PICOHARP, T3WRAPAROUND_PICOHARP, T2WRAPAROUND_V1,
+                          T2WRAPAROUND_V2, T3WRAPAROUND)
+
+
+def overflow_period(rec_type):
+    '''
+    Number of time tags (T2) or sync periods (T3) added by one overflow.
+    '''
+    if rec_type == rtPicoHarpT2:
+        return T2WRAPAROUND_PICOHARP
+    if rec_type == rtPicoHarpT3:
+        return T3WRAPAROUND_PICOHARP
+    if is_t3(rec_type):
+        return T3WRAPAROUND
+    return T2WRAPAROUND_V1 if rec_type in V1_RECORD_TYPES else T2WRAPAROUND_V2
+
+
+def overflow_records(rec_type, n_overflows, chunk_records=DECODE_CHUNK_RECORDS):
+    '''
+    Yield arrays of records adding n_overflows overflow periods, at most chunk_records records at a time.
+    PicoHarp and HydraHarp v1 records hold one overflow each, the other record types up to 1023 (T3)
+    or 2^25 - 1 (T2) overflows each.
+    '''
+    if rec_type in (rtPicoHarpT2, rtPicoHarpT3):
+        word, per_record = 0xF0000000, 1
+    elif rec_type in V1_RECORD_TYPES:
+        word, per_record = 0xFE000000, 1
+    else:
+        word, per_record = 0xFE000000, 0x3FF if is_t3(rec_type) else 0x1FFFFFF
+    n_full, remainder = divmod(n_overflows, per_record)
+    record = word | (per_record if per_record > 1 else 0)
+    for start in range(0, n_full, chunk_records):
+        yield np.full(min(chunk_records, n_full - start), record, dtype="<u4")
+    if remainder:
+        yield np.array([word | remainder], dtype="<u4")
+
+
+def _open_ptu(filename):
+    source = open_time_tags(filename)
+    return source["tags"], source["records_offset"], source["records"], TTTRDecoder(
+        source["rec_type"], source["global_resolution"], source["resolution"], return_index=True)
+
+
+def _write_piece(source, header, outputfile, start, stop, acquisition_time_ms):
+    header_end = len(header)
+    with open(outputfile, "wb") as output:
+        output.write(header)
+        copy_records(source, output, offset=header_end + 4 * start, length=4 * (stop - start))
+    patch_ptuheader(outputfile, acquisition_time_ms=acquisition_time_ms, total_records=stop - start)
+
+
+def split_ptu(inputfile, duration_ms, output_pattern=None, chunk_records=DECODE_CHUNK_RECORDS):
+    '''
+    Input:
+    1. inputfile: .ptu file to be split, possibly compressed.
+    2. duration_ms: duration of each piece (ms).
+    3. output_pattern: default: None, i.e. inputfile without extensions + '_{0:04d}.ptu'.
+       Name of the pieces, formatted with the index of the piece.
+    4. chunk_records: default: DECODE_CHUNK_RECORDS. Number of records decoded at once.
+
+    Output:
+    List of the pieces written. Piece k holds the records with k * duration_ms <= time < (k + 1) * duration_ms
+    (cut at the first record past each boundary). The time of each piece restarts close to 0.
+    '''
+    if output_pattern is None:
+        output_pattern = os.path.splitext(strip_compression_extension(inputfile))[0] + '_{0:04d}.ptu'
+    tags, header_end, records, decoder = _open_ptu(inputfile)
+    duration_ps = int(round(duration_ms * 1e9))
+    pieces = []
+    piece_start = 0
+    boundary = duration_ps
+    last = 0
+    with open_file(inputfile) as source:
+        # read once: seeking back to the header is slow in a compressed file
+        header = source.read(header_end)
+        for chunk_start in range(0, records.shape[0], chunk_records):
+            decoded = decoder.decode(records[chunk_start:chunk_start + chunk_records])
+            timestamp = decoded["timestamp"]
+            if timestamp.shape[0]:
+                last = max(last, int(timestamp.max()))
+            while True:
+                j = int(np.searchsorted(timestamp, boundary, side="left"))
+                if j == timestamp.shape[0]:
+                    break
+                cut = chunk_start + int(decoded["index"][j])
+                pieces.append(output_pattern.format(len(pieces)))
+                _write_piece(source, header, pieces[-1], piece_start, cut,
+                             int(math.ceil(duration_ms)))
+                piece_start = cut
+                boundary += duration_ps
+        remaining_ms = int(math.ceil((last - (boundary - duration_ps)) / 1e9))
+        pieces.append(output_pattern.format(len(pieces)))
+        _write_piece(source, header, pieces[-1], piece_start, records.shape[0],
+                     max(0, min(int(math.ceil(duration_ms)), remaining_ms)))
+    return pieces
+
+
+def _scan_end(records, decoder, chunk_records):
+    '''
+    Overflow correction after the last record and largest timestamp (ps) of a file.
+    '''
+    last = 0
+    for start in range(0, records.shape[0], chunk_records):
+        timestamp = decoder.decode(records[start:start + chunk_records])["timestamp"]
+        if timestamp.shape[0]:
+            last = max(last, int(timestamp.max()))
+    return decoder.oflcorrection, last
+
+
+def merge_ptu(inputfiles, outputfile, use_acquisition_time=True, chunk_records=DECODE_CHUNK_RECORDS):
+    '''
+    Input:
+    1. inputfiles: list of .ptu files acquired one after the other, with the same device and mode,
+       possibly compressed.
+    2. outputfile: merged .ptu file to be written (not compressed), with the header of the first file.
+    3. use_acquisition_time: default: True. If True, each file is taken to last at least its
+       MeasDesc_AcquisitionTime, otherwise up to its last record.
+    4. chunk_records: default: DECODE_CHUNK_RECORDS. Number of records decoded at once.
+
+    Output:
+    Number of records written.
+    Overflow records are inserted after each file so the next one starts at the first overflow
+    boundary after its end: the absolute time continues across the files (rounded up to one overflow period).
+    '''
+    if not inputfiles:
+        raise ValueError('No file to merge')
+    if compression_from_extension(outputfile) is not None:
+        raise ValueError('The merged file {0} cannot be compressed, its header is patched in place'.format(
+            outputfile))
+    first_tags = None
+    total_records = 0
+    total_periods = 0
+    with open(outputfile, "wb") as output:
+        for j, inputfile in enumerate(inputfiles):
+            tags, header_end, records, decoder = _open_ptu(inputfile)
+            rec_type = tags["TTResultFormat_TTTRRecType"]
+            if first_tags is None:
+                first_tags = tags
+                period = overflow_period(rec_type)
+                tick_ps = tags["MeasDesc_GlobalResolution"] * 1e12
+                with open_file(inputfile) as source:
+                    copy_records(source, output, offset=0, length=header_end)
+            else:
+                for name in ("TTResultFormat_TTTRRecType", "MeasDesc_GlobalResolution",
+                             "MeasDesc_Resolution"):
+                    if tags.get(name) != first_tags.get(name):
+                        raise ValueError('{0} of {1} does not match the first file'.format(
+                            name, inputfile))
+            with open_file(inputfile) as source:
+                copy_records(source, output, offset=header_end, length=4 * records.shape[0])
+            total_records += records.shape[0]
+            oflcorrection, last = _scan_end(records, decoder, chunk_records)
+            end = int(math.ceil(last / tick_ps))
+            if use_acquisition_time:
+                end = max(end, int(math.ceil(tags["MeasDesc_AcquisitionTime"] * 1e9 / tick_ps)))
+            if j == len(inputfiles) - 1:
+                total_periods += end / period
+                break
+            periods = int(math.ceil(end / period))
+            for overflows in overflow_records(rec_type, max(periods - oflcorrection // period, 0),
+                                              chunk_records):
+                output.write(overflows.tobytes())
+                total_records += overflows.shape[0]
+            total_periods += periods
+    patch_ptuheader(outputfile, total_records=total_records,
+                    acquisition_time_ms=int(math.ceil(total_periods * period * tick_ps / 1e9)))
+    return total_records
+
+
+if __name__ == "__main__":
+    pieces = split_ptu('test.ptu', duration_ms=1000)
+    print(pieces)
+    merge_ptu(pieces, 'test_merged.ptu')
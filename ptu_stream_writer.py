@@ -0,0 +1,215 @@
+'''
+This script includes a writer to save the time tags of a live acquisition directly to a .ptu file,
+e.g. the buffers returned by ReadFiFo in the PicoQuant tttrmode demo scripts.
+The header is written first from the header template, the records are appended as they arrive
+and the number of records, acquisition time and count rates are patched in the header on close.
+The photons of each channel are counted as the records are written (see header_check.RecordSummary),
+so the count rates are derived from the data unless the acquisition loop gives them.
+Writing to disk is done by a separate thread with a set of preallocated buffers (double buffering
+by default), so the acquisition loop only copies its records and never waits for the disk.
+A file that was not closed properly (e.g. crash during the acquisition) can be fixed with repair_ptu.
+'''
+
+import os
+import queue
+import threading
+import time
+import numpy as np
+from tttr_mode_to_ptu import (load_header_template, read_ptuheader,
+                              patch_ptuheader, header_patches, COPY_CHUNK_SIZE)
+from header_check import RecordSummary, derive_header_values, header_rates
+
+
+class PTUStreamWriter:
+    '''
+    Input:
+    1. filename: .ptu file to be written.
+    2. header: default: 'picoharp_ptu_header_parameter.npz'. Header file of the same device and mode as the records.
+    3. timestamp: default: None, i.e. now. Unix time of the start of the acquisition.
+    4. buffer_size: default: COPY_CHUNK_SIZE. Size in bytes of each buffer handed to the writing thread.
+    5. n_buffers: default: 2. Number of preallocated buffers. write only blocks when all of them are waiting for the disk.
+    6. global_resolution, resolution: default: None, i.e. as in the header template.
+       Time tag unit (T2) or sync period (T3), and dtime bin width (T3), in s, written to the header.
+
+    Usage:
+    with PTUStreamWriter('data.ptu', header='hydraharp_ptu_header_parameter.npz') as writer:
+        while measuring:
+            nactual = ReadFiFo(buffer)
+            writer.write(np.ctypeslib.as_array(buffer)[:nactual])
+    '''
+
+    def __init__(self, filename, header='picoharp_ptu_header_parameter.npz', timestamp=None,
+                 buffer_size=COPY_CHUNK_SIZE, n_buffers=2, global_resolution=None, resolution=None):
+        if buffer_size % 4:
+            raise ValueError("buffer_size must be a multiple of 4 bytes")
+        self.filename = filename
+        self.template = load_header_template(header)
+        tags = self.template.tags
+        self.rec_type = tags["TTResultFormat_TTTRRecType"]
+        if global_resolution is None:
+            global_resolution = tags["MeasDesc_GlobalResolution"]
+        if resolution is None:
+            resolution = tags.get("MeasDesc_Resolution")
+        self.global_resolution = global_resolution
+        self.summary = RecordSummary(self.rec_type, global_resolution, resolution)
+        self.n_records = 0
+        self.buffer_size = buffer_size
+        self._start = time.monotonic()
+        self._file = open(filename, "wb")
+        self._file.write(self.template.render(acquisition_time_ms=0, total_records=0,
+                                              timestamp=timestamp, global_resolution=global_resolution,
+                                              resolution=resolution))
+        self._free = queue.Queue()
+        for _ in range(n_buffers):
+            self._free.put(bytearray(buffer_size))
+        self._pending = queue.Queue()
+        self._current = self._free.get()
+        self._filled = 0
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_loop(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            buffer, size = item
+            if self._error is None:
+                try:
+                    self._file.write(memoryview(buffer)[:size])
+                    self.summary.update(memoryview(buffer)[:size])
+                except Exception as error:
+                    self._error = error
+            self._free.put(buffer)
+
+    def _check_error(self):
+        if self._error is not None:
+            raise IOError("Writing {0} failed".format(self.filename)) from self._error
+
+    def _hand_over(self):
+        self._pending.put((self._current, self._filled))
+        self._current = self._free.get()
+        self._filled = 0
+
+    def write(self, records):
+        """
+        Append records (any uint32 buffer: numpy array, ctypes array, bytes, ...).
+        The records are copied, so the caller can reuse its buffer right away.
+        """
+        if self._closed:
+            raise ValueError("write to a closed PTUStreamWriter")
+        self._check_error()
+        data = memoryview(records).cast("B")
+        if len(data) % 4:
+            raise ValueError("records must be a buffer of 32 bit records")
+        self.n_records += len(data) // 4
+        while len(data):
+            n = min(len(data), self.buffer_size - self._filled)
+            self._current[self._filled:self._filled + n] = data[:n]
+            self._filled += n
+            data = data[n:]
+            if self._filled == self.buffer_size:
+                self._hand_over()
+
+    def close(self, acquisition_time_ms=None, counts0=None, counts1=None):
+        """
+        Write the remaining records and patch the header.
+        acquisition_time_ms defaults to the time elapsed since the writer was created.
+        counts0 and counts1 (sync rate, and input rate or list of the rates of each input channel,
+        see tttr_mode_to_ptu.header_patches) default to the rates of the photons written
+        over acquisition_time_ms (see header_check.header_rates).
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if acquisition_time_ms is None:
+            acquisition_time_ms = int(round((time.monotonic() - self._start) * 1000))
+        if self._filled:
+            self._hand_over()
+        self._pending.put(None)
+        self._thread.join()
+        try:
+            self._check_error()
+            counts0, counts1 = _default_rates(self.rec_type, self.global_resolution, self.summary.result(),
+                                              acquisition_time_ms,
+                                              len(self.template.offsets["TTResult_InputRate"]),
+                                              counts0, counts1)
+            for offset, value in header_patches(self.template.offsets,
+                                                acquisition_time_ms=acquisition_time_ms,
+                                                total_records=self.n_records, counts0=counts0,
+                                                counts1=counts1):
+                self._file.seek(offset)
+                self._file.write(value)
+        finally:
+            self._file.close()
+
+
+def _default_rates(rec_type, global_resolution, derived, acquisition_time_ms, n_inputs,
+                   counts0=None, counts1=None):
+    """
+    counts0 and counts1 (sync rate and list of the n_inputs input rates, integers) for the header,
+    the ones left to None derived from the photon counts of derived (see header_check.derive_header_values)
+    over acquisition_time_ms.
+    """
+    duration_s = acquisition_time_ms / 1e3
+    channel_rates = {channel: (count / duration_s if duration_s > 0 else 0.0)
+                     for channel, count in derived["channel_counts"].items()}
+    sync_rate, input_rates = header_rates(rec_type, global_resolution, channel_rates, n_inputs)
+    if counts0 is None:
+        counts0 = int(round(sync_rate))
+    if counts1 is None:
+        counts1 = [int(round(rate)) for rate in input_rates]
+    return counts0, counts1
+
+
+def needs_repair(filename):
+    """
+    True if the number of records in the header of the ptu file does not match the size of the file.
+    """
+    tags, header_end = read_ptuheader(filename, isprint=False)
+    size = os.path.getsize(filename) - header_end
+    return size % 4 != 0 or tags.get("TTResult_NumberOfRecords") != size // 4
+
+
+def repair_ptu(filename, acquisition_time_ms=None):
+    """
+    Fix the header of a ptu file that was not closed properly:
+    the incomplete last record is removed, the number of records is set from the file size,
+    the acquisition time from the time of the last record (unless acquisition_time_ms is given)
+    and the sync and input rates from the photons counted over the acquisition time.
+    Output :
+    True if the file was modified.
+    """
+    if not needs_repair(filename):
+        return False
+    tags, header_end = read_ptuheader(filename, isprint=False)
+    n_records = (os.path.getsize(filename) - header_end) // 4
+    with open(filename, "r+b") as file:
+        file.truncate(header_end + 4 * n_records)
+    rec_type = tags["TTResultFormat_TTTRRecType"]
+    global_resolution = tags["MeasDesc_GlobalResolution"]
+    derived = derive_header_values(filename, header_end, rec_type, global_resolution,
+                                   tags.get("MeasDesc_Resolution"))
+    if acquisition_time_ms is None:
+        acquisition_time_ms = derived["acquisition_time_ms"]
+    n_inputs = sum(1 for tag in tags if tag.startswith("TTResult_InputRate("))
+    counts0, counts1 = _default_rates(rec_type, global_resolution, derived, acquisition_time_ms, n_inputs)
+    patch_ptuheader(filename, acquisition_time_ms=acquisition_time_ms, total_records=n_records,
+                    counts0=counts0, counts1=counts1)
+    return True
+
+
+if __name__ == "__main__":
+    records = np.arange(1000000, dtype=np.uint32) % 0x0FFFFFFF
+    with PTUStreamWriter("test.ptu", header='picoharp_ptu_header_parameter.npz') as writer:
+        for chunk in np.array_split(records, 10):
+            writer.write(chunk)
+    print(read_ptuheader("test.ptu", isprint=False)[0]["TTResult_NumberOfRecords"])
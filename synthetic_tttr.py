@@ -0,0 +1,249 @@
+'''
+This script generates synthetic time tag data, to test and benchmark the conversion functions
+without real measurement files.
+The photons arrive as a Poisson process at a given count rate, spread uniformly over the input channels.
+In T3 mode the dtime follows an exponential decay (fluorescence lifetime).
+Overflow records are inserted wherever the time tag (T2) or the sync counter (T3) wraps around,
+exactly as the devices do, so the density of overflow records follows from the count rate.
+The records are generated in chunks, so files larger than the RAM can be written.
+
+Supported devices: PicoHarp 300 (.pt2, .pt3) and HydraHarp 400 (.ht2, .ht3, format versions 1.0 and 2.0).
+'''
+
+import math
+import time
+import numpy as np
+from tttr_mode_to_ptu import (rtPicoHarpT3, rtPicoHarpT2, rtHydraHarpT3, rtHydraHarpT2,
+                              rtHydraHarp2T3, rtHydraHarp2T2)
+from tttr_decoder import is_t3, V1_RECORD_TYPES, DECODE_CHUNK_RECORDS
+from ptu_split_merge import overflow_period
+from legacy_header import (PICOHARP_LAYOUT, PICOHARP_BOARD_LAYOUT, PICOHARP_TTTR_LAYOUT,
+                           HYDRAHARP_LAYOUT, HYDRAHARP_CHANNEL_LAYOUT, HYDRAHARP_TTTR_LAYOUT,
+                           RECORD_TYPES, PICOHARP_T2_RESOLUTION)
+
+PICOHARP_RECORD_TYPES = (rtPicoHarpT2, rtPicoHarpT3)
+SYNTHETIC_RECORD_TYPES = (rtPicoHarpT2, rtPicoHarpT3, rtHydraHarpT2, rtHydraHarpT3,
+                          rtHydraHarp2T2, rtHydraHarp2T3)
+# Sync rate (Hz) used by default in T3 mode
+DEFAULT_SYNC_RATE = {rtPicoHarpT3: 10000000, rtHydraHarpT3: 80000000, rtHydraHarp2T3: 80000000}
+# Time tag unit (s) in T2 mode and dtime bin width (s) in T3 mode
+DEFAULT_RESOLUTION = {rtPicoHarpT2: PICOHARP_T2_RESOLUTION, rtPicoHarpT3: 4e-12}
+HYDRAHARP_RESOLUTION = 1e-12
+
+
+def _default_resolution(rec_type):
+    return DEFAULT_RESOLUTION.get(rec_type, HYDRAHARP_RESOLUTION)
+
+
+def _encode(ticks, channel, dtime, rec_type, wraps_before):
+    '''
+    Records of photons at absolute ticks (time tags in T2 mode, sync counts in T3 mode),
+    preceded by the overflow records of the wraparounds since the previous photon.
+    Returns the records and the number of wraparounds before the last photon.
+    '''
+    period = overflow_period(rec_type)
+    wraps = ticks // period
+    n_overflows = np.diff(wraps, prepend=np.int64(wraps_before))
+    if rec_type in PICOHARP_RECORD_TYPES:
+        overflow_word, per_record = 0xF0000000, 1
+    elif rec_type in V1_RECORD_TYPES:
+        overflow_word, per_record = 0xFE000000, 1
+    else:
+        overflow_word, per_record = 0xFE000000, 0x3FF if is_t3(rec_type) else 0x1FFFFFF
+    # overflow records before each photon, each holding up to per_record overflows
+    n_before = -(-n_overflows // per_record)
+    position = np.arange(ticks.shape[0]) + np.cumsum(n_before)
+    records = np.empty(ticks.shape[0] + int(n_before.sum()), dtype="<u4")
+    if per_record == 1:
+        records[:] = overflow_word
+    else:
+        owner = np.repeat(np.arange(ticks.shape[0]), n_before)
+        last = np.zeros(records.shape[0], dtype=bool)
+        last[position[n_before > 0] - 1] = True
+        is_overflow = np.ones(records.shape[0], dtype=bool)
+        is_overflow[position] = False
+        counts = np.where(last[is_overflow],
+                          n_overflows[owner] - (n_before[owner] - 1) * per_record, per_record)
+        records[is_overflow] = overflow_word | counts.astype(np.uint32)
+    ticks = (ticks % period).astype(np.uint32)
+    channel = channel.astype(np.uint32)
+    if rec_type == rtPicoHarpT2:
+        photons = (channel << 28) | ticks
+    elif rec_type == rtPicoHarpT3:
+        photons = (channel << 28) | (dtime.astype(np.uint32) << 16) | ticks
+    elif is_t3(rec_type):
+        photons = (channel << 25) | (dtime.astype(np.uint32) << 10) | ticks
+    else:
+        photons = (channel << 25) | ticks
+    records[position] = photons
+    return records, int(wraps[-1]) if wraps.shape[0] else wraps_before
+
+
+def synthetic_records(n_photons, rec_type, count_rate=1e5, overflow_density=None, n_channels=2,
+                      global_resolution=None, resolution=None, lifetime=3e-9,
+                      chunk_records=DECODE_CHUNK_RECORDS, seed=0, summary=None):
+    '''
+    Input:
+    1. n_photons: number of photon records.
+    2. rec_type: record type (PicoHarp or HydraHarp, T2 or T3).
+    3. count_rate: default: 1e5. Total count rate (counts/s) of the input channels.
+    4. overflow_density: default: None. If given, number of wraparounds per photon, which sets
+       the count rate instead of count_rate (one overflow record per wraparound for the PicoHarp and
+       HydraHarp v1, at most one overflow record between two photons for HydraHarp v2).
+    5. n_channels: default: 2. Number of input channels (up to 4 for the PicoHarp).
+    6. global_resolution: default: None, i.e. 4 ps (PicoHarp T2), 1 ps (HydraHarp T2)
+       or the period of DEFAULT_SYNC_RATE (T3). Time tag unit (T2) or sync period (T3) in s.
+    7. resolution: default: None, i.e. 4 ps (PicoHarp) or 1 ps (HydraHarp). dtime bin width (s), T3 only.
+    8. lifetime: default: 3e-9. Decay time (s) of the dtime distribution, T3 only.
+    9. chunk_records: default: DECODE_CHUNK_RECORDS. Number of photons generated at once.
+    10. seed: default: 0. Seed of the random generator.
+    11. summary: default: None. If a dict is given, it is filled with num_records, channel_counts
+        and last_time (time of the last photon, s, without its dtime) once the generator is exhausted.
+
+    Output:
+    Generator of arrays of records (uint32), in order.
+    '''
+    if rec_type not in SYNTHETIC_RECORD_TYPES:
+        raise ValueError('Unsupported record type {0:#010x}'.format(rec_type))
+    t3 = is_t3(rec_type)
+    max_channels = 4 if rec_type in PICOHARP_RECORD_TYPES else 64
+    if not 1 <= n_channels <= max_channels:
+        raise ValueError('n_channels must be between 1 and {0}'.format(max_channels))
+    if global_resolution is None:
+        global_resolution = 1 / DEFAULT_SYNC_RATE[rec_type] if t3 else _default_resolution(rec_type)
+    if resolution is None:
+        resolution = _default_resolution(rec_type)
+    if overflow_density is not None:
+        count_rate = 1 / (overflow_density * overflow_period(rec_type) * global_resolution)
+    # mean interval between photons, in ticks
+    mean_interval = 1 / (count_rate * global_resolution)
+    # PicoHarp T3 channels are numbered from 1
+    first_channel = 1 if rec_type == rtPicoHarpT3 else 0
+    max_dtime = min((1 << 12 if rec_type == rtPicoHarpT3 else 1 << 15) - 1,
+                    int(global_resolution / resolution))
+    rng = np.random.default_rng(seed)
+    now = 0
+    wraps = 0
+    num_records = 0
+    channel_counts = np.zeros(n_channels, dtype=np.int64)
+    for start in range(0, n_photons, chunk_records):
+        n = min(chunk_records, n_photons - start)
+        ticks = np.cumsum(np.rint(rng.exponential(mean_interval, n)).astype(np.int64)) + now
+        now = int(ticks[-1])
+        channel = rng.integers(0, n_channels, n)
+        channel_counts += np.bincount(channel, minlength=n_channels)
+        dtime = None
+        if t3:
+            dtime = np.minimum(rng.exponential(lifetime / resolution, n), max_dtime).astype(np.int64)
+        records, wraps = _encode(ticks, channel + first_channel, dtime, rec_type, wraps)
+        num_records += records.shape[0]
+        yield records
+    if summary is not None:
+        summary['num_records'] = num_records
+        summary['channel_counts'] = [int(count) for count in channel_counts]
+        summary['last_time'] = now * global_resolution
+        summary['global_resolution'] = global_resolution
+        summary['resolution'] = resolution if t3 else None
+
+
+def write_synthetic_stream(filename, n_photons, rec_type, **kwargs):
+    '''
+    Input:
+    1. filename: raw time tags file to be written (records only, no header),
+       as saved by the acquisition software or combined with a header by combine_time_tags_header.
+    2. n_photons, rec_type and kwargs: see synthetic_records.
+
+    Output:
+    dict with num_records, channel_counts, last_time (s), global_resolution and resolution.
+    '''
+    summary = {}
+    with open(filename, 'wb') as outputfile:
+        for records in synthetic_records(n_photons, rec_type, summary=summary, **kwargs):
+            outputfile.write(records)
+    return summary
+
+
+def _legacy_header(fileformat, version, summary, n_channels):
+    '''
+    Header of a legacy file holding the records described by summary (see synthetic_records).
+    '''
+    acquisition_time_ms = int(math.ceil(summary['last_time'] * 1e3))
+    duration = max(summary['last_time'], 1e-12)
+    rates = [int(round(count / duration)) for count in summary['channel_counts']]
+    text = {'FormatVersion': version, 'CreatorName': 'synthetic_tttr', 'CreatorVersion': '1.0',
+            'FileTime': time.strftime('%d/%m/%y %H:%M:%S'), 'CRLF': '\r\n',
+            'Comment': 'Synthetic data', 'BitsPerRecord': 32, 'AcquisitionTime': acquisition_time_ms,
+            'StopAt': 0, 'MeasurementMode': int(fileformat[2])}
+    t3 = fileformat.endswith('3')
+    sync_rate = int(round(1 / summary['global_resolution'])) if t3 else 0
+    if fileformat.startswith('pt'):
+        text.update({'Ident': 'PicoHarp 300', 'RoutingChannels': 4, 'NumberOfBoards': 1})
+        board = {'HardwareIdent': 'PicoHarp 300', 'HardwareVersion': '2.0', 'SyncDivider': 1,
+                 'Resolution': (summary['resolution'] or summary['global_resolution']) * 1e9}
+        if t3:
+            tttr = {'CntRate0': sync_rate, 'CntRate1': sum(rates)}
+        else:
+            # channel 0 is the sync input in T2 mode
+            tttr = {'CntRate0': rates[0], 'CntRate1': sum(rates[1:])}
+        tttr.update({'StopAfter': acquisition_time_ms, 'Records': summary['num_records']})
+        return (PICOHARP_LAYOUT.pack(text) + PICOHARP_BOARD_LAYOUT.pack(board)
+                + PICOHARP_TTTR_LAYOUT.pack(tttr))
+    text.update({'Ident': 'HydraHarp', 'NumberOfCurves': 0,
+                 'Resolution': (summary['resolution'] or summary['global_resolution']) * 1e12,
+                 'HardwareIdent': 'HydraHarp 400', 'ModulesPresent': 1,
+                 'BaseResolution': summary['global_resolution'] * 1e12 if not t3 else 1.0,
+                 'InputsEnabled': (1 << n_channels) - 1, 'InpChansPresent': n_channels,
+                 'SyncDivider': 1})
+    header = HYDRAHARP_LAYOUT.pack(text)
+    for j in range(n_channels):
+        header += HYDRAHARP_CHANNEL_LAYOUT.pack({'InputModuleIndex': j // 4})
+    header += np.array(rates, dtype='<i4').tobytes()
+    return header + HYDRAHARP_TTTR_LAYOUT.pack({'SyncRate': sync_rate, 'StopAfter': acquisition_time_ms,
+                                                'Records': summary['num_records']})
+
+
+def write_synthetic_legacy(filename, n_photons, fileformat='pt2', version=None, n_channels=2, **kwargs):
+    '''
+    Input:
+    1. filename: legacy file to be written.
+    2. n_photons: number of photon records.
+    3. fileformat: default: 'pt2'. 'pt2', 'pt3', 'ht2' or 'ht3'.
+    4. version: default: None, i.e. '2.0'. Format version ('1.0' or '2.0' for the HydraHarp).
+    5. n_channels and kwargs: see synthetic_records. The T2 time tag unit of the PicoHarp is fixed to 4 ps.
+
+    Output:
+    dict with num_records, channel_counts, last_time (s), global_resolution, resolution and records_offset.
+    The header (number of records, acquisition time, count rates) matches the generated records.
+    '''
+    if version is None:
+        version = '2.0'
+    if (fileformat, version) not in RECORD_TYPES:
+        raise ValueError('Unsupported {0} format version {1!r}'.format(fileformat, version))
+    rec_type = RECORD_TYPES[(fileformat, version)]
+    if fileformat == 'pt2':
+        kwargs['global_resolution'] = PICOHARP_T2_RESOLUTION
+    elif fileformat.endswith('3'):
+        # the sync rate is stored as an integer in the header
+        sync_rate = 1 / kwargs['global_resolution'] if kwargs.get('global_resolution') else \
+            DEFAULT_SYNC_RATE[rec_type]
+        kwargs['global_resolution'] = 1 / int(round(sync_rate))
+    summary = {}
+    # the header has a fixed size: placeholder first, then the real one once the records are known
+    placeholder = _legacy_header(fileformat, version, {'last_time': 0.0, 'num_records': 0,
+                                                       'channel_counts': [0] * n_channels,
+                                                       'global_resolution': 1.0, 'resolution': 1.0},
+                                 n_channels)
+    with open(filename, 'wb') as outputfile:
+        outputfile.write(placeholder)
+        for records in synthetic_records(n_photons, rec_type, n_channels=n_channels, summary=summary,
+                                         **kwargs):
+            outputfile.write(records)
+        outputfile.seek(0)
+        outputfile.write(_legacy_header(fileformat, version, summary, n_channels))
+    summary['records_offset'] = len(placeholder)
+    return summary
+
+
+if __name__ == "__main__":
+    print(write_synthetic_legacy('synthetic.pt2', 1000000, 'pt2', count_rate=2e5))
+    print(write_synthetic_stream('synthetic_ht3.bin', 1000000, rtHydraHarp2T3, n_channels=4))
@@ -0,0 +1,136 @@
+'''
+Check the batch conversion of batch_convert.py: the files found in the given directories, and the
+manifest logic deciding which files are converted again (new, modified, converted with another header
+or whose .ptu file is missing) and which are skipped, hashing a file only when its modification time changed.
+
+Usage:
+python -m pytest test_batch_convert.py
+'''
+
+import gzip
+import json
+import os
+import shutil
+import pytest
+import batch_convert
+from batch_convert import batch_convert_pt2_to_ptu, find_legacy_files, file_hash
+from synthetic_tttr import write_synthetic_legacy
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(autouse=True)
+def package_dir(monkeypatch):
+    # the default header files are looked up in the working directory
+    monkeypatch.chdir(PACKAGE_DIR)
+
+
+@pytest.fixture
+def hash_calls(monkeypatch):
+    calls = []
+
+    def counting_hash(filename, *args):
+        calls.append(filename)
+        return file_hash(filename, *args)
+    monkeypatch.setattr(batch_convert, 'file_hash', counting_hash)
+    return calls
+
+
+def _convert(paths, manifest, **kwargs):
+    return batch_convert_pt2_to_ptu([str(path) for path in paths], jobs=1, manifest=str(manifest), **kwargs)
+
+
+def test_find_legacy_files(tmp_path):
+    names = ['a.pt2', 'b.pt3.gz', 'c.ht3.zst', 'd.ht2', 'notes.txt', 'e.ptu', os.path.join('sub', 'f.pt2')]
+    os.mkdir(str(tmp_path / 'sub'))
+    for name in names:
+        (tmp_path / name).write_bytes(b'')
+    found = [os.path.relpath(filename, str(tmp_path)) for filename in find_legacy_files([str(tmp_path)])]
+    assert found == ['a.pt2', 'b.pt3.gz', 'c.ht3.zst', 'd.ht2']
+    found = find_legacy_files([str(tmp_path)], recursive=True)
+    assert str(tmp_path / 'sub' / 'f.pt2') in found and len(found) == 5
+    # glob patterns and files are taken as they are, without duplicates
+    assert find_legacy_files([str(tmp_path / '*.txt'), str(tmp_path / 'a.pt2'), str(tmp_path / 'a.pt2')]) == \
+        [str(tmp_path / 'a.pt2'), str(tmp_path / 'notes.txt')]
+
+
+def test_manifest_skips_the_converted_files(tmp_path, hash_calls):
+    pt2 = tmp_path / 'first.pt2'
+    ht3 = tmp_path / 'second.ht3'
+    write_synthetic_legacy(str(pt2), 2000, 'pt2')
+    write_synthetic_legacy(str(ht3), 2000, 'ht3')
+    manifest = tmp_path / 'manifest.json'
+    result = _convert([tmp_path], manifest)
+    assert sorted(result['converted']) == [str(pt2), str(ht3)] and not result['failed']
+    entries = json.loads(manifest.read_text())
+    for filename in (pt2, ht3):
+        # hashed during the conversion
+        assert entries[str(filename)]['sha256'] == file_hash(str(filename))
+        assert entries[str(filename)]['output'] == os.path.splitext(str(filename))[0] + '.ptu'
+        assert os.path.exists(entries[str(filename)]['output'])
+    assert hash_calls == []
+    result = _convert([tmp_path], manifest)
+    assert sorted(result['skipped']) == [str(pt2), str(ht3)] and result['converted'] == []
+    assert hash_calls == []
+
+
+def test_manifest_rehashes_a_touched_file(tmp_path, hash_calls):
+    pt2 = tmp_path / 'file.pt2'
+    write_synthetic_legacy(str(pt2), 2000, 'pt2')
+    manifest = tmp_path / 'manifest.json'
+    _convert([pt2], manifest)
+    stat = os.stat(str(pt2))
+    os.utime(str(pt2), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    # same content: skipped after hashing it, the new modification time is recorded
+    assert _convert([pt2], manifest)['skipped'] == [str(pt2)]
+    assert hash_calls == [str(pt2)]
+    assert json.loads(manifest.read_text())[str(pt2)]['mtime_ns'] == stat.st_mtime_ns + 10 ** 9
+    assert _convert([pt2], manifest)['skipped'] == [str(pt2)]
+    assert hash_calls == [str(pt2)]
+    # same size, other content: converted again
+    with open(str(pt2), 'r+b') as file:
+        file.seek(-4, os.SEEK_END)
+        file.write(b'\x00\x00\x00\x00')
+    os.utime(str(pt2), ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+    assert _convert([pt2], manifest)['converted'] == [str(pt2)]
+    assert json.loads(manifest.read_text())[str(pt2)]['sha256'] == file_hash(str(pt2))
+
+
+def test_manifest_converts_again(tmp_path, hash_calls):
+    pt2 = tmp_path / 'file.pt2'
+    write_synthetic_legacy(str(pt2), 2000, 'pt2')
+    manifest = tmp_path / 'manifest.json'
+    _convert([pt2], manifest)
+    # other header
+    header = str(tmp_path / 'header.npz')
+    shutil.copy('picoharp_ptu_header_parameter.npz', header)
+    assert _convert([pt2], manifest, header=header)['converted'] == [str(pt2)]
+    assert _convert([pt2], manifest, header=header)['skipped'] == [str(pt2)]
+    # missing .ptu file
+    os.remove(str(tmp_path / 'file.ptu'))
+    assert _convert([pt2], manifest, header=header)['converted'] == [str(pt2)]
+    # forced
+    assert _convert([pt2], manifest, header=header, force=True)['converted'] == [str(pt2)]
+    # other size, converted without hashing
+    with open(str(pt2), 'ab') as file:
+        file.write(b'\x00\x00\x00\x10')
+    assert _convert([pt2], manifest, header=header)['converted'] == [str(pt2)]
+    assert hash_calls == []
+
+
+def test_compressed_and_failed_files(tmp_path):
+    pt2 = tmp_path / 'file.pt2'
+    write_synthetic_legacy(str(pt2), 2000, 'pt2')
+    with open(str(pt2), 'rb') as source, gzip.open(str(tmp_path / 'packed.pt2.gz'), 'wb') as destination:
+        shutil.copyfileobj(source, destination)
+    (tmp_path / 'broken.ht2').write_bytes(b'not a header' * 100)
+    manifest = tmp_path / 'manifest.json'
+    result = _convert([tmp_path], manifest)
+    assert sorted(result['converted']) == [str(pt2), str(tmp_path / 'packed.pt2.gz')]
+    assert [filename for filename, error in result['failed']] == [str(tmp_path / 'broken.ht2')]
+    entries = json.loads(manifest.read_text())
+    packed = entries[str(tmp_path / 'packed.pt2.gz')]
+    assert packed['output'] == str(tmp_path / 'packed.ptu')
+    # the hash is the one of the uncompressed content
+    assert packed['sha256'] == entries[str(pt2)]['sha256']
+    assert str(tmp_path / 'broken.ht2') not in entries
@@ -0,0 +1,123 @@
+'''
+Check the columnar export of columnar_export.py: the row groups cover the time ranges, and the columns
+read back from HDF5 and Parquet, whole or for a time range, are the ones of a full decode.
+
+Usage:
+python -m pytest test_columnar_export.py
+'''
+
+import json
+import os
+import numpy as np
+import pytest
+from tttr_mode_to_ptu import assemble_ptu, rtPicoHarpT2, rtHydraHarp2T3
+from tttr_decoder import decode_records
+from synthetic_tttr import synthetic_records, write_synthetic_legacy
+from ptu_reader import open_time_tags
+from columnar_export import export_columnar, read_columnar, iter_row_groups, h5py, pq
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+PICOHARP_HEADER = os.path.join(PACKAGE_DIR, 'picoharp_ptu_header_parameter.npz')
+# Short row groups and small chunks, so that the file holds many of them
+ROW_GROUP_DURATION_PS = 10 ** 10
+CHUNK_RECORDS = 1000
+FORMATS = [pytest.param('.h5', marks=pytest.mark.skipif(h5py is None, reason='h5py is not installed')),
+           pytest.param('.parquet', marks=pytest.mark.skipif(pq is None, reason='pyarrow is not installed'))]
+
+
+def _ptu(tmp_path):
+    filename = str(tmp_path / 'data.ptu')
+    records = np.concatenate(list(synthetic_records(20000, rtPicoHarpT2, count_rate=1e5, n_channels=3)))
+    with open(filename, 'wb') as file:
+        file.write(assemble_ptu(records, header=PICOHARP_HEADER))
+    return filename
+
+
+def _legacy(tmp_path):
+    filename = str(tmp_path / 'data.ht3')
+    write_synthetic_legacy(filename, 20000, 'ht3', count_rate=1e5)
+    return filename
+
+
+def _full_decode(filename):
+    source = open_time_tags(filename)
+    return decode_records(source['records'], source['rec_type'], source['global_resolution'],
+                          source['resolution'])
+
+
+def _check_range(data, full, t0, t1):
+    selected = np.ones(full['timestamp'].shape[0], dtype=bool)
+    if t0 is not None:
+        selected &= full['timestamp'] >= t0
+    if t1 is not None:
+        selected &= full['timestamp'] < t1
+    for name, value in data.items():
+        np.testing.assert_array_equal(value, full[name][selected], err_msg=name)
+        assert value.dtype == full[name].dtype, name
+
+
+def test_row_groups():
+    timestamp = np.arange(0, 10000, 7, dtype=np.int64)
+    chunks = [{'timestamp': timestamp[start:start + 100]} for start in range(0, timestamp.shape[0], 100)]
+    groups = list(iter_row_groups(chunks, row_group_duration_ps=1000, max_rows=60))
+    np.testing.assert_array_equal(np.concatenate([group['timestamp'] for group in groups]), timestamp)
+    for group in groups:
+        # within one time range, at most max_rows rows
+        assert group['timestamp'].shape[0] <= 60
+        assert group['timestamp'][0] // 1000 == group['timestamp'][-1] // 1000
+    # each of the 10 time ranges of 1000 ps (142 or 143 rows) is split in 3 by max_rows
+    assert len(groups) == 30
+
+
+@pytest.mark.parametrize('extension', FORMATS)
+@pytest.mark.parametrize('source', [_ptu, _legacy])
+def test_round_trip(tmp_path, extension, source):
+    inputfile = source(tmp_path)
+    outputfile = str(tmp_path / ('data' + extension))
+    full = _full_decode(inputfile)
+    n_rows = export_columnar(inputfile, outputfile, row_group_duration_ps=ROW_GROUP_DURATION_PS,
+                             chunk_records=CHUNK_RECORDS, hdf5_chunk_rows=4096, threads=2)
+    assert n_rows == full['timestamp'].shape[0]
+    data = read_columnar(outputfile)
+    # nsync is not exported
+    assert sorted(data) == sorted(name for name in full if name != 'nsync')
+    _check_range(data, full, None, None)
+    last = int(full['timestamp'].max())
+    for t0, t1 in ((last // 3, last // 2), (0, ROW_GROUP_DURATION_PS), (last // 2, None), (None, last // 4),
+                   (last + 1, None)):
+        data = read_columnar(outputfile, columns=['channel', 'timestamp'], t0=t0, t1=t1)
+        assert list(data) == ['channel', 'timestamp']
+        _check_range(data, full, t0, t1)
+
+
+@pytest.mark.skipif(h5py is None, reason='h5py is not installed')
+def test_hdf5_layout(tmp_path):
+    inputfile = _ptu(tmp_path)
+    outputfile = str(tmp_path / 'data.h5')
+    export_columnar(inputfile, outputfile, row_group_duration_ps=ROW_GROUP_DURATION_PS,
+                    chunk_records=CHUNK_RECORDS, hdf5_chunk_rows=4096)
+    tags = open_time_tags(inputfile)['tags']
+    with h5py.File(outputfile, 'r') as file:
+        assert file.attrs['rec_type'] == rtPicoHarpT2
+        assert file.attrs['TTResult_NumberOfRecords'] == tags['TTResult_NumberOfRecords']
+        assert 'dtime' not in file
+        row_groups = file['row_groups'][:]
+        assert file['timestamp'].compression == 'gzip' and file['timestamp'].chunks == (4096,)
+    # row groups one after the other, each within one time range
+    np.testing.assert_array_equal(row_groups[1:, 2], row_groups[:-1, 2] + row_groups[:-1, 3])
+    assert np.all(row_groups[:, 0] // ROW_GROUP_DURATION_PS == row_groups[:, 1] // ROW_GROUP_DURATION_PS)
+
+
+@pytest.mark.skipif(pq is None, reason='pyarrow is not installed')
+def test_parquet_metadata(tmp_path):
+    inputfile = _legacy(tmp_path)
+    outputfile = str(tmp_path / 'data.parquet')
+    export_columnar(inputfile, outputfile, row_group_duration_ps=ROW_GROUP_DURATION_PS)
+    metadata = pq.read_schema(outputfile).metadata
+    assert json.loads(metadata[b'ptu_header'])['rec_type'] == rtHydraHarp2T3
+    assert pq.ParquetFile(outputfile).num_row_groups > 1
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError, match='format'):
+        export_columnar(_ptu(tmp_path), str(tmp_path / 'data.csv'))
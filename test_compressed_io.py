@@ -0,0 +1,124 @@
+'''
+Check the compressed input/output of compressed_io.py: round-trips through gzip, zstd and seekable zstd,
+the seek table, random access to the records with RecordStream and the uncompressed size of each format.
+
+Usage:
+python -m pytest test_compressed_io.py
+'''
+
+import gzip
+import numpy as np
+import pytest
+from compressed_io import (open_file, read_seek_table, uncompressed_size, open_records, RecordStream,
+                           SeekableZstdReader, detect_compression, strip_compression_extension, zstandard)
+
+requires_zstandard = pytest.mark.skipif(zstandard is None, reason='zstandard is not installed')
+# Small frames, so that the records span many frames
+FRAME_SIZE = 4096
+OFFSET = 100
+
+
+@pytest.fixture
+def content():
+    records = np.random.default_rng(0).integers(0, 1 << 32, 50000, dtype=np.uint32)
+    return b'h' * OFFSET + records.astype('<u4').tobytes()
+
+
+def _write(filename, content, **kwargs):
+    with open_file(filename, 'wb', **kwargs) as file:
+        # several writes, not aligned on the frames
+        for start in range(0, len(content), 3000):
+            file.write(content[start:start + 3000])
+
+
+def _check_slices(records, content):
+    expected = np.frombuffer(content, dtype='<u4', offset=OFFSET)
+    assert len(records) == expected.shape[0]
+    # forwards, backwards and across frames
+    for start, stop in ((0, 10), (40000, 40100), (5, 3000), (1020, 1030), (49990, 60000), (7, 7)):
+        np.testing.assert_array_equal(records[start:stop], expected[start:stop])
+
+
+@requires_zstandard
+def test_seekable_zstd_round_trip(tmp_path, content):
+    filename = str(tmp_path / 'data.ptu.zst')
+    _write(filename, content, seekable=True, frame_size=FRAME_SIZE)
+    assert detect_compression(filename) == 'zstd'
+    with open(filename, 'rb') as file:
+        table = read_seek_table(file)
+    assert sum(size for compressed, size in table) == len(content)
+    assert all(size == FRAME_SIZE for compressed, size in table[:-1])
+    # still a valid zstd file for any decoder
+    with open(filename, 'rb') as file:
+        assert zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True).read() == content
+    with open_file(filename) as file:
+        assert isinstance(file, SeekableZstdReader)
+        file.seek(len(content) - 10)
+        assert file.read() == content[-10:]
+        file.seek(5)
+        assert file.read(FRAME_SIZE * 2) == content[5:5 + FRAME_SIZE * 2]
+    assert uncompressed_size(filename) == len(content)
+    records = open_records(filename, OFFSET)
+    assert records.random_access
+    _check_slices(records, content)
+    records.close()
+
+
+@requires_zstandard
+def test_zstd_stream_round_trip(tmp_path, content):
+    filename = str(tmp_path / 'data.ptu.zst')
+    _write(filename, content)
+    with open(filename, 'rb') as file:
+        assert read_seek_table(file) is None
+    with open_file(filename) as file:
+        assert file.read() == content
+    assert uncompressed_size(filename) == len(content)
+    records = RecordStream(filename, OFFSET)
+    assert not records.random_access
+    _check_slices(records, content)
+    records.close()
+
+
+def test_gzip_round_trip(tmp_path, content):
+    filename = str(tmp_path / 'data.pt2.gz')
+    _write(filename, content)
+    with gzip.open(filename) as file:
+        assert file.read() == content
+    assert detect_compression(filename) == 'gzip'
+    # from the trailer, and by decompressing the file
+    assert uncompressed_size(filename) == len(content)
+    assert uncompressed_size(filename, exact=True) == len(content)
+    records = RecordStream(filename, OFFSET)
+    assert not records.random_access
+    _check_slices(records, content)
+    records.close()
+
+
+def test_gzip_of_several_members(tmp_path, content):
+    filename = str(tmp_path / 'data.pt2.gz')
+    with open(filename, 'wb') as file:
+        file.write(gzip.compress(content[:1000]) + gzip.compress(content[1000:]))
+    # the trailer only holds the size of the last member
+    assert uncompressed_size(filename) == len(content) - 1000
+    assert uncompressed_size(filename, exact=True) == len(content)
+    records = RecordStream(filename, OFFSET, n_records=(len(content) - OFFSET) // 4)
+    _check_slices(records, content)
+    records.close()
+
+
+def test_plain_files_and_names(tmp_path, content):
+    filename = str(tmp_path / 'data.ptu')
+    _write(filename, content)
+    assert detect_compression(filename) is None
+    assert uncompressed_size(filename) == len(content)
+    records = open_records(filename, OFFSET)
+    assert isinstance(records, np.memmap)
+    _check_slices(records, content)
+    del records
+    assert strip_compression_extension('a/data.pt2.zst') == 'a/data.pt2'
+    assert strip_compression_extension('a/data.pt2.GZ') == 'a/data.pt2'
+    assert strip_compression_extension('a/data.pt2') == 'a/data.pt2'
+    with pytest.raises(ValueError):
+        open_file(filename, 'ab')
+    with pytest.raises(ValueError):
+        open_file(filename, 'wb', compression='lzma')
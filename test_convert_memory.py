@@ -0,0 +1,77 @@
+'''
+Check that converting a .pt2 file to .ptu runs in constant memory: the peak RSS (VmHWM) of a conversion
+in a fresh process must not grow with the size of the file. The conversion runs with its defaults,
+the header check (verify) included.
+
+Usage:
+python -m pytest test_convert_memory.py
+'''
+
+import multiprocessing
+import os
+import struct
+import sys
+import numpy as np
+import pytest
+from instrumentation import peak_rss_mb
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+HEADER = os.path.join(PACKAGE_DIR, 'picoharp_ptu_header_parameter.npz')
+# Number of records of the small and of the large file, both larger than one copy chunk
+# (tttr_mode_to_ptu.COPY_CHUNK_SIZE) so the chunk buffers are fully allocated in both conversions
+SMALL_RECORDS = 3000000
+LARGE_RECORDS = 12000000
+# Growth of the peak RSS (MB) allowed from the small to the large file
+RSS_MARGIN_MB = 8
+# Offset of the first record of a PicoHarp 300 .pt2 file with one board and no image header
+PT2_RECORDS_OFFSET = 728
+
+
+def write_pt2(filename, num_records, chunk_records=1 << 20):
+    '''
+    Write a PicoHarp 300 .pt2 file with num_records random photon records on channel 1.
+    '''
+    header = bytearray(PT2_RECORDS_OFFSET)
+    struct.pack_into('<16s6s18s12s18s', header, 0, b'PicoHarp 300', b'2.0', b'PicoHarp Software',
+                     b'2.3', b'17/10/26 00:00:00')
+    # Numberofcurves, Bitsperrecord, Routingchannels, Numberofboards, Activecurve, Measurementmode
+    struct.pack_into('<6i', header, 328, 0, 32, 1, 1, 0, 2)
+    # Acquisitiontime_ms
+    struct.pack_into('<i', header, 364, 1000)
+    # board: Hardwareident, Hardwareversion, then Resolution_ns after 6 ints
+    struct.pack_into('<16s8s', header, 536, b'PicoHarp 300', b'2.0')
+    struct.pack_into('<f', header, 536 + 24 + 4 * 6, 0.004)
+    # Inprate0, Inprate1, Stopafter_ms, Stopreason, Numrecords, Imghdrsize
+    struct.pack_into('<6i', header, 704, 100000, 100000, 1000, 0, num_records, 0)
+    random = np.random.default_rng(0)
+    with open(filename, 'wb') as file:
+        file.write(header)
+        for start in range(0, num_records, chunk_records):
+            n = min(chunk_records, num_records - start)
+            ticks = np.sort(random.integers(0, 1 << 28, n, dtype=np.uint32))
+            file.write((ticks | np.uint32(1 << 28)).astype('<u4').tobytes())
+
+
+def _convert_peak_rss_mb(filename):
+    from pt2_to_ptu import convert_pt2_to_ptu
+    convert_pt2_to_ptu(filename, isprint=False, header=HEADER)
+    return peak_rss_mb()
+
+
+def _peak_rss_of_conversion(filename):
+    # a fresh process per conversion, so the peak RSS only covers this conversion
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_convert_peak_rss_mb, (filename,))
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='VmHWM is only available on Linux')
+def test_peak_rss_does_not_grow_with_file_size(tmp_path):
+    peaks = []
+    for num_records in (SMALL_RECORDS, LARGE_RECORDS):
+        filename = str(tmp_path / 'synthetic_{0}.pt2'.format(num_records))
+        write_pt2(filename, num_records)
+        peaks.append(_peak_rss_of_conversion(filename))
+        assert os.path.getsize(os.path.splitext(filename)[0] + '.ptu') > 4 * num_records
+    small, large = peaks
+    assert large - small < RSS_MARGIN_MB, \
+        'peak RSS grew from {0:.1f} MB to {1:.1f} MB'.format(small, large)
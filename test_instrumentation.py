@@ -0,0 +1,107 @@
+'''
+Check the instrumentation of instrumentation.py: the events of each stage, with the failures,
+the stages of a conversion summed by StageCounters, the json lines of JSONLinesHook and the hook
+of the TTTR_EVENTS environment variable, added once and only by the entry points.
+
+Usage:
+python -m pytest test_instrumentation.py
+'''
+
+import json
+import os
+import pytest
+import instrumentation
+from instrumentation import stage, add_hook, remove_hook, StageCounters, JSONLinesHook, add_environment_hook
+from synthetic_tttr import write_synthetic_legacy
+from pt2_to_ptu import convert_to_ptu
+import batch_convert  # noqa: F401
+import ptu_catalog  # noqa: F401
+import tttr_analysis  # noqa: F401
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def events():
+    received = []
+    hook = add_hook(received.append)
+    yield received
+    remove_hook(hook)
+
+
+def test_stage_events(events):
+    with stage('work', file='a.ptu') as event:
+        event['bytes'] = 10
+    assert len(events) == 1
+    assert {key: events[0][key] for key in ('stage', 'file', 'bytes', 'pid')} == \
+        {'stage': 'work', 'file': 'a.ptu', 'bytes': 10, 'pid': os.getpid()}
+    assert events[0]['seconds'] >= 0
+    with pytest.raises(KeyError):
+        with stage('failing'):
+            raise KeyError('missing')
+    assert events[1]['stage'] == 'failing' and 'missing' in events[1]['error']
+
+
+def test_no_events_without_hooks():
+    assert instrumentation._hooks == ()
+    with stage('work') as event:
+        pass
+    # the event is not completed when nobody receives it
+    assert 'seconds' not in event
+
+
+def test_conversion_stages(tmp_path, monkeypatch):
+    monkeypatch.chdir(PACKAGE_DIR)
+    filename = str(tmp_path / 'file.pt2')
+    summary = write_synthetic_legacy(filename, 1000, 'pt2')
+    counters = add_hook(StageCounters())
+    try:
+        convert_to_ptu(filename, isprint=False)
+    finally:
+        remove_hook(counters)
+    totals = counters.as_dict()
+    for name in ('convert', 'header_parse', 'header_write', 'payload_copy', 'header_patch', 'cleanup'):
+        assert totals[name]['calls'] == 1, name
+    assert totals['header_parse']['bytes'] == summary['records_offset']
+    assert totals['payload_copy']['bytes'] == totals['convert']['bytes'] == 4 * summary['num_records']
+    assert totals['convert']['records'] == summary['num_records']
+    counters.reset()
+    assert counters.as_dict() == {}
+
+
+def test_json_lines(tmp_path):
+    filename = str(tmp_path / 'events.jsonl')
+    hook = add_hook(JSONLinesHook(filename))
+    try:
+        with stage('first', records=3):
+            pass
+        with stage('second'):
+            pass
+    finally:
+        remove_hook(hook)
+        hook.close()
+    with open(filename) as file:
+        lines = [json.loads(line) for line in file]
+    assert [line['stage'] for line in lines] == ['first', 'second']
+    assert lines[0]['records'] == 3
+
+
+def test_environment_hook(tmp_path, monkeypatch):
+    monkeypatch.setattr(instrumentation, '_environment_hook', None)
+    monkeypatch.delenv(instrumentation.EVENTS_ENVIRONMENT_VARIABLE, raising=False)
+    assert add_environment_hook() is None
+    # importing the entry points (batch_convert, ptu_catalog and tttr_analysis, above) does not register any hook
+    assert instrumentation._hooks == ()
+    filename = str(tmp_path / 'events.jsonl')
+    monkeypatch.setenv(instrumentation.EVENTS_ENVIRONMENT_VARIABLE, filename)
+    hook = add_environment_hook()
+    try:
+        assert add_environment_hook() is hook
+        assert instrumentation._hooks == (hook,)
+        with stage('work'):
+            pass
+    finally:
+        remove_hook(hook)
+        hook.close()
+    with open(filename) as file:
+        assert json.loads(file.readline())['stage'] == 'work'
@@ -0,0 +1,129 @@
+'''
+Check the header layouts of legacy_header.py against headers written field by field at the offsets of the
+PicoQuant file format descriptions, one per format: .pt2 and .pt3 (PicoHarp 300, version 2.0),
+.ht2 and .ht3 (HydraHarp 400, versions 1.0 and 2.0).
+
+Usage:
+python -m pytest test_legacy_header.py
+'''
+
+import struct
+import pytest
+from tttr_mode_to_ptu import (rtPicoHarpT2, rtPicoHarpT3, rtHydraHarpT2, rtHydraHarpT3,
+                              rtHydraHarp2T2, rtHydraHarp2T3)
+from legacy_header import read_legacy_header, decode_legacy_header, detect_legacy_format
+
+# Offsets of the fields of the PicoHarp header (one board)
+PICOHARP_BOARD_OFFSET = 536
+PICOHARP_TTTR_OFFSET = 692
+# Offsets of the fields of the HydraHarp header, the input channels start at HYDRAHARP_CHANNELS_OFFSET
+HYDRAHARP_CHANNELS_OFFSET = 696
+
+
+def _text_header(ident, version):
+    header = bytearray(328)
+    struct.pack_into('<16s6s18s12s18s2s', header, 0, ident, version, b'test', b'1.0',
+                     b'17/10/26 12:34:56', b'\r\n')
+    return header
+
+
+def picoharp_header(mode, num_records=1000, acquisition_time_ms=1500, sync_rate=10000000,
+                    input_rate=25000, resolution_ns=0.004, image_header=0):
+    header = _text_header(b'PicoHarp 300', b'2.0') + bytearray(PICOHARP_TTTR_OFFSET + 36 - 328)
+    # Curves, BitsPerRecord, RoutingChannels, NumberOfBoards, ActiveCurve, MeasurementMode
+    struct.pack_into('<6i', header, 328, 0, 32, 4, 1, 0, mode)
+    struct.pack_into('<i', header, 364, acquisition_time_ms)
+    struct.pack_into('<16s8s', header, PICOHARP_BOARD_OFFSET, b'PicoHarp 300', b'2.0')
+    struct.pack_into('<f', header, 584, resolution_ns)
+    # ExtDevices, Reserved1, Reserved2, CntRate0, CntRate1, StopAfter, StopReason, Records, ImgHdrSize
+    struct.pack_into('<9i', header, PICOHARP_TTTR_OFFSET, 0, 0, 0, sync_rate, input_rate,
+                     acquisition_time_ms, 0, num_records, image_header)
+    return bytes(header + bytearray(4 * image_header))
+
+
+def hydraharp_header(mode, version, input_rates, num_records=1000, acquisition_time_ms=1500,
+                     sync_rate=80000000, resolution_ps=1.0, base_resolution_ps=1.0, image_header=0):
+    channels = len(input_rates)
+    header = _text_header(b'HydraHarp', version) + bytearray(HYDRAHARP_CHANNELS_OFFSET - 328)
+    # NumberOfCurves, BitsPerRecord, ActiveCurve, MeasurementMode, SubMode, Binning, Resolution
+    struct.pack_into('<6id', header, 328, 0, 32, 0, mode, 0, 0, resolution_ps)
+    struct.pack_into('<i', header, 364, acquisition_time_ms)
+    struct.pack_into('<16s', header, 536, b'HydraHarp 400')
+    struct.pack_into('<dqi', header, 648, base_resolution_ps, (1 << channels) - 1, channels)
+    for j in range(channels):
+        # InputModuleIndex, InputCFDLevel, InputCFDZeroCross, InputOffset
+        header += struct.pack('<4i', j // 4, 100, 10, 0)
+    header += struct.pack('<{0}i'.format(channels), *input_rates)
+    header += struct.pack('<4iq', sync_rate, acquisition_time_ms, 0, image_header, num_records)
+    return bytes(header + bytearray(4 * image_header))
+
+
+def test_pt2_layout():
+    legacy = decode_legacy_header(picoharp_header(2, sync_rate=1000, input_rate=2000))
+    assert (legacy['format'], legacy['rec_type']) == ('pt2', rtPicoHarpT2)
+    assert legacy['records_offset'] == 728
+    assert (legacy['num_records'], legacy['acquisition_time_ms']) == (1000, 1500)
+    assert (legacy['sync_rate'], legacy['input_rates']) == (1000, [2000])
+    assert legacy['global_resolution'] == 4e-12
+    assert legacy['resolution'] == pytest.approx(4e-12)
+    assert legacy['file_time'] == '17/10/26 12:34:56'
+    assert legacy['fields']['Boards'][0]['HardwareIdent'] == 'PicoHarp 300'
+
+
+def test_pt3_layout():
+    legacy = decode_legacy_header(picoharp_header(3, resolution_ns=0.016, image_header=5))
+    assert (legacy['format'], legacy['rec_type']) == ('pt3', rtPicoHarpT3)
+    # the imaging header is skipped
+    assert legacy['records_offset'] == 728 + 4 * 5
+    assert (legacy['sync_rate'], legacy['input_rates']) == (10000000, [25000])
+    assert legacy['global_resolution'] == pytest.approx(1e-7)
+    assert legacy['resolution'] == pytest.approx(16e-12)
+
+
+@pytest.mark.parametrize('version, rec_type', [('1.0', rtHydraHarpT2), ('2.0', rtHydraHarp2T2)])
+def test_ht2_layout(version, rec_type):
+    legacy = decode_legacy_header(hydraharp_header(2, version.encode(), [100, 200, 300],
+                                                   base_resolution_ps=1.0, num_records=1 << 33))
+    assert (legacy['format'], legacy['rec_type']) == ('ht2', rec_type)
+    assert legacy['records_offset'] == HYDRAHARP_CHANNELS_OFFSET + 3 * 20 + 24
+    assert legacy['num_records'] == 1 << 33
+    assert legacy['input_rates'] == [100, 200, 300]
+    assert legacy['global_resolution'] == pytest.approx(1e-12)
+    assert [channel['InputModuleIndex'] for channel in legacy['fields']['InpChan']] == [0, 0, 0]
+
+
+@pytest.mark.parametrize('version, rec_type', [('1.0', rtHydraHarpT3), ('2.0', rtHydraHarp2T3)])
+def test_ht3_layout(version, rec_type):
+    legacy = decode_legacy_header(hydraharp_header(3, version.encode(), [10] * 8, resolution_ps=8.0,
+                                                   sync_rate=40000000, image_header=2))
+    assert (legacy['format'], legacy['rec_type']) == ('ht3', rec_type)
+    assert legacy['records_offset'] == HYDRAHARP_CHANNELS_OFFSET + 8 * 20 + 24 + 4 * 2
+    assert legacy['sync_rate'] == 40000000
+    assert legacy['input_rates'] == [10] * 8
+    assert legacy['global_resolution'] == pytest.approx(25e-9)
+    assert legacy['resolution'] == pytest.approx(8e-12)
+    assert [channel['InputModuleIndex'] for channel in legacy['fields']['InpChan']] == [0] * 4 + [1] * 4
+
+
+def test_file_and_buffer_agree(tmp_path):
+    header = hydraharp_header(3, b'2.0', [10, 20])
+    filename = str(tmp_path / 'header.ht3')
+    with open(filename, 'wb') as file:
+        file.write(header + bytes(400))
+    # a first read shorter than the header
+    from_file = read_legacy_header(filename, read_size=100)
+    from_buffer = decode_legacy_header(header)
+    assert from_file == from_buffer
+
+
+def test_invalid_headers():
+    with pytest.raises(ValueError, match='ptu'):
+        detect_legacy_format(b'PQTTTR\0\0' + bytes(400))
+    with pytest.raises(ValueError, match='identifier'):
+        decode_legacy_header(bytes(1000))
+    with pytest.raises(ValueError, match='TTTR'):
+        decode_legacy_header(picoharp_header(0))
+    with pytest.raises(ValueError, match='version'):
+        decode_legacy_header(hydraharp_header(2, b'3.0', [1]))
+    with pytest.raises(ValueError, match='truncated'):
+        decode_legacy_header(picoharp_header(2)[:700])
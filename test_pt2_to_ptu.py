@@ -0,0 +1,126 @@
+'''
+Check the conversion of the legacy files (.pt2, .pt3, .ht2 and .ht3) to .ptu with convert_to_ptu:
+the records are copied unchanged and the .ptu header holds the record type, resolutions and count rates
+of the file, with the default header of each format. The in-memory convert_buffer_to_ptu gives the same bytes.
+
+Usage:
+python -m pytest test_pt2_to_ptu.py
+'''
+
+import os
+import struct
+import numpy as np
+import pytest
+from tttr_mode_to_ptu import read_ptuheader
+from legacy_header import read_legacy_header
+from synthetic_tttr import write_synthetic_legacy
+from compressed_io import open_file
+from pt2_to_ptu import convert_to_ptu, convert_buffer_to_ptu
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Offset of the input channels of a HydraHarp header, each one 16 bytes, followed by their input rates
+HYDRAHARP_CHANNELS_OFFSET = 696
+# Offset of the acquisition time (ms) in the PicoHarp and HydraHarp headers
+ACQUISITION_TIME_OFFSET = 364
+
+
+@pytest.fixture(autouse=True)
+def package_dir(monkeypatch):
+    # the default header files are looked up in the working directory
+    monkeypatch.chdir(PACKAGE_DIR)
+
+
+def _write(tmp_path, fileformat, version='2.0', n_channels=2):
+    filename = str(tmp_path / 'synthetic.{0}'.format(fileformat))
+    write_synthetic_legacy(filename, 5000, fileformat, version, n_channels=n_channels, count_rate=1e6)
+    return filename, read_legacy_header(filename)
+
+
+def _ptu(filename):
+    tags, header_end = read_ptuheader(os.path.splitext(filename)[0] + '.ptu', isprint=False)
+    records = np.fromfile(os.path.splitext(filename)[0] + '.ptu', dtype='<u4', offset=header_end)
+    return tags, records
+
+
+def _legacy_records(filename, legacy):
+    return np.fromfile(filename, dtype='<u4', offset=legacy['records_offset'])
+
+
+@pytest.mark.parametrize('fileformat, version, mode', [('pt2', '2.0', 2), ('pt3', '2.0', 3), ('ht2', '1.0', 2),
+                                                       ('ht2', '2.0', 2), ('ht3', '1.0', 3), ('ht3', '2.0', 3)])
+def test_default_header_of_each_format(tmp_path, fileformat, version, mode):
+    filename, legacy = _write(tmp_path, fileformat, version, n_channels=3)
+    assert convert_to_ptu(filename, isprint=False) == []
+    tags, records = _ptu(filename)
+    np.testing.assert_array_equal(records, _legacy_records(filename, legacy))
+    assert tags['TTResultFormat_TTTRRecType'] == legacy['rec_type']
+    assert tags['Measurement_Mode'] == mode
+    assert tags['TTResult_NumberOfRecords'] == legacy['num_records']
+    assert tags['MeasDesc_GlobalResolution'] == pytest.approx(legacy['global_resolution'])
+    if mode == 3:
+        assert tags['MeasDesc_Resolution'] == pytest.approx(legacy['resolution'])
+    assert tags['TTResult_SyncRate'] == legacy['sync_rate']
+
+
+def test_input_rate_of_each_channel(tmp_path):
+    filename, legacy = _write(tmp_path, 'ht3', n_channels=4)
+    convert_to_ptu(filename, isprint=False, verify=False)
+    tags, records = _ptu(filename)
+    assert [tags['TTResult_InputRate({0})'.format(j)] for j in range(4)] == legacy['input_rates']
+    assert len(set(legacy['input_rates'])) > 1
+
+
+def test_stale_input_rate_is_corrected(tmp_path):
+    filename, legacy = _write(tmp_path, 'ht2', n_channels=2)
+    stale = list(legacy['input_rates'])
+    stale[1] *= 3
+    with open(filename, 'r+b') as file:
+        file.seek(HYDRAHARP_CHANNELS_OFFSET + 16 * 2)
+        file.write(struct.pack('<2i', *stale))
+    mismatches = convert_to_ptu(filename, isprint=False)
+    assert [(tag, header_value) for tag, header_value, derived_value in mismatches] == \
+        [('input_rate(1)', stale[1])]
+    assert mismatches[0][2] == pytest.approx(legacy['input_rates'][1], rel=1e-6, abs=1)
+    tags, records = _ptu(filename)
+    assert tags['TTResult_InputRate(0)'] == legacy['input_rates'][0]
+    assert tags['TTResult_InputRate(1)'] == mismatches[0][2]
+
+
+def test_header_of_another_record_type_is_rejected(tmp_path):
+    filename, legacy = _write(tmp_path, 'pt3')
+    with pytest.raises(ValueError, match='record type'):
+        convert_to_ptu(filename, isprint=False, header='picoharp_ptu_header_parameter.npz')
+
+
+@pytest.mark.parametrize('fileformat, version', [('pt2', '2.0'), ('pt3', '2.0'), ('ht2', '1.0'), ('ht3', '2.0')])
+@pytest.mark.parametrize('verify', [True, False])
+def test_buffer_conversion_matches_the_file_conversion(tmp_path, fileformat, version, verify):
+    filename, legacy = _write(tmp_path, fileformat, version)
+    with open(filename, 'r+b') as file:
+        # a stale acquisition time, corrected when verify is True
+        file.seek(ACQUISITION_TIME_OFFSET)
+        file.write(struct.pack('<i', legacy['acquisition_time_ms'] * 10))
+        file.seek(0)
+        content = bytearray(file.read())
+    mismatches = convert_to_ptu(filename, isprint=False, verify=verify)
+    assert [tag for tag, header_value, derived_value in mismatches] == (['acquisition_time_ms'] if verify else [])
+    with open(os.path.splitext(filename)[0] + '.ptu', 'rb') as file:
+        expected = file.read()
+    ptu, buffer_mismatches = convert_buffer_to_ptu(content, verify=verify)
+    assert buffer_mismatches == mismatches
+    assert bytes(ptu) == expected
+    # into a given buffer, from a read-only buffer
+    out = bytearray(len(expected) + 8)
+    assert convert_buffer_to_ptu(bytes(content), verify=verify, out=out)[0] == len(expected)
+    assert bytes(out[:len(expected)]) == expected
+    with pytest.raises(ValueError, match='too small'):
+        convert_buffer_to_ptu(content, verify=verify, out=bytearray(len(expected) - 1))
+
+
+def test_buffer_conversion_matches_a_compressed_conversion(tmp_path):
+    filename, legacy = _write(tmp_path, 'ht3')
+    with open(filename, 'rb') as file:
+        ptu, mismatches = convert_buffer_to_ptu(file.read())
+    convert_to_ptu(filename, isprint=False, compression='gzip')
+    with open_file(os.path.splitext(filename)[0] + '.ptu.gz') as file:
+        assert file.read() == bytes(ptu)
@@ -0,0 +1,100 @@
+'''
+Check the catalog of ptu_catalog.py: the header values stored for each file, the files read again
+by an update (new, modified or removed ones only), the unreadable headers and the queries of find.
+
+Usage:
+python -m pytest test_ptu_catalog.py
+'''
+
+import datetime
+import gzip
+import os
+import pytest
+from tttr_mode_to_ptu import write_ptuheader, patch_ptuheader, rtPicoHarpT2, rtHydraHarp2T3
+from ptu_catalog import PTUCatalog, main
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+PICOHARP_HEADER = os.path.join(PACKAGE_DIR, 'picoharp_ptu_header_parameter.npz')
+HYDRAHARP_HEADER = os.path.join(PACKAGE_DIR, 'hydraharp_ptu_header_parameter.npz')
+# Creation times of the files
+JANUARY = datetime.datetime(2023, 1, 10).timestamp()
+JUNE = datetime.datetime(2023, 6, 10).timestamp()
+
+
+def _write(filename, header, timestamp, total_records, acquisition_time_ms=1000):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    write_ptuheader(filename, acquisition_time_ms, total_records, timestamp, header=header)
+
+
+@pytest.fixture
+def data(tmp_path):
+    root = tmp_path / 'data'
+    _write(str(root / 'a.ptu'), PICOHARP_HEADER, JANUARY, 1000)
+    _write(str(root / 'run' / 'b.ptu'), HYDRAHARP_HEADER, JUNE, 10 ** 7, acquisition_time_ms=60000)
+    _write(str(root / 'run' / 'c.ptu'), HYDRAHARP_HEADER, JANUARY + 60, 5000)
+    with open(str(root / 'run' / 'c.ptu'), 'rb') as source:
+        content = source.read()
+    with gzip.open(str(root / 'run' / 'd.ptu.gz'), 'wb') as packed:
+        packed.write(content)
+    (root / 'broken.ptu').write_bytes(b'PQTTTR\0\0' + b'\xff' * 100)
+    (root / 'notes.txt').write_bytes(b'')
+    return root
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = PTUCatalog(str(tmp_path / 'catalog.sqlite'))
+    yield catalog
+    catalog.close()
+
+
+def _names(rows):
+    return [os.path.basename(row['path']) for row in rows]
+
+
+def test_update_and_find(data, catalog):
+    result = catalog.update(str(data), jobs=2)
+    assert result == {'scanned': 5, 'unchanged': 0, 'removed': 0, 'failed': 1}
+    assert [os.path.basename(path) for path, error in catalog.failed()] == ['broken.ptu']
+    # by creation time, the unreadable header excluded
+    assert _names(catalog.find()) == ['a.ptu', 'c.ptu', 'd.ptu.gz', 'b.ptu']
+    row = catalog.find(rec_type=rtPicoHarpT2)[0]
+    assert row['path'] == str(data / 'a.ptu')
+    assert (row['device'], row['serial']) == ('PicoHarp 300', '1020798')
+    assert row['created'] == pytest.approx(JANUARY, abs=1e-3)
+    assert (row['num_records'], row['acquisition_time_ms'], row['mode']) == (1000, 1000, 2)
+    assert row['header_end'] == os.path.getsize(str(data / 'a.ptu'))
+    assert _names(catalog.find(device='hydra', min_records=5000)) == ['c.ptu', 'd.ptu.gz', 'b.ptu']
+    assert _names(catalog.find(rec_type=rtHydraHarp2T3, max_records=5000)) == ['c.ptu', 'd.ptu.gz']
+    assert _names(catalog.find(after=datetime.datetime(2023, 2, 1))) == ['b.ptu']
+    assert _names(catalog.find(before=JANUARY + 60)) == ['a.ptu']
+    assert _names(catalog.find(min_acquisition_time_ms=2000)) == ['b.ptu']
+    assert _names(catalog.find(directory=str(data / 'run'), serial='1025')) == ['c.ptu', 'd.ptu.gz', 'b.ptu']
+
+
+def test_update_reads_the_changed_files_only(data, catalog):
+    catalog.update(str(data))
+    assert catalog.update(str(data)) == {'scanned': 0, 'unchanged': 5, 'removed': 0, 'failed': 0}
+    patch_ptuheader(str(data / 'a.ptu'), total_records=2000)
+    stat = os.stat(str(data / 'a.ptu'))
+    os.utime(str(data / 'a.ptu'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    os.remove(str(data / 'run' / 'b.ptu'))
+    assert catalog.update(str(data)) == {'scanned': 1, 'unchanged': 3, 'removed': 1, 'failed': 0}
+    assert catalog.find(rec_type=rtPicoHarpT2)[0]['num_records'] == 2000
+    assert _names(catalog.find()) == ['a.ptu', 'c.ptu', 'd.ptu.gz']
+    # forced, and files out of the updated directory are kept
+    assert catalog.update(str(data / 'run'), force=True) == {'scanned': 2, 'unchanged': 0, 'removed': 0,
+                                                             'failed': 0}
+    assert _names(catalog.find()) == ['a.ptu', 'c.ptu', 'd.ptu.gz']
+
+
+def test_command_line(data, tmp_path, capsys):
+    database = str(tmp_path / 'catalog.sqlite')
+    # an unreadable header is reported by the exit code
+    assert main(['--catalog', database, 'update', str(data)]) == 1
+    capsys.readouterr()
+    assert main(['--catalog', database, 'find', '--rec-type', '0x00010203', '--after', '2023-01-01']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    assert lines[0].split('\t')[:2] == [str(data / 'a.ptu'), 'PicoHarp 300']
+    assert lines[0].split('\t')[3:] == ['0x00010203', '1000', '1000']
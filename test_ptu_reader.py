@@ -0,0 +1,120 @@
+'''
+Check the reader of ptu_reader.py: the records of a time window are the ones of a full decode,
+the time index is saved and reused, extended when records are appended and rebuilt when the file
+is replaced, for plain and seekable zstd files.
+
+Usage:
+python -m pytest test_ptu_reader.py
+'''
+
+import os
+import numpy as np
+import pytest
+from tttr_mode_to_ptu import assemble_ptu, rtHydraHarp2T3
+from tttr_decoder import decode_records
+from synthetic_tttr import synthetic_records
+from compressed_io import open_file, zstandard
+from ptu_reader import PTUReader, open_time_tags
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+HYDRAHARP_HEADER = os.path.join(PACKAGE_DIR, 'hydraharp_ptu_header_parameter.npz')
+GLOBAL_RESOLUTION = 25e-9
+RESOLUTION = 8e-12
+# Small blocks, so that the windows span several blocks
+INDEX_STRIDE = 1000
+
+
+def _records(n, seed=0):
+    return np.concatenate(list(synthetic_records(n, rtHydraHarp2T3, overflow_density=0.2, seed=seed,
+                                                 global_resolution=GLOBAL_RESOLUTION, resolution=RESOLUTION)))
+
+
+def _write(filename, records, **kwargs):
+    with open_file(filename, 'wb', **kwargs) as file:
+        file.write(assemble_ptu(records, header=HYDRAHARP_HEADER, global_resolution=GLOBAL_RESOLUTION,
+                                resolution=RESOLUTION))
+
+
+def _check_windows(reader, records):
+    full = decode_records(records, rtHydraHarp2T3, GLOBAL_RESOLUTION, RESOLUTION)
+    timestamp = full['timestamp']
+    last = int(timestamp[-1])
+    for t0, t1 in ((0, last + 1), (last // 3, last // 2), (int(timestamp[1500]), int(timestamp[1500]) + 1),
+                   (last // 2, last // 2), (-10, 0), (last + 1, last + 10 ** 12), (last - 10 ** 6, last + 1)):
+        window = reader.window(t0, t1)
+        selected = (timestamp >= t0) & (timestamp < t1)
+        assert sorted(window) == sorted(full)
+        for key in full:
+            np.testing.assert_array_equal(window[key], full[key][selected], err_msg=key)
+
+
+def test_window_matches_a_full_decode(tmp_path):
+    filename = str(tmp_path / 'data.ptu')
+    records = _records(20000)
+    _write(filename, records)
+    reader = PTUReader(filename, index_stride=INDEX_STRIDE)
+    assert len(reader) == records.shape[0]
+    assert reader.n_blocks() == -(-records.shape[0] // INDEX_STRIDE)
+    _check_windows(reader, records)
+    decoded = list(reader.iter_decode(chunk_records=3000))
+    np.testing.assert_array_equal(np.concatenate([chunk['timestamp'] for chunk in decoded]),
+                                  decode_records(records, rtHydraHarp2T3, GLOBAL_RESOLUTION,
+                                                 RESOLUTION)['timestamp'])
+    np.testing.assert_array_equal(open_time_tags(filename)['records'], records)
+
+
+def test_index_is_saved_and_reused(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'data.ptu')
+    records = _records(20000)
+    _write(filename, records)
+    PTUReader(filename, index_stride=INDEX_STRIDE)
+    assert os.path.exists(filename + '.index.npz')
+
+    def no_decoder(reader):
+        raise AssertionError('the index was rebuilt')
+    with monkeypatch.context() as patch:
+        patch.setattr(PTUReader, '_decoder', no_decoder)
+        reader = PTUReader(filename, index_stride=INDEX_STRIDE)
+    _check_windows(reader, records)
+    # another stride is indexed again
+    reader = PTUReader(filename, index_stride=INDEX_STRIDE * 2)
+    assert reader.n_blocks() == -(-records.shape[0] // (INDEX_STRIDE * 2))
+    # kept in memory only
+    os.remove(filename + '.index.npz')
+    PTUReader(filename, index_stride=INDEX_STRIDE, index_file=False)
+    assert not os.path.exists(filename + '.index.npz')
+
+
+def test_appended_records_are_indexed(tmp_path):
+    filename = str(tmp_path / 'data.ptu')
+    records = _records(20500)
+    _write(filename, records[:10500])
+    reader = PTUReader(filename, index_stride=INDEX_STRIDE)
+    assert len(reader) == 10500
+    with open(filename, 'ab') as file:
+        file.write(records[10500:].tobytes())
+    reader.refresh()
+    assert len(reader) == records.shape[0]
+    _check_windows(reader, records)
+    # and by a new reader, from the saved index
+    _check_windows(PTUReader(filename, index_stride=INDEX_STRIDE), records)
+
+
+def test_replaced_file_is_indexed_again(tmp_path):
+    filename = str(tmp_path / 'data.ptu')
+    _write(filename, _records(20000))
+    PTUReader(filename, index_stride=INDEX_STRIDE)
+    # other records, the first block and the last record differ
+    records = _records(20000, seed=1)
+    _write(filename, records)
+    _check_windows(PTUReader(filename, index_stride=INDEX_STRIDE), records)
+
+
+@pytest.mark.skipif(zstandard is None, reason='zstandard is not installed')
+def test_seekable_zstd_file(tmp_path):
+    filename = str(tmp_path / 'data.ptu.zst')
+    records = _records(20000)
+    _write(filename, records, seekable=True, frame_size=4096)
+    reader = PTUReader(filename, index_stride=INDEX_STRIDE)
+    assert reader.records.random_access
+    _check_windows(reader, records)
@@ -0,0 +1,113 @@
+'''
+Check the split and merge of ptu_split_merge.py: the pieces of a split hold the records of each time
+slice, merging them back gives the photons of the file with continuous timestamps, and merged files
+are checked for the same record type.
+
+Usage:
+python -m pytest test_ptu_split_merge.py
+'''
+
+import gzip
+import math
+import os
+import numpy as np
+import pytest
+from tttr_mode_to_ptu import assemble_ptu, read_ptuheader, rtPicoHarpT2, rtHydraHarp2T3
+from tttr_decoder import decode_records
+from synthetic_tttr import synthetic_records
+from ptu_reader import open_time_tags
+from ptu_split_merge import split_ptu, merge_ptu, overflow_period
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+HEADERS = {rtPicoHarpT2: os.path.join(PACKAGE_DIR, 'picoharp_ptu_header_parameter.npz'),
+           rtHydraHarp2T3: os.path.join(PACKAGE_DIR, 'hydraharp_ptu_header_parameter.npz')}
+RESOLUTIONS = {rtPicoHarpT2: (4e-12, None), rtHydraHarp2T3: (25e-9, 8e-12)}
+DURATION_MS = 50
+# Small chunks, so that the cuts fall in several chunks
+CHUNK_RECORDS = 1000
+
+
+def _write(filename, rec_type, seed=0):
+    global_resolution, resolution = RESOLUTIONS[rec_type]
+    summary = {}
+    records = np.concatenate(list(synthetic_records(20000, rec_type, count_rate=1e5, seed=seed, summary=summary,
+                                                    global_resolution=global_resolution,
+                                                    resolution=resolution)))
+    ptu = assemble_ptu(records, header=HEADERS[rec_type], global_resolution=global_resolution,
+                       resolution=resolution, acquisition_time_ms=int(math.ceil(summary['last_time'] * 1e3)))
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'wb') as file:
+        file.write(ptu)
+    return records
+
+
+def _decode(filename):
+    source = open_time_tags(filename)
+    return decode_records(source['records'][:], source['rec_type'], source['global_resolution'],
+                          source['resolution'])
+
+
+@pytest.mark.parametrize('rec_type', [rtPicoHarpT2, rtHydraHarp2T3])
+@pytest.mark.parametrize('extension', ['.ptu', '.ptu.gz'])
+def test_split_then_merge(tmp_path, rec_type, extension):
+    filename = str(tmp_path / ('data' + extension))
+    records = _write(filename, rec_type)
+    full = _decode(filename)
+    pieces = split_ptu(filename, DURATION_MS, chunk_records=CHUNK_RECORDS)
+    assert pieces[0] == str(tmp_path / 'data_0000.ptu')
+    duration_ps = DURATION_MS * 10 ** 9
+    assert len(pieces) == int(full['timestamp'][-1] // duration_ps) + 1
+    # the pieces hold all the records, in order
+    np.testing.assert_array_equal(np.concatenate([open_time_tags(piece)['records'] for piece in pieces]),
+                                  records)
+    for k, piece in enumerate(pieces):
+        tags, header_end = read_ptuheader(piece, isprint=False)
+        assert tags['TTResult_NumberOfRecords'] == open_time_tags(piece)['records'].shape[0]
+        assert tags['MeasDesc_AcquisitionTime'] <= DURATION_MS
+        in_slice = (full['timestamp'] >= k * duration_ps) & (full['timestamp'] < (k + 1) * duration_ps)
+        np.testing.assert_array_equal(_decode(piece)['channel'], full['channel'][in_slice])
+    merged = str(tmp_path / 'merged.ptu')
+    n_records = merge_ptu(pieces, merged, chunk_records=CHUNK_RECORDS)
+    tags, header_end = read_ptuheader(merged, isprint=False)
+    assert tags['TTResult_NumberOfRecords'] == n_records == open_time_tags(merged)['records'].shape[0]
+    decoded = _decode(merged)
+    for key in ('channel', 'marker') + (('dtime',) if 'dtime' in full else ()):
+        np.testing.assert_array_equal(decoded[key], full[key])
+    # continuous time: each piece starts after the end of the previous one (the T3 timestamps add the dtime)
+    assert np.all(np.diff(decoded['nsync' if 'nsync' in decoded else 'timestamp']) >= 0)
+    assert decoded['timestamp'][-1] >= full['timestamp'][-1]
+
+
+def test_merged_files_follow_each_other(tmp_path):
+    first = str(tmp_path / 'first.ptu')
+    second = str(tmp_path / 'second.ptu')
+    _write(first, rtHydraHarp2T3)
+    _write(second, rtHydraHarp2T3, seed=1)
+    merged = str(tmp_path / 'merged.ptu')
+    merge_ptu([first, second], merged)
+    decoded = _decode(merged)
+    one = _decode(first)
+    two = _decode(second)
+    n = one['timestamp'].shape[0]
+    np.testing.assert_array_equal(decoded['timestamp'][:n], one['timestamp'])
+    # the second file starts at the first overflow boundary after the acquisition time of the first one
+    tags, header_end = read_ptuheader(first, isprint=False)
+    period_ps = overflow_period(rtHydraHarp2T3) * 25000
+    shift = decoded['timestamp'][n:] - two['timestamp']
+    assert np.all(shift == shift[0])
+    assert shift[0] % period_ps == 0
+    assert tags['MeasDesc_AcquisitionTime'] * 10 ** 9 <= shift[0] < tags['MeasDesc_AcquisitionTime'] * 10 ** 9 \
+        + period_ps
+
+
+def test_merge_errors(tmp_path):
+    t2 = str(tmp_path / 't2.ptu')
+    t3 = str(tmp_path / 't3.ptu')
+    _write(t2, rtPicoHarpT2)
+    _write(t3, rtHydraHarp2T3)
+    with pytest.raises(ValueError, match='TTTRRecType'):
+        merge_ptu([t2, t3], str(tmp_path / 'merged.ptu'))
+    with pytest.raises(ValueError, match='compressed'):
+        merge_ptu([t2, t2], str(tmp_path / 'merged.ptu.gz'))
+    with pytest.raises(ValueError):
+        merge_ptu([], str(tmp_path / 'merged.ptu'))
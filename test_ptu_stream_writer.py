@@ -0,0 +1,127 @@
+'''
+Check the live acquisition writer of ptu_stream_writer.py: the records handed to PTUStreamWriter
+end up in the .ptu file in order, whatever the size of the writes, and the header is patched on close
+with values derived from the records. Also checks needs_repair and repair_ptu on a file left open.
+
+Usage:
+python -m pytest test_ptu_stream_writer.py
+'''
+
+import os
+import numpy as np
+import pytest
+from tttr_mode_to_ptu import read_ptuheader, patch_ptuheader, rtPicoHarpT2, rtHydraHarp2T3
+from tttr_decoder import decode_records
+from synthetic_tttr import synthetic_records
+from ptu_stream_writer import PTUStreamWriter, needs_repair, repair_ptu
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+PICOHARP_HEADER = os.path.join(PACKAGE_DIR, 'picoharp_ptu_header_parameter.npz')
+HYDRAHARP_HEADER = os.path.join(PACKAGE_DIR, 'hydraharp_ptu_header_parameter.npz')
+
+
+def _records(n_photons, rec_type, **kwargs):
+    return np.concatenate(list(synthetic_records(n_photons, rec_type, chunk_records=4096, **kwargs)))
+
+
+def _read(filename):
+    tags, header_end = read_ptuheader(filename, isprint=False)
+    return tags, np.fromfile(filename, dtype='<u4', offset=header_end)
+
+
+def _photon_rates(records, rec_type, global_resolution, resolution, acquisition_time_ms):
+    decoded = decode_records(records, rec_type, global_resolution, resolution)
+    channel = decoded['channel'][~decoded['marker']]
+    return {int(number): np.count_nonzero(channel == number) / (acquisition_time_ms / 1e3)
+            for number in np.unique(channel)}
+
+
+@pytest.mark.parametrize('buffer_size, n_buffers', [(4096, 2), (1 << 16, 1), (1 << 20, 3)])
+def test_writer_keeps_the_records_in_order(tmp_path, buffer_size, n_buffers):
+    records = _records(20000, rtPicoHarpT2, count_rate=2e6)
+    filename = str(tmp_path / 'live.ptu')
+    with PTUStreamWriter(filename, header=PICOHARP_HEADER, buffer_size=buffer_size,
+                         n_buffers=n_buffers) as writer:
+        # writes of random sizes, some larger than a buffer, from a buffer reused by the caller
+        bounds = np.sort(np.random.default_rng(0).integers(0, records.shape[0], 40))
+        reused = np.empty(records.shape[0], dtype=np.uint32)
+        for chunk in np.split(records, bounds):
+            reused[:chunk.shape[0]] = chunk
+            writer.write(reused[:chunk.shape[0]])
+    tags, written = _read(filename)
+    np.testing.assert_array_equal(written, records)
+    assert tags['TTResult_NumberOfRecords'] == records.shape[0]
+    assert not needs_repair(filename)
+
+
+def test_close_derives_the_rates(tmp_path):
+    records = _records(20000, rtPicoHarpT2, count_rate=2e6, n_channels=3)
+    filename = str(tmp_path / 'live.ptu')
+    with PTUStreamWriter(filename, header=PICOHARP_HEADER, buffer_size=8192) as writer:
+        writer.write(records)
+        writer.close(acquisition_time_ms=250)
+    tags, written = _read(filename)
+    rates = _photon_rates(records, rtPicoHarpT2, 4e-12, None, 250)
+    assert tags['MeasDesc_AcquisitionTime'] == 250
+    # channel 0 is the sync input in T2 mode, the PicoHarp has a single other input
+    assert tags['TTResult_SyncRate'] == int(round(rates[0]))
+    assert tags['TTResult_InputRate(0)'] == int(round(rates[1] + rates[2]))
+    other = str(tmp_path / 'given.ptu')
+    with PTUStreamWriter(other, header=PICOHARP_HEADER) as writer:
+        writer.write(records)
+        writer.close(acquisition_time_ms=250, counts0=12, counts1=34)
+    tags, written = _read(other)
+    assert (tags['TTResult_SyncRate'], tags['TTResult_InputRate(0)']) == (12, 34)
+
+
+def test_writer_resolutions(tmp_path):
+    global_resolution, resolution = 1 / 40e6, 4e-12
+    records = _records(5000, rtHydraHarp2T3, global_resolution=global_resolution, resolution=resolution)
+    filename = str(tmp_path / 'live.ptu')
+    with PTUStreamWriter(filename, header=HYDRAHARP_HEADER, global_resolution=global_resolution,
+                         resolution=resolution) as writer:
+        writer.write(records)
+        writer.close(acquisition_time_ms=100)
+    tags, written = _read(filename)
+    assert tags['MeasDesc_GlobalResolution'] == global_resolution
+    assert tags['MeasDesc_Resolution'] == resolution
+    # in T3 mode, the sync rate is the inverse of the sync period
+    assert tags['TTResult_SyncRate'] == 40000000
+    rates = _photon_rates(records, rtHydraHarp2T3, global_resolution, resolution, 100)
+    assert tags['TTResult_InputRate(0)'] == int(round(rates[0]))
+
+
+def test_write_after_close_and_odd_buffers(tmp_path):
+    filename = str(tmp_path / 'live.ptu')
+    with pytest.raises(ValueError):
+        PTUStreamWriter(filename, header=PICOHARP_HEADER, buffer_size=4098)
+    writer = PTUStreamWriter(filename, header=PICOHARP_HEADER)
+    with pytest.raises(ValueError):
+        writer.write(b'\x00' * 6)
+    writer.close()
+    with pytest.raises(ValueError):
+        writer.write(np.zeros(4, dtype=np.uint32))
+
+
+def test_repair_ptu(tmp_path):
+    records = _records(20000, rtPicoHarpT2, count_rate=2e6)
+    filename = str(tmp_path / 'crashed.ptu')
+    with PTUStreamWriter(filename, header=PICOHARP_HEADER) as writer:
+        writer.write(records)
+    # a crash during the acquisition: header left as written at the start, last record incomplete
+    patch_ptuheader(filename, acquisition_time_ms=0, total_records=0, counts0=0, counts1=0)
+    with open(filename, 'ab') as file:
+        file.write(b'\x01\x02')
+    assert needs_repair(filename)
+    assert repair_ptu(filename)
+    assert not needs_repair(filename)
+    assert not repair_ptu(filename)
+    tags, written = _read(filename)
+    np.testing.assert_array_equal(written, records)
+    decoded = decode_records(records, rtPicoHarpT2, 4e-12)
+    acquisition_time_ms = int(np.ceil(decoded['timestamp'].max() / 1e9))
+    assert tags['TTResult_NumberOfRecords'] == records.shape[0]
+    assert tags['MeasDesc_AcquisitionTime'] == acquisition_time_ms
+    rates = _photon_rates(records, rtPicoHarpT2, 4e-12, None, acquisition_time_ms)
+    assert tags['TTResult_SyncRate'] == int(round(rates[0]))
+    assert tags['TTResult_InputRate(0)'] == int(round(rates[1]))
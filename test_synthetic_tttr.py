@@ -0,0 +1,97 @@
+'''
+Check the synthetic data of synthetic_tttr.py against the decoder: the records decode to increasing
+times with the counts and the last time of the summary, the overflow density is the one asked for,
+the legacy headers describe their records, and the benchmark suite runs on them.
+
+Usage:
+python -m pytest test_synthetic_tttr.py
+'''
+
+import json
+import numpy as np
+import pytest
+from tttr_mode_to_ptu import (rtPicoHarpT2, rtPicoHarpT3, rtHydraHarpT2, rtHydraHarpT3,
+                              rtHydraHarp2T2, rtHydraHarp2T3)
+from tttr_decoder import decode_records, is_t3
+from legacy_header import read_legacy_header
+from ptu_split_merge import overflow_period
+from synthetic_tttr import synthetic_records, write_synthetic_stream, write_synthetic_legacy
+from tttr_benchmark import run_benchmarks, compare_benchmarks
+
+RECORD_TYPES = [rtPicoHarpT2, rtPicoHarpT3, rtHydraHarpT2, rtHydraHarpT3, rtHydraHarp2T2, rtHydraHarp2T3]
+
+
+def _decode(records, summary):
+    return decode_records(records, summary['rec_type'], summary['global_resolution'], summary['resolution'])
+
+
+@pytest.mark.parametrize('rec_type', RECORD_TYPES)
+def test_records_match_the_summary(rec_type):
+    summary = {}
+    records = np.concatenate(list(synthetic_records(10000, rec_type, count_rate=1e6, n_channels=3,
+                                                    chunk_records=3000, summary=summary)))
+    assert summary['num_records'] == records.shape[0]
+    summary['rec_type'] = rec_type
+    decoded = _decode(records, summary)
+    # photons only, on the channels 0 to 2 (1 to 3 for the PicoHarp T3 and the HydraHarp T2)
+    assert decoded['timestamp'].shape[0] == 10000 and not decoded['marker'].any()
+    first = 1 if rec_type in (rtPicoHarpT3, rtHydraHarpT2, rtHydraHarp2T2) else 0
+    np.testing.assert_array_equal(np.bincount(decoded['channel'], minlength=first + 3)[first:],
+                                  summary['channel_counts'])
+    ticks = decoded['nsync'] if is_t3(rec_type) else decoded['timestamp'] // int(
+        round(summary['global_resolution'] * 1e12))
+    assert np.all(np.diff(ticks) >= 0)
+    assert ticks[-1] * summary['global_resolution'] == pytest.approx(summary['last_time'])
+    # about 1e6 counts/s
+    assert summary['last_time'] == pytest.approx(1e-2, rel=0.1)
+
+
+@pytest.mark.parametrize('rec_type', [rtPicoHarpT2, rtHydraHarpT3, rtHydraHarp2T2])
+def test_overflow_density(rec_type):
+    summary = {}
+    records = np.concatenate(list(synthetic_records(20000, rec_type, overflow_density=0.5, summary=summary)))
+    # two photons per overflow period on average
+    periods = summary['last_time'] / (overflow_period(rec_type) * summary['global_resolution'])
+    assert periods == pytest.approx(10000, rel=0.05)
+    # one record per overflow, except for HydraHarp v2 records holding several overflows
+    if rec_type != rtHydraHarp2T2:
+        assert records.shape[0] - 20000 == pytest.approx(periods, abs=1)
+
+
+@pytest.mark.parametrize('fileformat, version', [('pt2', '2.0'), ('pt3', '2.0'), ('ht2', '1.0'), ('ht3', '2.0')])
+def test_legacy_file_describes_its_records(tmp_path, fileformat, version):
+    filename = str(tmp_path / ('synthetic.' + fileformat))
+    summary = write_synthetic_legacy(filename, 5000, fileformat, version, n_channels=2, count_rate=1e5)
+    legacy = read_legacy_header(filename)
+    assert legacy['records_offset'] == summary['records_offset']
+    assert legacy['num_records'] == summary['num_records']
+    assert legacy['global_resolution'] == pytest.approx(summary['global_resolution'])
+    records = np.fromfile(filename, dtype='<u4', offset=legacy['records_offset'])
+    assert records.shape[0] == summary['num_records']
+    decoded = decode_records(records, legacy['rec_type'], legacy['global_resolution'], legacy['resolution'])
+    assert decoded['timestamp'].shape[0] == 5000
+
+
+def test_stream(tmp_path):
+    filename = str(tmp_path / 'stream.bin')
+    summary = write_synthetic_stream(filename, 5000, rtHydraHarp2T3, seed=3)
+    records = np.concatenate(list(synthetic_records(5000, rtHydraHarp2T3, seed=3)))
+    np.testing.assert_array_equal(np.fromfile(filename, dtype='<u4'), records)
+    assert summary['num_records'] == records.shape[0]
+    with pytest.raises(ValueError):
+        write_synthetic_stream(filename, 10, rtPicoHarpT2, n_channels=5)
+
+
+def test_benchmark_suite(tmp_path):
+    output = str(tmp_path / 'results.json')
+    report = run_benchmarks(n_photons=20000, stages=['read_ptuheader', 'decode'], repeat=1, header_ops=10,
+                            workdir=str(tmp_path), output=output)
+    with open(output) as file:
+        assert json.load(file)['stages'].keys() == {'read_ptuheader', 'decode'}
+    decode = report['stages']['decode']
+    # the overflow records included
+    assert decode['records'] > 20000 and decode['records_per_s'] > 0
+    assert report['stages']['read_ptuheader']['header_ops_per_s'] > 0
+    assert compare_benchmarks(report, output)['decode']['records_per_s'] == pytest.approx(1)
+    with pytest.raises(ValueError, match='Unknown stage'):
+        run_benchmarks(stages=['missing'], output=None)
@@ -0,0 +1,110 @@
+'''
+Check the streaming analyses of tttr_analysis.py against brute-force results computed from all the
+decoded photons at once: the TCSPC histogram against a bincount of the dtime, the multi-tau g(2) against
+the differences of bin numbers of all the pairs of photons.
+
+Usage:
+python -m pytest test_tttr_analysis.py
+'''
+
+import numpy as np
+import pytest
+from ptu_reader import open_time_tags
+from synthetic_tttr import write_synthetic_legacy
+from tttr_decoder import decode_records
+from tttr_analysis import DtimeHistogram, MultiTauCorrelator, analyse_file, tcspc_histogram
+
+N_PHOTONS = 3000
+# Small chunks, so that the pairs across chunks are counted from the carried photons
+CHUNK_RECORDS = 256
+CORRELATOR = {'bin_width': 1e-9, 'n_levels': 12, 'points_per_level': 4}
+
+
+def _photons(filename):
+    source = open_time_tags(filename)
+    decoded = decode_records(np.asarray(source['records']), source['rec_type'], source['global_resolution'],
+                             source['resolution'])
+    photons = ~decoded['marker']
+    return source, {key: value[photons] for key, value in decoded.items()}
+
+
+def brute_force_counts(timestamp, channel, channel_a, channel_b, lag, bin_width):
+    '''
+    Number of pairs of photons (channel_a, channel_b) at each lag of MultiTauCorrelator.result:
+    the bin of the photon of channel_b minus the bin of the photon of channel_a is lag / bin_width.
+    '''
+    times_a = timestamp[channel == channel_a]
+    times_b = timestamp[channel == channel_b]
+    counts = np.zeros(lag.shape[0])
+    for width in np.unique(bin_width):
+        distance = times_b[None, :] // width - times_a[:, None] // width
+        if channel_a == channel_b:
+            # a photon is not paired with itself
+            np.fill_diagonal(distance, np.iinfo(np.int64).min)
+        at_width = bin_width == width
+        values, n_pairs = np.unique(distance, return_counts=True)
+        position = np.searchsorted(values, lag[at_width] // width)
+        found = values[np.minimum(position, values.shape[0] - 1)] == lag[at_width] // width
+        counts[at_width] = np.where(found, n_pairs[np.minimum(position, values.shape[0] - 1)], 0)
+    return counts
+
+
+@pytest.mark.parametrize('fileformat, count_rate, channels', [('ht2', 2e7, (1, 2)), ('ht2', 2e7, (2, 2)),
+                                                                ('pt3', 5e6, (1, 2)), ('ht3', 5e6, (0, 0))])
+def test_correlation_matches_brute_force(tmp_path, fileformat, count_rate, channels):
+    filename = str(tmp_path / 'synthetic.{0}'.format(fileformat))
+    write_synthetic_legacy(filename, N_PHOTONS, fileformat, count_rate=count_rate)
+    source, photons = _photons(filename)
+    correlator = MultiTauCorrelator(*channels, **CORRELATOR)
+    result = analyse_file(filename, correlator, chunk_records=CHUNK_RECORDS).result()
+    expected = brute_force_counts(photons['timestamp'], photons['channel'], *channels, result['lag'],
+                                  result['bin_width'])
+    assert expected.sum() > 0
+    np.testing.assert_array_equal(result['counts'], expected)
+    assert correlator.n_a == np.count_nonzero(photons['channel'] == channels[0])
+    assert correlator.n_b == np.count_nonzero(photons['channel'] == channels[1])
+
+
+def test_merged_segments_match_single_pass():
+    timestamp = np.sort(np.random.default_rng(1).integers(0, 10 ** 8, 4000))
+    channel = np.random.default_rng(2).integers(0, 2, 4000).astype(np.uint8)
+    decoded = {'timestamp': timestamp, 'channel': channel, 'marker': np.zeros(4000, dtype=bool)}
+    single = MultiTauCorrelator(0, 1, **CORRELATOR)
+    single.update(decoded)
+    first = MultiTauCorrelator(0, 1, **CORRELATOR)
+    second = MultiTauCorrelator(0, 1, **CORRELATOR)
+    first.update({key: value[:2500] for key, value in decoded.items()})
+    # the second segment is primed with the photons just before its start
+    second.update({key: value[:2500] for key, value in decoded.items()}, count=False)
+    second.update({key: value[2500:] for key, value in decoded.items()})
+    merged = first.merge(second).result()
+    np.testing.assert_array_equal(merged['counts'], single.result()['counts'])
+    np.testing.assert_array_equal(merged['g2'], single.result()['g2'])
+
+
+@pytest.mark.parametrize('fileformat', ['pt3', 'ht3'])
+def test_histogram_matches_bincount(tmp_path, fileformat):
+    filename = str(tmp_path / 'synthetic.{0}'.format(fileformat))
+    write_synthetic_legacy(filename, N_PHOTONS, fileformat, n_channels=3)
+    source, photons = _photons(filename)
+    result = tcspc_histogram(filename, chunk_records=CHUNK_RECORDS)
+    n_bins = result['counts'].shape[1]
+    assert n_bins == (1 << 12 if fileformat == 'pt3' else 1 << 15)
+    expected = np.zeros_like(result['counts'])
+    np.add.at(expected, (photons['channel'].astype(np.intp), photons['dtime'].astype(np.intp)), 1)
+    np.testing.assert_array_equal(result['counts'], expected)
+    np.testing.assert_allclose(result['dtime'][1], source['resolution'] * 1e12)
+
+
+def test_histogram_merge():
+    decoded = {'channel': np.array([0, 1, 1, 2], dtype=np.uint8), 'dtime': np.array([3, 0, 0, 7]),
+               'marker': np.array([False, False, False, True])}
+    first = DtimeHistogram(8)
+    first.update({key: value[:1] for key, value in decoded.items()})
+    second = DtimeHistogram(8)
+    second.update(decoded)
+    merged = first.merge(second).counts
+    assert merged.shape == (2, 8)
+    assert merged[0, 3] == 2 and merged[1, 0] == 2 and merged.sum() == 4
+    with pytest.raises(ValueError):
+        first.merge(DtimeHistogram(16))
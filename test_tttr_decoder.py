@@ -0,0 +1,91 @@
+'''
+Check the vectorized decoder of tttr_decoder.py against the scalar reference decode_records_scalar for
+each record type: the whole buffer at once, chunk by chunk with iter_decode, and the channel counts of
+count_channels.
+
+Usage:
+python -m pytest test_tttr_decoder.py
+'''
+
+import numpy as np
+import pytest
+from tttr_mode_to_ptu import (rtPicoHarpT2, rtPicoHarpT3, rtHydraHarpT2, rtHydraHarpT3,
+                              rtHydraHarp2T2, rtHydraHarp2T3)
+from tttr_decoder import (TTTRDecoder, decode_records, iter_decode, decode_records_scalar, random_records,
+                          is_t3)
+from synthetic_tttr import synthetic_records
+
+RECORD_TYPES = [rtPicoHarpT2, rtPicoHarpT3, rtHydraHarpT2, rtHydraHarpT3, rtHydraHarp2T2, rtHydraHarp2T3]
+# Random records hold any special record (markers, overflows of any count), few enough not to overflow
+# the int64 timestamps
+N_RANDOM = 3000
+
+
+def _resolutions(rec_type):
+    # a time tag unit that is not a whole number of ps, to check the rounding
+    return (25e-9, 8e-12) if is_t3(rec_type) else (4e-12 if rec_type == rtPicoHarpT2 else 1.5e-12, None)
+
+
+def _assert_same(decoded, expected):
+    assert sorted(decoded) == sorted(expected)
+    for key in expected:
+        np.testing.assert_array_equal(decoded[key], expected[key], err_msg=key)
+        assert decoded[key].dtype == expected[key].dtype, key
+
+
+def _records(rec_type):
+    random = random_records(N_RANDOM, rec_type, overflow_fraction=0.05, seed=rec_type & 0xFFFF)
+    synthetic = np.concatenate(list(synthetic_records(5000, rec_type, n_channels=3, overflow_density=0.1,
+                                                      chunk_records=1000, seed=1)))
+    return {'random': random, 'synthetic': synthetic}
+
+
+@pytest.mark.parametrize('rec_type', RECORD_TYPES)
+def test_decoder_matches_the_scalar_decoder(rec_type):
+    global_resolution, resolution = _resolutions(rec_type)
+    for name, records in _records(rec_type).items():
+        expected = decode_records_scalar(records, rec_type, global_resolution, resolution)
+        assert expected['timestamp'].shape[0] > 0, name
+        _assert_same(decode_records(records, rec_type, global_resolution, resolution), expected)
+        # chunks not aligned on the overflow records
+        chunks = list(iter_decode(records, rec_type, global_resolution, resolution, chunk_records=333))
+        assert len(chunks) == -(-records.shape[0] // 333)
+        _assert_same({key: np.concatenate([chunk[key] for chunk in chunks]) for key in expected}, expected)
+        # from the bytes of a file
+        _assert_same(decode_records(records.astype('<u4').tobytes(), rec_type, global_resolution, resolution),
+                     expected)
+
+
+@pytest.mark.parametrize('rec_type', RECORD_TYPES)
+def test_count_channels(rec_type):
+    global_resolution, resolution = _resolutions(rec_type)
+    for name, records in _records(rec_type).items():
+        expected = decode_records_scalar(records, rec_type, global_resolution, resolution)
+        photons = expected['channel'][~expected['marker']]
+        counter = TTTRDecoder(rec_type, global_resolution, resolution)
+        decoder = TTTRDecoder(rec_type, global_resolution, resolution)
+        counts = np.zeros(256, dtype=np.int64)
+        n_events = 0
+        for start in range(0, records.shape[0], 700):
+            chunk_counts, chunk_events = counter.count_channels(records[start:start + 700])
+            counts += chunk_counts
+            n_events += chunk_events
+            decoder.decode(records[start:start + 700])
+            # same overflow correction carried to the next chunk
+            assert counter.oflcorrection == decoder.oflcorrection
+        np.testing.assert_array_equal(counts, np.bincount(photons, minlength=256), err_msg=name)
+        assert n_events == expected['timestamp'].shape[0]
+
+
+def test_return_index():
+    records = random_records(N_RANDOM, rtHydraHarp2T3, overflow_fraction=0.05)
+    decoded = TTTRDecoder(rtHydraHarp2T3, 25e-9, 8e-12, return_index=True).decode(records)
+    expected = decode_records_scalar(records, rtHydraHarp2T3, 25e-9, 8e-12)
+    _assert_same({key: value for key, value in decoded.items() if key != 'index'}, expected)
+    # the records at the returned positions hold the nsync of the events
+    np.testing.assert_array_equal(records[decoded['index']] & 0x3FF, expected['nsync'] % 1024)
+
+
+def test_t3_requires_the_resolution():
+    with pytest.raises(ValueError, match='resolution'):
+        TTTRDecoder(rtPicoHarpT3, 1e-7)
@@ -0,0 +1,111 @@
+'''
+Check the header templates of tttr_mode_to_ptu.py: the header written from a compiled template holds the
+values given, in the file, in memory and when patched in place, and the templates are cached until
+their .npz file changes.
+
+Usage:
+python -m pytest test_tttr_mode_to_ptu.py
+'''
+
+import os
+import shutil
+import numpy as np
+import pytest
+from tttr_mode_to_ptu import (load_header_template, write_ptuheader, encode_ptuheader, read_ptuheader,
+                              patch_ptuheader, assemble_ptu, ptu_size, decode_ptu, combine_time_tags_header,
+                              tdatetime_to_timestamp, rtHydraHarpT3)
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+PICOHARP_HEADER = os.path.join(PACKAGE_DIR, 'picoharp_ptu_header_parameter.npz')
+HYDRAHARP_HEADER = os.path.join(PACKAGE_DIR, 'hydraharp_ptu_header_parameter.npz')
+VALUES = {'acquisition_time_ms': 1234, 'total_records': 5678, 'timestamp': 1.7e9, 'counts0': 11,
+          'counts1': 22, 'global_resolution': 5e-12, 'resolution': 7e-12}
+
+
+def _check_tags(tags, counts1=(22,)):
+    assert tags['MeasDesc_AcquisitionTime'] == 1234
+    assert tags['TTResult_StopAfter'] == 1234
+    assert tags['TTResult_NumberOfRecords'] == 5678
+    assert tags['TTResult_SyncRate'] == 11
+    assert [tags['TTResult_InputRate({0})'.format(j)] for j in range(len(counts1))] == list(counts1)
+    assert tags['MeasDesc_GlobalResolution'] == 5e-12
+    assert tags['MeasDesc_Resolution'] == 7e-12
+    assert tdatetime_to_timestamp(tags['File_CreatingTime']) == pytest.approx(1.7e9, abs=1e-3)
+
+
+def test_written_header_holds_the_values(tmp_path):
+    filename = str(tmp_path / 'header.ptu')
+    write_ptuheader(filename, header=PICOHARP_HEADER, **VALUES)
+    tags, header_end = read_ptuheader(filename, isprint=False)
+    _check_tags(tags)
+    assert header_end == os.path.getsize(filename) == len(load_header_template(PICOHARP_HEADER).buffer)
+    # same bytes in memory
+    with open(filename, 'rb') as file:
+        assert encode_ptuheader(header=PICOHARP_HEADER, **VALUES) == file.read()
+    # the other tags are the ones of the template
+    template = load_header_template(PICOHARP_HEADER)
+    assert tags['TTResultFormat_TTTRRecType'] == template.tags['TTResultFormat_TTTRRecType']
+
+
+def test_input_rate_of_each_channel(tmp_path):
+    header = encode_ptuheader(header=HYDRAHARP_HEADER, **dict(VALUES, counts1=[1, 2, 3, 4]))
+    tags, records = decode_ptu(header)
+    _check_tags(tags, counts1=(1, 2, 3, 4))
+    # a single value is written to every channel
+    tags, records = decode_ptu(encode_ptuheader(header=HYDRAHARP_HEADER, **VALUES))
+    _check_tags(tags, counts1=(22, 22, 22, 22))
+
+
+def test_patch_in_place(tmp_path):
+    filename = str(tmp_path / 'header.ptu')
+    records = np.arange(100, dtype='<u4')
+    write_ptuheader(filename, header=PICOHARP_HEADER, timestamp=1.7e9)
+    with open(filename, 'ab') as file:
+        file.write(records.tobytes())
+    patch_ptuheader(filename, **{key: value for key, value in VALUES.items() if key != 'timestamp'})
+    tags, header_end = read_ptuheader(filename, isprint=False)
+    _check_tags(tags)
+    np.testing.assert_array_equal(np.fromfile(filename, dtype='<u4', offset=header_end), records)
+
+
+def test_assemble_and_combine(tmp_path):
+    records = np.arange(1000, dtype='<u4')
+    ptu = assemble_ptu(records, header=PICOHARP_HEADER, **dict(VALUES, total_records=None))
+    assert len(ptu) == ptu_size(records, PICOHARP_HEADER)
+    tags, decoded = decode_ptu(ptu)
+    assert tags['TTResult_NumberOfRecords'] == 1000
+    np.testing.assert_array_equal(decoded, records)
+    out = bytearray(len(ptu) + 10)
+    assert assemble_ptu(records, header=PICOHARP_HEADER, out=out, **dict(VALUES, total_records=None)) == len(ptu)
+    assert out[:len(ptu)] == ptu
+    headerfile = str(tmp_path / 'header.ptu')
+    timetags = str(tmp_path / 'timetags.bin')
+    outputfile = str(tmp_path / 'combined.ptu')
+    write_ptuheader(headerfile, header=PICOHARP_HEADER, **dict(VALUES, total_records=1000))
+    records.tofile(timetags)
+    combine_time_tags_header(headerfile, timetags, outputfile)
+    with open(outputfile, 'rb') as file:
+        assert file.read() == bytes(ptu)
+
+
+def test_template_cache(tmp_path):
+    header = str(tmp_path / 'header.npz')
+    shutil.copy(PICOHARP_HEADER, header)
+    template = load_header_template(header)
+    assert load_header_template(header) is template
+    # reloaded once the file changes
+    stat = os.stat(header)
+    os.utime(header, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert load_header_template(header) is not template
+    assert load_header_template(template) is template
+
+
+def test_with_record_type():
+    template = load_header_template(HYDRAHARP_HEADER)
+    other = template.with_record_type(rtHydraHarpT3)
+    tags, records = decode_ptu(other.render(acquisition_time_ms=1))
+    assert tags['TTResultFormat_TTTRRecType'] == rtHydraHarpT3 == other.tags['TTResultFormat_TTTRRecType']
+    assert tags['Measurement_Mode'] == 3
+    # the template itself is not modified
+    assert decode_ptu(template.render())[0]['TTResultFormat_TTTRRecType'] == \
+        template.tags['TTResultFormat_TTTRRecType'] != rtHydraHarpT3
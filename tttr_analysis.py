@@ -0,0 +1,455 @@
+'''
+This script includes streaming analyses of .ptu files: the TCSPC histogram of the dtime (T3 mode)
+and the multi-tau g(2) correlation between two channels (T2 or T3 mode).
+The records are decoded chunk by chunk (see tttr_decoder.py) and each chunk is added to the result
+with vectorized operations, so a file is analysed in constant memory at the speed of the decoder.
+
+The results are mergeable: a file can be cut into segments analysed in parallel by worker processes,
+and the partial results added with merge. The segments start at blocks of the time index
+of ptu_reader.PTUReader, and the correlation of a segment also reads the photons just before
+its start, so the merged result is the same as the one of a single pass.
+
+The correlation follows the multi-tau algorithm for time tags of
+Wahl et al., Optics Express 11, 3583 (2003): at level k, the timestamps are counted in bins of
+bin_width * 2^k and the pairs of photons at a distance of points_per_level to 2 * points_per_level
+bins are counted (0 to 2 * points_per_level at level 0). The photons further than
+2 * points_per_level bins from all the photons of the other channel are left out of a level,
+and the levels where most bins hold photons are counted from dense arrays of bins.
+'''
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from tttr_mode_to_ptu import rtPicoHarpT3
+from tttr_decoder import TTTRDecoder, is_t3, DECODE_CHUNK_RECORDS
+from ptu_reader import PTUReader, open_time_tags
+from instrumentation import add_environment_hook
+
+# Pairs are counted from dense arrays of bins when there are at most this many bins per photon
+DENSE_BINS_FACTOR = 4
+
+
+def _merge_bins(times, old):
+    '''
+    Bins of the sorted array of bin numbers times: (bin numbers, number of photons,
+    number of old photons, i.e. photons flagged in old).
+    '''
+    if times.shape[0] == 0:
+        return times, old, old
+    starts = np.flatnonzero(np.concatenate(([True], times[1:] != times[:-1])))
+    if starts.shape[0] == times.shape[0]:
+        return times, np.ones(times.shape[0], dtype=np.int64), old
+    weight = np.diff(starts, append=times.shape[0])
+    old_weight = np.add.reduceat(old, starts) if old.any() else np.zeros(starts.shape[0], dtype=np.int64)
+    return times[starts], weight, old_weight
+
+
+def _pair_counts(times_a, weight_a, old_a, times_b, weight_b, old_b, max_lag):
+    '''
+    Number of pairs with times_b - times_a = -max_lag, ..., max_lag (sorted bins with their weights),
+    excluding the pairs between two old photons (already counted with the previous chunk).
+    '''
+    counts = np.zeros(2 * max_lag + 1)
+    if times_a.shape[0] == 0 or times_b.shape[0] == 0:
+        return counts
+    origin = min(times_a[0], times_b[0])
+    span = int(max(times_a[-1], times_b[-1]) - origin) + 1
+    if span <= DENSE_BINS_FACTOR * (times_a.shape[0] + times_b.shape[0]):
+        return _dense_pair_counts(times_a - origin, weight_a, old_a, times_b - origin, weight_b, old_b,
+                                  max_lag, span)
+    lo = np.searchsorted(times_b, times_a - max_lag, side="left")
+    hi = np.searchsorted(times_b, times_a + max_lag, side="right")
+    n_pairs = hi - lo
+    total = int(n_pairs.sum())
+    if total == 0:
+        return counts
+    index_a = np.repeat(np.arange(times_a.shape[0]), n_pairs)
+    index_b = np.arange(total) - np.repeat(np.cumsum(n_pairs) - n_pairs - lo, n_pairs)
+    weight = (weight_a[index_a] * weight_b[index_b]
+              - old_a[index_a] * old_b[index_b]).astype(np.float64)
+    return np.bincount(times_b[index_b] - times_a[index_a] + max_lag, weights=weight,
+                       minlength=2 * max_lag + 1)
+
+
+def _nearest(times, other):
+    '''
+    Distance from each value of the sorted array times to the closest value of the sorted array other.
+    '''
+    nearest = np.full(times.shape[0], np.iinfo(np.int64).max)
+    if other.shape[0] == 0:
+        return nearest
+    position = np.searchsorted(other, times)
+    after = position < other.shape[0]
+    nearest[after] = other[position[after]] - times[after]
+    before = position > 0
+    nearest[before] = np.minimum(nearest[before], times[before] - other[position[before] - 1])
+    return nearest
+
+
+def _nearest_other(times):
+    '''
+    Distance from each value of the sorted array times to the closest other value.
+    '''
+    nearest = np.full(times.shape[0], np.iinfo(np.int64).max)
+    gap = np.diff(times)
+    nearest[1:] = gap
+    nearest[:-1] = np.minimum(nearest[:-1], gap)
+    return nearest
+
+
+def _correlate_bins(a, b, max_lag):
+    '''
+    sum(a[i] * b[i + lag]) for lag = -max_lag, ..., max_lag (arrays of the weights of consecutive bins).
+    '''
+    padded = np.zeros(b.shape[0] + 2 * max_lag)
+    padded[max_lag:max_lag + b.shape[0]] = b
+    return np.correlate(padded, a, "valid")
+
+
+def _dense_pair_counts(times_a, weight_a, old_a, times_b, weight_b, old_b, max_lag, span):
+    '''
+    Same as _pair_counts, from the weights of all the bins from 0 to span - 1
+    (faster when most bins hold photons).
+    '''
+    a = np.zeros(span)
+    a[times_a] = weight_a
+    b = np.zeros(span)
+    b[times_b] = weight_b
+    counts = _correlate_bins(a, b, max_lag)
+    if old_a.any() and old_b.any():
+        # the old photons only cover the start of the bins
+        old_span = int(max(times_a[old_a > 0][-1], times_b[old_b > 0][-1])) + 1
+        a = np.zeros(old_span)
+        a[times_a[times_a < old_span]] = old_a[times_a < old_span]
+        b = np.zeros(old_span)
+        b[times_b[times_b < old_span]] = old_b[times_b < old_span]
+        counts -= _correlate_bins(a, b, max_lag)
+    return counts
+
+
+class DtimeHistogram:
+    '''
+    Input:
+    1. n_bins: default: 32768. Number of dtime bins (4096 for the PicoHarp, 32768 for the other devices).
+    2. resolution: default: None. Width of a dtime bin (s), MeasDesc_Resolution in the ptu header.
+
+    Attributes:
+    counts: number of photons (markers excluded) of each channel (rows) in each dtime bin (columns),
+    as int64. The channels are numbered as by the decoder.
+    '''
+
+    def __init__(self, n_bins=1 << 15, resolution=None):
+        self.n_bins = n_bins
+        self.resolution = resolution
+        self.counts = np.zeros((0, n_bins), dtype=np.int64)
+
+    def update(self, decoded, count=True):
+        '''
+        Add the photons of a chunk decoded by tttr_decoder.TTTRDecoder (T3 mode).
+        Nothing is done if count is False (chunks only read to prime the correlations).
+        '''
+        if not count:
+            return
+        photons = ~decoded["marker"]
+        channel = decoded["channel"][photons].astype(np.intp)
+        if channel.shape[0] == 0:
+            return
+        n_channels = max(int(channel.max()) + 1, self.counts.shape[0])
+        if n_channels > self.counts.shape[0]:
+            counts = np.zeros((n_channels, self.n_bins), dtype=np.int64)
+            counts[:self.counts.shape[0]] = self.counts
+            self.counts = counts
+        index = channel * self.n_bins + decoded["dtime"][photons]
+        self.counts += np.bincount(index, minlength=n_channels * self.n_bins).reshape(
+            n_channels, self.n_bins)
+
+    def merge(self, other):
+        '''
+        Add the counts of another DtimeHistogram (e.g. of another segment of the file). Returns self.
+        '''
+        if other.n_bins != self.n_bins:
+            raise ValueError("Cannot merge histograms with different numbers of bins")
+        if other.counts.shape[0] > self.counts.shape[0]:
+            self.counts, other_counts = other.counts.copy(), self.counts
+        else:
+            other_counts = other.counts
+        self.counts[:other_counts.shape[0]] += other_counts
+        return self
+
+    def result(self):
+        '''
+        dict with dtime (start of each bin, ps, or bin number if the resolution is not known)
+        and counts (channels x bins).
+        '''
+        dtime = np.arange(self.n_bins, dtype=np.float64)
+        if self.resolution is not None:
+            dtime *= self.resolution * 1e12
+        return {"dtime": dtime, "counts": self.counts}
+
+
+class MultiTauCorrelator:
+    '''
+    Input:
+    1. channel_a, channel_b: channels correlated, as numbered by the decoder
+       (in T2 mode, HydraHarp and later devices number the inputs from 1, 0 being the sync).
+    2. bin_width: default: 1e-10. Width of the bins of the first level (s).
+    3. n_levels: default: 20. Number of levels, each one with bins twice as wide as the previous one.
+    4. points_per_level: default: 8. Number of lags per level (twice as many at the first level).
+
+    The largest lag is about 2 * points_per_level * 2^(n_levels - 1) * bin_width
+    (0.84 s with the default values). Positive lags are photons of channel_b after photons of channel_a.
+    '''
+
+    def __init__(self, channel_a, channel_b, bin_width=1e-10, n_levels=20, points_per_level=8):
+        self.channel_a = channel_a
+        self.channel_b = channel_b
+        self.bin_width_ps = int(round(bin_width * 1e12))
+        if self.bin_width_ps < 1:
+            raise ValueError("bin_width must be at least 1 ps")
+        self.n_levels = n_levels
+        self.points_per_level = points_per_level
+        m = points_per_level
+        self.counts_ab = [np.zeros(2 * m)] + [np.zeros(m) for level in range(1, n_levels)]
+        self.counts_ba = [np.zeros(2 * m)] + [np.zeros(m) for level in range(1, n_levels)]
+        self.n_a = 0
+        self.n_b = 0
+        self.t_first = None
+        self.t_last = None
+        # largest distance (ps) between two photons counted in a pair
+        self.max_lag_ps = (2 * m + 1) * self.bin_width_ps << (n_levels - 1)
+        self.carry_a = np.zeros(0, dtype=np.int64)
+        self.carry_b = np.zeros(0, dtype=np.int64)
+        # largest timestamp so far, and largest delay of a photon behind it
+        # (T3 mode: the photons are in the order of the syncs, not of the timestamps)
+        self.t_max = None
+        self.disorder = 0
+
+    def update(self, decoded, count=True):
+        '''
+        Add the photons of a chunk decoded by tttr_decoder.TTTRDecoder. The chunks must be given in order.
+        If count is False, the photons are only kept to be paired with the next chunks
+        (used to start a segment of a file in the middle, see the module docstring).
+        '''
+        photons = ~decoded["marker"]
+        timestamp = decoded["timestamp"][photons]
+        channel = decoded["channel"][photons]
+        if timestamp.shape[0] == 0:
+            return
+        running = np.maximum.accumulate(timestamp)
+        if self.t_max is not None:
+            running = np.maximum(running, self.t_max)
+        self.disorder = max(self.disorder, int((running - timestamp).max()))
+        self.t_max = int(running[-1])
+        new_a = timestamp[channel == self.channel_a]
+        if self.disorder:
+            new_a = np.sort(new_a)
+        if self.channel_b == self.channel_a:
+            new_b = new_a
+        else:
+            new_b = timestamp[channel == self.channel_b]
+            if self.disorder:
+                new_b = np.sort(new_b)
+        if count:
+            self.n_a += new_a.shape[0]
+            self.n_b += new_b.shape[0]
+            first, last = int(timestamp.min()), int(timestamp.max())
+            self.t_first = first if self.t_first is None else min(self.t_first, first)
+            self.t_last = last if self.t_last is None else max(self.t_last, last)
+            self._correlate(new_a, new_b)
+        # the next photons are at least at t_max - disorder
+        horizon = self.t_max - self.disorder - self.max_lag_ps
+        self.carry_a = self._carry(self.carry_a, new_a, horizon)
+        self.carry_b = self._carry(self.carry_b, new_b, horizon)
+
+    @staticmethod
+    def _carry(carry, new, horizon):
+        times = np.concatenate((carry, new))
+        if carry.shape[0] and new.shape[0] and carry[-1] > new[0]:
+            times.sort(kind="stable")
+        return times[np.searchsorted(times, horizon):]
+
+    @staticmethod
+    def _sorted(carry, new):
+        times = np.concatenate((carry, new))
+        old = np.zeros(times.shape[0], dtype=np.int64)
+        old[:carry.shape[0]] = 1
+        if carry.shape[0] and new.shape[0] and carry[-1] > new[0]:
+            order = np.argsort(times, kind="stable")
+            times, old = times[order], old[order]
+        return times, old
+
+    def _correlate(self, new_a, new_b):
+        m = self.points_per_level
+        times_a, old_a = self._sorted(self.carry_a, new_a)
+        if self.channel_a == self.channel_b:
+            times_b, old_b = times_a, old_a
+            nearest_a = nearest_b = _nearest_other(times_a)
+        else:
+            times_b, old_b = self._sorted(self.carry_b, new_b)
+            nearest_a = _nearest(times_a, times_b)
+            nearest_b = _nearest(times_b, times_a)
+        for level in range(self.n_levels):
+            width = self.bin_width_ps << level
+            # a photon further than 2 * m bins from all the photons of the other channel has no pair
+            active_a = nearest_a < 2 * m * width
+            active_b = nearest_b < 2 * m * width
+            bins_a = _merge_bins(times_a[active_a] // width, old_a[active_a])
+            bins_b = _merge_bins(times_b[active_b] // width, old_b[active_b])
+            # counts[2 * m - 1 + j]: pairs with a photon of channel_b j bins after one of channel_a
+            counts = _pair_counts(*bins_a, *bins_b, 2 * m - 1)
+            if level == 0:
+                self.counts_ab[0] += counts[2 * m - 1:]
+                self.counts_ba[0][1:] += counts[2 * m - 2::-1]
+                if self.channel_a == self.channel_b:
+                    # a photon is not paired with itself
+                    self.counts_ab[0][0] -= int((active_a & (old_a == 0)).sum())
+            else:
+                self.counts_ab[level] += counts[3 * m - 1:]
+                self.counts_ba[level] += counts[m - 1::-1]
+
+    def merge(self, other):
+        '''
+        Add the counts of another MultiTauCorrelator with the same parameters
+        (e.g. of another segment of the file). Returns self.
+        '''
+        if ((other.channel_a, other.channel_b, other.bin_width_ps, other.n_levels, other.points_per_level)
+                != (self.channel_a, self.channel_b, self.bin_width_ps, self.n_levels, self.points_per_level)):
+            raise ValueError("Cannot merge correlations with different parameters")
+        for level in range(self.n_levels):
+            self.counts_ab[level] += other.counts_ab[level]
+            self.counts_ba[level] += other.counts_ba[level]
+        self.n_a += other.n_a
+        self.n_b += other.n_b
+        if other.t_first is not None:
+            self.t_first = other.t_first if self.t_first is None else min(self.t_first, other.t_first)
+            self.t_last = other.t_last if self.t_last is None else max(self.t_last, other.t_last)
+        return self
+
+    def result(self):
+        '''
+        dict with:
+        lag: lags (ps), from the most negative to the most positive.
+        bin_width: width (ps) of the bins of the level of each lag.
+        counts: number of pairs of photons at each lag.
+        g2: normalized correlation, 1 for uncorrelated photons.
+        '''
+        m = self.points_per_level
+        lags, widths, counts = [], [], []
+        for level in range(self.n_levels):
+            width = self.bin_width_ps << level
+            first = 0 if level == 0 else m
+            j = np.arange(first, 2 * m)
+            lags.append(j * width)
+            widths.append(np.full(j.shape[0], width))
+            counts.append(self.counts_ab[level])
+        positive_lag = np.concatenate(lags)
+        positive_width = np.concatenate(widths)
+        positive = np.concatenate(counts)
+        negative = np.concatenate([self.counts_ba[0][1:]] + self.counts_ba[1:])
+        lag = np.concatenate((-positive_lag[1:][::-1], positive_lag))
+        bin_width = np.concatenate((positive_width[1:][::-1], positive_width))
+        counts = np.concatenate((negative[::-1], positive))
+        duration = 0 if self.t_first is None else self.t_last - self.t_first
+        with np.errstate(divide="ignore", invalid="ignore"):
+            overlap = np.maximum(duration - np.abs(lag), 0).astype(np.float64)
+            g2 = counts * float(duration) ** 2 / (float(self.n_a) * self.n_b * bin_width * overlap)
+        g2[~np.isfinite(g2)] = np.nan
+        return {"lag": lag, "bin_width": bin_width, "counts": counts, "g2": g2}
+
+
+def _analyse_segment(filename, analysis, prime_start, start, stop, oflcorrection, chunk_records):
+    '''
+    Add the records start to stop of a file to analysis, after priming it with the records
+    prime_start to start. The overflow correction at prime_start is oflcorrection.
+    '''
+    source = open_time_tags(filename)
+    decoder = TTTRDecoder(source["rec_type"], source["global_resolution"], source["resolution"])
+    decoder.reset(oflcorrection)
+    records = source["records"]
+    for first in range(prime_start, start, chunk_records):
+        analysis.update(decoder.decode(records[first:min(first + chunk_records, start)]), count=False)
+    for first in range(start, stop, chunk_records):
+        analysis.update(decoder.decode(records[first:min(first + chunk_records, stop)]))
+    return analysis
+
+
+def analyse_file(filename, analysis, jobs=1, chunk_records=DECODE_CHUNK_RECORDS, lookback_ps=0,
+                 index_file=None):
+    '''
+    Input:
+    1. filename: .ptu file (possibly compressed, see compressed_io.py).
+    2. analysis: DtimeHistogram, MultiTauCorrelator, or any object with update(decoded, count) and merge(other).
+    3. jobs: default: 1. Number of worker processes. With more than one, the file is cut into
+       jobs segments at blocks of the time index (see ptu_reader.PTUReader, the index is built if needed).
+    4. chunk_records: default: DECODE_CHUNK_RECORDS. Number of records decoded at once.
+    5. lookback_ps: default: 0. Time (ps) before the start of each segment read to prime the analysis.
+    6. index_file: default: None. See ptu_reader.PTUReader.
+
+    Output:
+    analysis, with all the records of the file added.
+    '''
+    if jobs == 1:
+        n_records = open_time_tags(filename)["records"].shape[0]
+        return _analyse_segment(filename, analysis, 0, 0, n_records, 0, chunk_records)
+    reader = PTUReader(filename, index_file=index_file)
+    n_blocks = reader.n_blocks()
+    bounds = np.linspace(0, n_blocks, min(jobs, max(n_blocks, 1)) + 1).astype(int)
+    segments = []
+    for first_block, end_block in zip(bounds[:-1], bounds[1:]):
+        prime_block = first_block
+        if lookback_ps and first_block > 0:
+            # in T3 mode, a later block can hold slightly earlier photons
+            t_start = min(reader.block_info(block)[1] for block in range(first_block, end_block))
+            prime_block = min(reader.block_range(t_start - lookback_ps, t_start)[0], first_block)
+        segments.append((prime_block * reader.index_stride, first_block * reader.index_stride,
+                         min(end_block * reader.index_stride, len(reader)),
+                         reader.block_info(prime_block)[0] if prime_block < n_blocks else 0))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=add_environment_hook) as executor:
+        futures = [executor.submit(_analyse_segment, filename, analysis, prime_start, start, stop,
+                                   oflcorrection, chunk_records)
+                   for prime_start, start, stop, oflcorrection in segments]
+        partials = [future.result() for future in futures]
+    result = partials[0]
+    for partial in partials[1:]:
+        result.merge(partial)
+    return result
+
+
+def tcspc_histogram(filename, n_bins=None, jobs=1, chunk_records=DECODE_CHUNK_RECORDS, index_file=None):
+    '''
+    Input:
+    1. filename: .ptu file in T3 mode.
+    2. n_bins: default: None, i.e. 4096 for the PicoHarp and 32768 for the other devices. Number of dtime bins.
+    3. jobs, chunk_records, index_file: see analyse_file.
+
+    Output:
+    dict with dtime (ps) and counts (channels x bins), see DtimeHistogram.result.
+    '''
+    source = open_time_tags(filename)
+    if not is_t3(source["rec_type"]):
+        raise ValueError("{0} is not a T3 mode file".format(filename))
+    if n_bins is None:
+        n_bins = 1 << 12 if source["rec_type"] == rtPicoHarpT3 else 1 << 15
+    histogram = DtimeHistogram(n_bins, source["resolution"])
+    return analyse_file(filename, histogram, jobs, chunk_records, index_file=index_file).result()
+
+
+def g2_correlation(filename, channel_a, channel_b, bin_width=1e-10, n_levels=20, points_per_level=8,
+                   jobs=1, chunk_records=DECODE_CHUNK_RECORDS, index_file=None):
+    '''
+    Input:
+    1. filename: .ptu file (T2 or T3 mode, in T3 mode the timestamps include the dtime).
+    2. channel_a, channel_b, bin_width, n_levels, points_per_level: see MultiTauCorrelator.
+    3. jobs, chunk_records, index_file: see analyse_file.
+
+    Output:
+    dict with lag (ps), bin_width (ps), counts and g2, see MultiTauCorrelator.result.
+    '''
+    correlator = MultiTauCorrelator(channel_a, channel_b, bin_width, n_levels, points_per_level)
+    return analyse_file(filename, correlator, jobs, chunk_records, lookback_ps=correlator.max_lag_ps,
+                        index_file=index_file).result()
+
+
+if __name__ == "__main__":
+    g2 = g2_correlation('test.ptu', 1, 2, jobs=4)
+    for lag, value in zip(g2["lag"], g2["g2"]):
+        print(lag, value)
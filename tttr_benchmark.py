@@ -0,0 +1,260 @@
+'''
+This script benchmarks each stage of the conversion on synthetic data (see synthetic_tttr.py):
+write_ptuheader, read_ptuheader, combine_time_tags_header, convert_pt2_to_ptu (with and without
+the check of the header values) and the decoding of the time tags.
+Each stage runs in a fresh process, so its peak memory (RSS) is measured on its own,
+and the best time of a few repeats is kept.
+The results are saved as a json file, with the version of the code and of the libraries,
+so runs can be compared across versions with --compare.
+
+Usage:
+python tttr_benchmark.py --photons 10000000 --output results.json
+python tttr_benchmark.py --compare old_results.json --output new_results.json
+'''
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from tttr_mode_to_ptu import (write_ptuheader, read_ptuheader, combine_time_tags_header,
+                              rtPicoHarpT2)
+from pt2_to_ptu import convert_pt2_to_ptu
+from tttr_decoder import iter_decode
+from synthetic_tttr import write_synthetic_legacy, write_synthetic_stream
+from instrumentation import peak_rss_mb
+
+DEFAULT_OUTPUT = 'benchmark_results.json'
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_HEADER = os.path.join(PACKAGE_DIR, 'picoharp_ptu_header_parameter.npz')
+
+
+def _bench_write_ptuheader(data, header_ops):
+    output = os.path.join(data['workdir'], 'header_write.ptu')
+    start = time.perf_counter()
+    for j in range(header_ops):
+        write_ptuheader(output, acquisition_time_ms=1000 + j, total_records=j,
+                        timestamp=1.7e9, counts0=1000, counts1=2000, header=data['header'])
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'bytes': header_ops * os.path.getsize(output), 'ops': header_ops}
+
+
+def _bench_read_ptuheader(data, header_ops):
+    start = time.perf_counter()
+    for j in range(header_ops):
+        read_ptuheader(data['ptu_header'], isprint=False)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'bytes': header_ops * os.path.getsize(data['ptu_header']),
+            'ops': header_ops}
+
+
+def _bench_combine_time_tags_header(data, header_ops):
+    output = os.path.join(data['workdir'], 'combined.ptu')
+    start = time.perf_counter()
+    combine_time_tags_header(data['ptu_header'], data['stream'], output)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'bytes': os.path.getsize(output),
+            'records': data['stream_records']}
+
+
+def _bench_convert(data, verify):
+    start = time.perf_counter()
+    convert_pt2_to_ptu(data['pt2'], isprint=False, header=data['header'], verify=verify)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'bytes': os.path.getsize(data['pt2']),
+            'records': data['pt2_records']}
+
+
+def _bench_convert_pt2_to_ptu(data, header_ops):
+    return _bench_convert(data, verify=False)
+
+
+def _bench_convert_pt2_to_ptu_verify(data, header_ops):
+    return _bench_convert(data, verify=True)
+
+
+def _bench_decode(data, header_ops):
+    records = np.memmap(data['stream'], dtype='<u4', mode='r')
+    start = time.perf_counter()
+    photons = 0
+    for decoded in iter_decode(records, rtPicoHarpT2, 4e-12):
+        photons += decoded['timestamp'].shape[0]
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'bytes': 4 * records.shape[0], 'records': records.shape[0]}
+
+
+STAGES = {'write_ptuheader': _bench_write_ptuheader,
+          'read_ptuheader': _bench_read_ptuheader,
+          'combine_time_tags_header': _bench_combine_time_tags_header,
+          'convert_pt2_to_ptu': _bench_convert_pt2_to_ptu,
+          'convert_pt2_to_ptu_verify': _bench_convert_pt2_to_ptu_verify,
+          'decode': _bench_decode}
+
+
+def _run_stage(name, data, repeat, header_ops):
+    '''
+    Best of repeat runs of a stage, with the throughputs and the peak memory of the process.
+    '''
+    best = None
+    for j in range(repeat):
+        result = STAGES[name](data, header_ops)
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    seconds = max(best['seconds'], 1e-9)
+    best['mb_per_s'] = best['bytes'] / 1e6 / seconds
+    if 'records' in best:
+        best['records_per_s'] = best['records'] / seconds
+    if 'ops' in best:
+        best['header_ops_per_s'] = best['ops'] / seconds
+    best['peak_rss_mb'] = peak_rss_mb()
+    return best
+
+
+def prepare_benchmark_data(workdir, n_photons=10000000, count_rate=1e5, overflow_density=None,
+                           header=DEFAULT_HEADER, seed=0):
+    '''
+    Write the synthetic files used by the benchmarks in workdir: a .pt2 file, a raw stream of
+    PicoHarp T2 records and a .ptu header.
+    Returns a dict with their paths and number of records.
+    '''
+    kwargs = {'count_rate': count_rate, 'overflow_density': overflow_density, 'seed': seed}
+    pt2 = os.path.join(workdir, 'synthetic.pt2')
+    stream = os.path.join(workdir, 'synthetic_stream.bin')
+    ptu_header = os.path.join(workdir, 'synthetic_header.ptu')
+    pt2_summary = write_synthetic_legacy(pt2, n_photons, 'pt2', **kwargs)
+    stream_summary = write_synthetic_stream(stream, n_photons, rtPicoHarpT2, **kwargs)
+    write_ptuheader(ptu_header, acquisition_time_ms=int(stream_summary['last_time'] * 1e3),
+                    total_records=stream_summary['num_records'], header=header)
+    return {'workdir': workdir, 'header': header, 'pt2': pt2, 'pt2_records': pt2_summary['num_records'],
+            'stream': stream, 'stream_records': stream_summary['num_records'],
+            'ptu_header': ptu_header}
+
+
+def _git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=PACKAGE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(n_photons=10000000, count_rate=1e5, overflow_density=None, stages=None,
+                   repeat=3, header_ops=2000, header=DEFAULT_HEADER, workdir=None,
+                   output=DEFAULT_OUTPUT, seed=0):
+    '''
+    Input:
+    1. n_photons: default: 10000000. Number of photons of the synthetic files.
+    2. count_rate, overflow_density: see synthetic_tttr.synthetic_records.
+    3. stages: default: None, i.e. all the STAGES. Names of the stages to run.
+    4. repeat: default: 3. Number of runs of each stage, the fastest is kept.
+    5. header_ops: default: 2000. Number of headers written or read per run of the header stages.
+    6. header: default: DEFAULT_HEADER. .npz header file (PicoHarp, T2 mode).
+    7. workdir: default: None, i.e. a temporary directory, removed at the end.
+       Directory of the synthetic files and of the converted files.
+    8. output: default: DEFAULT_OUTPUT. json file of the results, None to not save them.
+    9. seed: default: 0. Seed of the synthetic data.
+
+    Output:
+    dict with the parameters, the environment (versions of the code, Python and NumPy)
+    and, for each stage: seconds, bytes, records and/or ops, mb_per_s, records_per_s and/or
+    header_ops_per_s, peak_rss_mb (None if not available).
+    '''
+    if stages is None:
+        stages = list(STAGES)
+    for name in stages:
+        if name not in STAGES:
+            raise ValueError('Unknown stage {0!r}, expected one of {1}'.format(name, ', '.join(STAGES)))
+    temporary = workdir is None
+    if temporary:
+        workdir = tempfile.mkdtemp(prefix='tttr_benchmark_')
+    try:
+        data = prepare_benchmark_data(workdir, n_photons, count_rate, overflow_density, header, seed)
+        results = {}
+        context = multiprocessing.get_context('spawn')
+        for name in stages:
+            # a fresh process per stage: its peak memory only covers this stage
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results[name] = executor.submit(_run_stage, name, data, repeat, header_ops).result()
+    finally:
+        if temporary:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'version': _git_version(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'platform': platform.platform(),
+              'parameters': {'n_photons': n_photons, 'count_rate': count_rate,
+                             'overflow_density': overflow_density, 'repeat': repeat,
+                             'header_ops': header_ops, 'header': os.path.basename(header),
+                             'seed': seed},
+              'stages': results}
+    if output is not None:
+        with open(output, 'w') as outputfile:
+            json.dump(report, outputfile, indent=1)
+    return report
+
+
+def compare_benchmarks(baseline, current):
+    '''
+    Ratio current / baseline of the throughputs and of the peak memory of each stage run in both.
+    baseline and current are results of run_benchmarks, or json files of results.
+    '''
+    reports = []
+    for report in (baseline, current):
+        if not isinstance(report, dict):
+            with open(report) as inputfile:
+                report = json.load(inputfile)
+        reports.append(report)
+    ratios = {}
+    for name, stage in reports[1]['stages'].items():
+        old = reports[0]['stages'].get(name)
+        if old is None:
+            continue
+        ratios[name] = {metric: stage[metric] / old[metric]
+                        for metric in ('mb_per_s', 'records_per_s', 'header_ops_per_s', 'peak_rss_mb')
+                        if stage.get(metric) and old.get(metric)}
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the conversion stages on synthetic data.')
+    parser.add_argument('--photons', type=int, default=10000000,
+                        help='number of photons of the synthetic files')
+    parser.add_argument('--count-rate', type=float, default=1e5,
+                        help='count rate of the synthetic files (counts/s)')
+    parser.add_argument('--overflow-density', type=float, default=None,
+                        help='number of overflows per photon, sets the count rate')
+    parser.add_argument('--stages', nargs='+', default=None, choices=list(STAGES),
+                        help='stages to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each stage, the fastest is kept')
+    parser.add_argument('--header-ops', type=int, default=2000,
+                        help='number of headers written or read per run')
+    parser.add_argument('--workdir', default=None,
+                        help='directory of the synthetic files (default: temporary directory)')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='json file of the results')
+    parser.add_argument('--compare', default=None,
+                        help='json file of previous results to compare with')
+    args = parser.parse_args(argv)
+    report = run_benchmarks(n_photons=args.photons, count_rate=args.count_rate,
+                            overflow_density=args.overflow_density, stages=args.stages,
+                            repeat=args.repeat, header_ops=args.header_ops,
+                            workdir=args.workdir, output=args.output)
+    for name, stage in report['stages'].items():
+        print('{0:<28} {1:10.1f} MB/s {2:14.0f} records/s {3:10.0f} header ops/s {4:8.1f} MB peak RSS'.format(
+            name, stage['mb_per_s'], stage.get('records_per_s', 0), stage.get('header_ops_per_s', 0),
+            stage['peak_rss_mb'] or 0))
+    if args.compare is not None:
+        for name, ratios in compare_benchmarks(args.compare, report).items():
+            print('{0:<28} {1}'.format(name, ', '.join(
+                '{0} x{1:.2f}'.format(metric, ratio) for metric, ratio in ratios.items())))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
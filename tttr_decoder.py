@@ -0,0 +1,374 @@
+'''
+This script includes a vectorized decoder for the time tag records of PicoQuant devices
+(PicoHarp 300, HydraHarp 400, TimeHarp 260 and MultiHarp, in both T2 and T3 modes).
+The records are decoded with NumPy bit operations and the overflow records are unwrapped
+with a cumulative sum, so there is no Python code running per record.
+Records can be decoded in chunks: the overflow correction is carried from one chunk to the next.
+A scalar decoder, following the record descriptions of the PicoQuant demo scripts,
+is included as a reference and to benchmark the vectorized one.
+'''
+
+import time
+import numpy as np
+from tttr_mode_to_ptu import (rtPicoHarpT3, rtPicoHarpT2, rtHydraHarpT3, rtHydraHarpT2,
+                              rtHydraHarp2T3, rtHydraHarp2T2, rtTimeHarp260NT3,
+                              rtTimeHarp260NT2, rtTimeHarp260PT3, rtTimeHarp260PT2,
+                              rtMultiHarpNT3, rtMultiHarpNT2)
+
+# Overflow periods, in units of the time tag (T2) or of the sync period (T3)
+T2WRAPAROUND_PICOHARP = 210698240
+T3WRAPAROUND_PICOHARP = 65536
+T2WRAPAROUND_V1 = 33552000
+T2WRAPAROUND_V2 = 33554432
+T3WRAPAROUND = 1024
+
+# Number of records decoded at once by iter_decode
+DECODE_CHUNK_RECORDS = 1 << 20
+
+T2_RECORD_TYPES = (rtPicoHarpT2, rtHydraHarpT2, rtHydraHarp2T2, rtTimeHarp260NT2,
+                   rtTimeHarp260PT2, rtMultiHarpNT2)
+T3_RECORD_TYPES = (rtPicoHarpT3, rtHydraHarpT3, rtHydraHarp2T3, rtTimeHarp260NT3,
+                   rtTimeHarp260PT3, rtMultiHarpNT3)
+# HydraHarp records of format version 1 store a single overflow per record
+V1_RECORD_TYPES = (rtHydraHarpT2, rtHydraHarpT3)
+
+
+def is_t3(rec_type):
+    """
+    Return True for a T3 record type, False for a T2 record type.
+    """
+    if rec_type in T3_RECORD_TYPES:
+        return True
+    if rec_type in T2_RECORD_TYPES:
+        return False
+    raise ValueError("Unknown record type {0:#010x}".format(rec_type))
+
+
+def as_records(buffer):
+    """
+    View any buffer (bytes, memoryview, np.memmap, ...) as an array of little-endian uint32 records, without copying.
+    """
+    if isinstance(buffer, np.ndarray) and buffer.dtype == np.dtype("<u4"):
+        return buffer
+    return np.frombuffer(buffer, dtype="<u4")
+
+
+def _to_ps(counts, unit_ps):
+    """
+    Convert counts of unit_ps picoseconds to int64 picoseconds.
+    Exact integer arithmetic is used when unit_ps is a whole number of picoseconds.
+    """
+    if unit_ps == round(unit_ps):
+        return counts * np.int64(round(unit_ps))
+    return np.rint(counts * unit_ps).astype(np.int64)
+
+
+class TTTRDecoder:
+    '''
+    Input:
+    1. rec_type: record type of the file (TTResultFormat_TTTRRecType in the ptu header).
+    2. global_resolution: MeasDesc_GlobalResolution in s. Time tag unit in T2 mode, sync period in T3 mode.
+    3. resolution: MeasDesc_Resolution in s. Width of a dtime bin, only used in T3 mode.
+    4. return_index: default: False. If True, the output also has the position of each record in the decoded buffer.
+
+    Calling decode on consecutive chunks of the same file carries the overflow correction between chunks.
+
+    Output of decode (dict of arrays, overflow records are dropped):
+    timestamp: absolute time in ps (int64). In T3 mode, time of the sync plus dtime.
+    channel: input channel, or the marker bits for a marker (uint8). In T2 mode, 0 is the sync channel.
+    marker: True for marker records (bool).
+    T3 mode only:
+    nsync: absolute number of sync periods (int64).
+    dtime: time from the sync, in units of resolution (uint16).
+    With return_index:
+    index: position of the record in the decoded buffer (int64).
+    '''
+
+    def __init__(self, rec_type, global_resolution, resolution=None, return_index=False):
+        self.rec_type = rec_type
+        self.return_index = return_index
+        self.t3 = is_t3(rec_type)
+        self.global_resolution_ps = global_resolution * 1e12
+        if self.t3 and resolution is None:
+            raise ValueError("resolution is required to decode T3 records")
+        self.resolution_ps = None if resolution is None else resolution * 1e12
+        self.oflcorrection = 0
+
+    def reset(self, oflcorrection=0):
+        """
+        Restart decoding at a record where the overflow correction is oflcorrection.
+        """
+        self.oflcorrection = oflcorrection
+
+    def _unwrap(self, overflow, increment):
+        """
+        Absolute overflow correction of each record, continuing from the previous chunk.
+        """
+        ofl = np.zeros(overflow.shape[0], dtype=np.int64)
+        ofl[overflow] = increment
+        np.cumsum(ofl, out=ofl)
+        ofl += self.oflcorrection
+        if ofl.shape[0]:
+            self.oflcorrection = int(ofl[-1])
+        return ofl
+
+    def decode(self, records):
+        records = as_records(records)
+        if self.rec_type == rtPicoHarpT2:
+            output, keep = self._decode_picoharp_t2(records)
+        elif self.rec_type == rtPicoHarpT3:
+            output, keep = self._decode_picoharp_t3(records)
+        elif self.t3:
+            output, keep = self._decode_hydraharp_t3(records)
+        else:
+            output, keep = self._decode_hydraharp_t2(records)
+        if self.return_index:
+            output["index"] = np.flatnonzero(keep)
+        return output
+
+    def count_channels(self, records):
+        """
+        Count the photons of records on each channel, numbered as by decode, without decoding their times.
+        The overflow correction is carried to the next chunk as by decode.
+        Output:
+        counts: photons (markers excluded) on each channel (int64 array of 256).
+        n_events: number of records that decode would return (photons and markers).
+        """
+        records = as_records(records)
+        counts = np.zeros(256, dtype=np.int64)
+        if self.rec_type in (rtPicoHarpT2, rtPicoHarpT3):
+            code = np.bincount(records >> 28, minlength=16)
+            n_overflow = 0
+            if code[15]:
+                # special records: markers, or overflows when the marker bits are 0
+                special = records[(records >> 28) == 0xF]
+                n_overflow = int(np.count_nonzero((special & (0xF0000 if self.t3 else 0xF)) == 0))
+            counts[:15] = code[:15]
+            self.oflcorrection += n_overflow * (T3WRAPAROUND_PICOHARP if self.t3 else T2WRAPAROUND_PICOHARP)
+            return counts, records.shape[0] - n_overflow
+        # bit 31 (special) and the 6 channel bits
+        code = np.bincount(records >> 25, minlength=128)
+        if code[0x7F]:
+            wraparound = T3WRAPAROUND if self.t3 else (
+                T2WRAPAROUND_V1 if self.rec_type in V1_RECORD_TYPES else T2WRAPAROUND_V2)
+            if self.rec_type in V1_RECORD_TYPES:
+                self.oflcorrection += int(code[0x7F]) * wraparound
+            else:
+                overflow = records[(records >> 25) == 0x7F] & (0x3FF if self.t3 else 0x1FFFFFF)
+                self.oflcorrection += int(np.maximum(overflow, 1).sum(dtype=np.int64)) * wraparound
+        n_markers = int(code[0x41:0x50].sum())
+        if self.t3:
+            counts[:64] = code[:64]
+        else:
+            # channel 0 is the sync, special records with channel 0
+            counts[0] = code[0x40]
+            counts[1:65] = code[:64]
+        return counts, int(counts.sum()) + n_markers
+
+    def _decode_picoharp_t2(self, records):
+        channel = (records >> 28).astype(np.uint8)
+        timetag = records & 0x0FFFFFFF
+        special = channel == 0xF
+        markers = (timetag & 0xF).astype(np.uint8)
+        overflow = special & (markers == 0)
+        truetime = self._unwrap(overflow, T2WRAPAROUND_PICOHARP) + timetag
+        keep = ~overflow
+        marker = special[keep]
+        channel = np.where(marker, markers[keep], channel[keep])
+        return {"timestamp": _to_ps(truetime[keep], self.global_resolution_ps),
+                "channel": channel, "marker": marker}, keep
+
+    def _decode_picoharp_t3(self, records):
+        channel = (records >> 28).astype(np.uint8)
+        dtime = ((records >> 16) & 0xFFF).astype(np.uint16)
+        nsync = records & 0xFFFF
+        special = channel == 0xF
+        markers = (dtime & 0xF).astype(np.uint8)
+        overflow = special & (markers == 0)
+        truensync = self._unwrap(overflow, T3WRAPAROUND_PICOHARP) + nsync
+        keep = ~overflow
+        return self._t3_output(truensync[keep], dtime[keep], special[keep],
+                               np.where(special, markers, channel)[keep]), keep
+
+    def _decode_hydraharp_t2(self, records):
+        special = (records >> 31).astype(bool)
+        channel = ((records >> 25) & 0x3F).astype(np.uint8)
+        timetag = records & 0x1FFFFFF
+        overflow = special & (channel == 0x3F)
+        if self.rec_type in V1_RECORD_TYPES:
+            increment = T2WRAPAROUND_V1
+        else:
+            increment = T2WRAPAROUND_V2 * np.maximum(timetag[overflow], 1).astype(np.int64)
+        truetime = self._unwrap(overflow, increment) + timetag
+        marker = special & (channel >= 1) & (channel <= 15)
+        sync = special & (channel == 0)
+        keep = ~special | marker | sync
+        marker = marker[keep]
+        channel = channel[keep]
+        channel = np.where(marker | sync[keep], channel, channel + 1).astype(np.uint8)
+        return {"timestamp": _to_ps(truetime[keep], self.global_resolution_ps),
+                "channel": channel, "marker": marker}, keep
+
+    def _decode_hydraharp_t3(self, records):
+        special = (records >> 31).astype(bool)
+        channel = ((records >> 25) & 0x3F).astype(np.uint8)
+        dtime = ((records >> 10) & 0x7FFF).astype(np.uint16)
+        nsync = records & 0x3FF
+        overflow = special & (channel == 0x3F)
+        if self.rec_type in V1_RECORD_TYPES:
+            increment = T3WRAPAROUND
+        else:
+            increment = T3WRAPAROUND * np.maximum(nsync[overflow], 1).astype(np.int64)
+        truensync = self._unwrap(overflow, increment) + nsync
+        marker = special & (channel >= 1) & (channel <= 15)
+        keep = ~special | marker
+        return self._t3_output(truensync[keep], dtime[keep], marker[keep], channel[keep]), keep
+
+    def _t3_output(self, nsync, dtime, marker, channel):
+        timestamp = _to_ps(nsync, self.global_resolution_ps)
+        timestamp += _to_ps(dtime.astype(np.int64), self.resolution_ps)
+        return {"timestamp": timestamp, "channel": channel, "marker": marker,
+                "nsync": nsync, "dtime": dtime}
+
+
+def decode_records(records, rec_type, global_resolution, resolution=None):
+    """
+    Decode all the records of a buffer at once. See TTTRDecoder for the inputs and the output.
+    """
+    return TTTRDecoder(rec_type, global_resolution, resolution).decode(records)
+
+
+def iter_decode(records, rec_type, global_resolution, resolution=None,
+                chunk_records=DECODE_CHUNK_RECORDS):
+    """
+    Decode a buffer (e.g. a np.memmap of a file) chunk by chunk, carrying the overflow correction
+    between chunks. Yields the decoded dict of each chunk of chunk_records records.
+    records can also be any object sliced like an array (e.g. compressed_io.RecordStream).
+    """
+    if not hasattr(records, "shape"):
+        records = as_records(records)
+    decoder = TTTRDecoder(rec_type, global_resolution, resolution)
+    for start in range(0, records.shape[0], chunk_records):
+        yield decoder.decode(records[start:start + chunk_records])
+
+
+def decode_records_scalar(records, rec_type, global_resolution, resolution=None):
+    """
+    Reference decoder, one record at a time, as in the PicoQuant demo scripts.
+    Same inputs and output as decode_records, only meant for testing and benchmarking.
+    """
+    t3 = is_t3(rec_type)
+    v1 = rec_type in V1_RECORD_TYPES
+    global_resolution_ps = global_resolution * 1e12
+    resolution_ps = None if resolution is None else resolution * 1e12
+    oflcorrection = 0
+    _nsync = []
+    _dtime = []
+    _channel = []
+    _marker = []
+    for record in as_records(records).tolist():
+        if rec_type in (rtPicoHarpT2, rtPicoHarpT3):
+            channel = record >> 28
+            if t3:
+                dtime = (record >> 16) & 0xFFF
+                nsync = record & 0xFFFF
+                markers = dtime & 0xF
+            else:
+                dtime = 0
+                nsync = record & 0x0FFFFFFF
+                markers = nsync & 0xF
+            if channel == 0xF:
+                if markers == 0:
+                    oflcorrection += T3WRAPAROUND_PICOHARP if t3 else T2WRAPAROUND_PICOHARP
+                    continue
+                channel = markers
+                marker = True
+            else:
+                marker = False
+        else:
+            special = record >> 31
+            channel = (record >> 25) & 0x3F
+            if t3:
+                dtime = (record >> 10) & 0x7FFF
+                nsync = record & 0x3FF
+                wraparound = T3WRAPAROUND
+            else:
+                dtime = 0
+                nsync = record & 0x1FFFFFF
+                wraparound = T2WRAPAROUND_V1 if v1 else T2WRAPAROUND_V2
+            marker = False
+            if special == 1:
+                if channel == 0x3F:
+                    if v1 or nsync == 0:
+                        oflcorrection += wraparound
+                    else:
+                        oflcorrection += wraparound * nsync
+                    continue
+                elif 1 <= channel <= 15:
+                    marker = True
+                elif channel != 0 or t3:
+                    continue
+            elif not t3:
+                channel += 1
+        _nsync.append(oflcorrection + nsync)
+        _dtime.append(dtime)
+        _channel.append(channel)
+        _marker.append(marker)
+    nsync = np.array(_nsync, dtype=np.int64)
+    output = {"channel": np.array(_channel, dtype=np.uint8),
+              "marker": np.array(_marker, dtype=bool)}
+    if t3:
+        dtime = np.array(_dtime, dtype=np.uint16)
+        output["timestamp"] = (_to_ps(nsync, global_resolution_ps)
+                               + _to_ps(dtime.astype(np.int64), resolution_ps))
+        output["nsync"] = nsync
+        output["dtime"] = dtime
+    else:
+        output["timestamp"] = _to_ps(nsync, global_resolution_ps)
+    return output
+
+
+def random_records(n_records, rec_type, overflow_fraction=0.01, seed=0):
+    """
+    Random records of type rec_type, with a fraction overflow_fraction of overflow records.
+    Only meant for benchmarking: the time tags are random, not increasing.
+    """
+    rng = np.random.default_rng(seed)
+    records = rng.integers(0, 1 << 32, n_records, dtype=np.uint64).astype(np.uint32)
+    overflow = rng.random(n_records) < overflow_fraction
+    if rec_type in (rtPicoHarpT2, rtPicoHarpT3):
+        records[overflow] = 0xF0000000
+    else:
+        records[overflow] |= np.uint32(0xFE000000)
+    return records
+
+
+def benchmark_decoder(n_records=1000000, rec_type=rtPicoHarpT2, global_resolution=4e-12,
+                      resolution=4e-12, chunk_records=DECODE_CHUNK_RECORDS):
+    """
+    Compare the throughput (records/s) of the chunked vectorized decoder against
+    the scalar reference decoder, and check that both give the same result.
+    """
+    records = random_records(n_records, rec_type)
+    start = time.perf_counter()
+    chunks = list(iter_decode(records, rec_type, global_resolution, resolution, chunk_records))
+    vectorized_s = time.perf_counter() - start
+    start = time.perf_counter()
+    reference = decode_records_scalar(records, rec_type, global_resolution, resolution)
+    scalar_s = time.perf_counter() - start
+    for key, value in reference.items():
+        if not np.array_equal(np.concatenate([chunk[key] for chunk in chunks]), value):
+            raise AssertionError("Decoders disagree on {0}".format(key))
+    return {"rec_type": rec_type, "records": n_records,
+            "vectorized_records_per_s": n_records / vectorized_s,
+            "scalar_records_per_s": n_records / scalar_s,
+            "speedup": scalar_s / vectorized_s}
+
+
+if __name__ == "__main__":
+    for rec_type, global_resolution, resolution in ((rtPicoHarpT2, 4e-12, 4e-12),
+                                                    (rtPicoHarpT3, 100e-9, 4e-12),
+                                                    (rtHydraHarpT2, 1e-12, 1e-12),
+                                                    (rtHydraHarp2T3, 12.443e-9, 1e-12)):
+        print(benchmark_decoder(rec_type=rec_type, global_resolution=global_resolution,
+                                resolution=resolution, chunk_records=100000))
@@ -18,10 +18,17 @@ Zhe Xian, Koong
 Date: 8th of April 2023. Oxford, UK.
 '''
 
+import copy
+import functools
+import logging
+import os
 import struct
 import time
-import sys
 import numpy as np
+from instrumentation import stage
+from compressed_io import open_file, is_plain_file, detect_compression, GZIP_MAGIC, ZSTD_MAGIC
+
+logger = logging.getLogger(__name__)
 
 # Tag Types
 tyEmpty8 = struct.unpack(">i", bytes.fromhex("FFFF0008"))[0]
@@ -50,196 +57,638 @@ rtTimeHarp260PT2 = struct.unpack(">i", bytes.fromhex("00010206"))[0]
 rtMultiHarpNT3 = struct.unpack(">i", bytes.fromhex("00010307"))[0]
 rtMultiHarpNT2 = struct.unpack(">i", bytes.fromhex("00010207"))[0]
 
+# Size of the chunks used when copying time tags between files
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+# Size of the first block of a file read to parse its header (most headers are a few kB)
+HEADER_READ_SIZE = 64 * 1024
+
+# Tag header: identifier, index, type and the 8 bytes value (the length for the types in LENGTH_TAG_TYPES)
+_TAG = struct.Struct("<32siiq")
+_DOUBLE = struct.Struct("<d")
+# Tag types followed by a payload of the length given as value
+LENGTH_TAG_TYPES = (tyAnsiString, tyWideString, tyFloat8Array, tyBinaryBlob)
+INT_TAG_TYPES = (tyBool8, tyInt8, tyBitSet64, tyColor8, tyFloat8Array, tyBinaryBlob)
+KNOWN_TAG_TYPES = frozenset((tyEmpty8, tyFloat8, tyTDateTime) + LENGTH_TAG_TYPES + INT_TAG_TYPES)
+_LENGTH_TAG_TYPES_SET = frozenset(LENGTH_TAG_TYPES)
+
+
+@functools.lru_cache(maxsize=32)
+def _tag_identifiers(names):
+    # identifiers as stored in the header, padded to 32 bytes
+    return frozenset(name.encode("utf-8").ljust(32, b"\0") for name in names + ("Header_End",))
+
+
+def _parse_header(buffer, names=None, entries=None, filename=None):
+    """
+    Parse the tags of the ptu header at the start of buffer (any bytes-like object, not copied).
+    Only the tags of names (tag names without index) are decoded, all the tags if names is None,
+    the other values are skipped by their length.
+    If entries is a list, (ident, tagIdx, tagTyp, value) is appended for each tag, as saved in the .npz files.
+    Output :
+    tags, header_end : see read_ptuheader. header_end is None if buffer ends before the Header_End tag.
+    """
+    if bytes(buffer[:6]) != b"PQTTTR":
+        raise ValueError("{0} is not a ptu file".format("buffer" if filename is None else filename))
+    if names is not None:
+        names = _tag_identifiers(tuple(names))
+    unpack_tag = _TAG.unpack_from
+    length_types = _LENGTH_TAG_TYPES_SET
+    known_types = KNOWN_TAG_TYPES
+    size = len(buffer)
+    tags = {}
+    position = 16
+    while position + 48 <= size:
+        rawIdent, tagIdx, tagTyp, tagInt = unpack_tag(buffer, position)
+        value_end = position + 48 + tagInt if tagTyp in length_types else position + 48
+        if tagTyp in length_types and tagInt < 0:
+            raise ValueError("Invalid length {0} of the tag {1} in {2}".format(
+                tagInt, rawIdent.rstrip(b"\0").decode("utf-8", errors="replace"),
+                "buffer" if filename is None else filename))
+        if names is not None and rawIdent not in names and tagTyp in known_types:
+            position = value_end
+            continue
+        rawIdent = rawIdent.rstrip(b"\0")
+        if rawIdent == b"Header_End":
+            if entries is not None:
+                entries.append(("Header_End", tagIdx, tagTyp, " "))
+            tags["Header_End"] = " "
+            return tags, value_end
+        if tagTyp in known_types:
+            if tagTyp == tyEmpty8:
+                value = " "
+            elif tagTyp in INT_TAG_TYPES:
+                value = tagInt
+            elif tagTyp in (tyFloat8, tyTDateTime):
+                value = _DOUBLE.unpack_from(buffer, position + 40)[0]
+            elif tagTyp in (tyAnsiString, tyWideString):
+                if value_end > size:
+                    break
+                raw = bytes(buffer[position + 48:value_end])
+                if tagTyp == tyAnsiString:
+                    value = [tagInt, raw.decode("utf-8").strip("\0")]
+                else:
+                    value = [tagInt, raw.decode("utf-16le", errors="ignore").strip("\0")]
+            tagIdent = rawIdent.decode("utf-8")
+            if entries is not None:
+                entries.append((tagIdent, tagIdx, tagTyp, value))
+            evalName = tagIdent + '(' + str(tagIdx) + ')' if tagIdx > -1 else tagIdent
+            tags[evalName] = value[1] if tagTyp in (tyAnsiString, tyWideString) else value
+        else:
+            raise ValueError("Unknown tag type {0:#010x} of {1} in {2}".format(
+                tagTyp & 0xFFFFFFFF, rawIdent.decode("utf-8", errors="replace"),
+                "buffer" if filename is None else filename))
+        position = value_end
+    return tags, None
+
+
+def _read_header_buffer(inputfile, filename, read_size=HEADER_READ_SIZE, names=None, entries=None):
+    """
+    Read the header of the open file inputfile (at its start) in as few reads as possible and parse it.
+    Output :
+    tags, header_end, and the buffer read (starting with the header).
+    """
+    buffer = inputfile.read(read_size)
+    while True:
+        if entries is not None:
+            del entries[:]
+        tags, header_end = _parse_header(buffer, names, entries, filename)
+        if header_end is not None:
+            return tags, header_end, buffer
+        more = inputfile.read(max(len(buffer), read_size))
+        if not more:
+            raise ValueError("{0} has no Header_End tag".format(filename))
+        buffer += more
+
 
 def read_ptuheader(originalfile, isprint=True, npz_savedfile=None):
     """
     Read header from ptu file. It will work on a suitably formated binary file. Add option to output the headers to a .npz file compatible with the writing function.
+    If isprint, the tags are logged at INFO level (logger tttr_mode_to_ptu).
+    The file can be compressed (gzip or zstd, see compressed_io.py), header_end is then an offset in the uncompressed content.
+    The header is read in one block of HEADER_READ_SIZE bytes (more only for larger headers).
+    Raises ValueError for a file that is not a ptu file or holds an unknown tag type.
+    Output :
+    tags : dict of the header tags, keyed by tag name (with the tag index in brackets for indexed tags).
+    header_end : offset in bytes of the first record, right after the Header_End tag.
     """
-    _ident = []
-    _tagIdx = []
-    _tagTyp = []
-    _val = []
+    # the tags are only formatted if they are logged
+    isprint = isprint and logger.isEnabledFor(logging.INFO)
+    entries = [] if isprint or npz_savedfile is not None else None
 
-    with open(originalfile, "rb") as inputfile:
-        magic = inputfile.read(8).decode("utf-8").strip('\0')
-        version = inputfile.read(8).decode("utf-8").strip('\0')
-        if isprint:
-            print(magic, version)
-        while True:
-            tagIdent = inputfile.read(32).decode("utf-8").strip('\0')
-            tagIdx = struct.unpack("<i", inputfile.read(4))[0]
-            tagTyp = struct.unpack("<i", inputfile.read(4))[0]
-            _ident.append(tagIdent)
-            _tagIdx.append(tagIdx)
-            _tagTyp.append(tagTyp)
-            if tagIdx > -1:
-                evalName = tagIdent + '(' + str(tagIdx) + ')'
-            else:
-                evalName = tagIdent
+    with stage("header_parse", file=originalfile) as event, open_file(originalfile) as inputfile:
+        tags, header_end, buffer = _read_header_buffer(inputfile, originalfile, entries=entries)
+        event["bytes"] = header_end
+    if isprint:
+        logger.info("%s %s", buffer[:8].decode("utf-8").strip('\0'),
+                    buffer[8:16].decode("utf-8").strip('\0'))
+        for tagIdent, tagIdx, tagTyp, value in entries:
+            evalName = tagIdent + '(' + str(tagIdx) + ')' if tagIdx > -1 else tagIdent
             if tagTyp == tyEmpty8:
-                inputfile.read(8)
-                _val.append(' ')
-                if isprint:
-                    print((evalName, "<empty Tag>"))
+                shown = "<empty Tag>"
             elif tagTyp == tyBool8:
-                tagInt = struct.unpack("<q", inputfile.read(8))[0]
-                _val.append(int(tagInt))
-                if tagInt == 0:
-                    if isprint:
-                        print((evalName, "False"))
-                else:
-                    if isprint:
-                        print((evalName, "True"))
-            elif tagTyp == tyInt8:
-                tagInt = struct.unpack("<q", inputfile.read(8))[0]
-                _val.append(int(tagInt))
-                if isprint:
-                    print((evalName, tagInt))
-            elif tagTyp == tyBitSet64:
-                tagInt = struct.unpack("<q", inputfile.read(8))[0]
-                _val.append(int(tagInt))
-                if isprint:
-                    print((evalName, tagInt))
-            elif tagTyp == tyColor8:
-                tagInt = struct.unpack("<q", inputfile.read(8))[0]
-                _val.append(int(tagInt))
-                if isprint:
-                    print((evalName, tagInt))
-            elif tagTyp == tyFloat8:
-                tagFloat = struct.unpack("<d", inputfile.read(8))[0]
-                _val.append(float(tagFloat))
-                if isprint:
-                    print((evalName, tagFloat))
-            elif tagTyp == tyFloat8Array:
-                tagInt = struct.unpack("<q", inputfile.read(8))[0]
-                _val.append(int(tagInt))
-                if isprint:
-                    print((evalName, tagInt))
+                shown = "False" if value == 0 else "True"
             elif tagTyp == tyTDateTime:
-                tagFloat = struct.unpack("<d", inputfile.read(8))[0]
-                _val.append(float(tagFloat))
-                tagTime = int((tagFloat - 25569) * 86400)
-                tagTime = time.gmtime(tagTime)
-                if isprint:
-                    print((evalName, tagTime))
-            elif tagTyp == tyAnsiString:
-                tagInt = struct.unpack("<q", inputfile.read(8))[0]
-                tagString = inputfile.read(tagInt).decode("utf-8").strip("\0")
-                _val.append(list([int(tagInt), tagString]))
-                if isprint:
-                    print((evalName, tagString))
-            elif tagTyp == tyWideString:
-                tagInt = struct.unpack("<q", inputfile.read(8))[0]
-                tagString = inputfile.read(tagInt).decode(
-                    "utf-16le", errors="ignore").strip("\0")
-                _val.append(list([int(tagInt), tagString]))
-                if isprint:
-                    print((evalName, tagString))
-            elif tagTyp == tyBinaryBlob:
-                tagInt = struct.unpack("<q", inputfile.read(8))[0]
-                _val.append(int(tagInt))
-                if isprint:
-                    print((evalName, tagInt))
+                shown = time.gmtime(int(tdatetime_to_timestamp(value)))
+            elif tagTyp in (tyAnsiString, tyWideString):
+                shown = value[1]
             else:
-                print("ERROR: Unknown tag type")
-                sys.exit(0)
-            if tagIdent == "Header_End":
-                break
+                shown = value
+            logger.info("%s %s", evalName, shown)
     if npz_savedfile is not None:
-        np.savez(npz_savedfile, ident=_ident, tagIdx=_tagIdx,
-                 tagTyp=_tagTyp, tagValues=np.array(_val, dtype=object))
+        _val = [value for tagIdent, tagIdx, tagTyp, value in entries]
+        values = np.empty(len(_val), dtype=object)
+        for j, value in enumerate(_val):
+            values[j] = value
+        np.savez(npz_savedfile, ident=[entry[0] for entry in entries],
+                 tagIdx=[entry[1] for entry in entries],
+                 tagTyp=[entry[2] for entry in entries], tagValues=values)
+    return tags, header_end
 
 
-def write_ptuheader(inputfile, acquisition_time_ms=None, total_records=None,
-                    timestamp=None, counts0=None, counts1=None,
-                    header='picoharp_ptu_header_parameter.npz'):
+def scan_ptuheader(originalfile, names=None, read_size=HEADER_READ_SIZE):
     """
-    Create a blank file : inputfile
-    Write the ptuheader from the npz file, with the only major changes being 
-    the acquisition time in ms and the total records.
+    Read only the header values of names (tag names without index, all the tags if None) of a ptu file,
+    from a single read of its first read_size bytes. The values of the other tags are skipped,
+    not decoded. Compressed files (see compressed_io.py) are decompressed up to the end of the header.
     Output :
-    inputfile containing the header.
+    tags, header_end : see read_ptuheader (tags only holds the tags of names, and Header_End).
+    """
+    with open(originalfile, "rb") as inputfile:
+        if not inputfile.read(4).startswith((GZIP_MAGIC, ZSTD_MAGIC)):
+            inputfile.seek(0)
+            return _read_header_buffer(inputfile, originalfile, read_size, names)[:2]
+    with open_file(originalfile) as inputfile:
+        return _read_header_buffer(inputfile, originalfile, read_size, names)[:2]
+
+
+def read_ptuheader_offsets(originalfile):
+    """
+    Locate the values of the header tags of a ptu file, so they can be modified in place.
+    The values of the tags are not decoded.
+    Output :
+    offsets : dict mapping each tag name (without index) to the list of (offset in bytes, tag type) of its values.
+    header_end : offset in bytes of the first record, right after the Header_End tag.
+    """
+    offsets = {}
+    with open(originalfile, "rb") as inputfile:
+        inputfile.seek(16)
+        while True:
+            tag = inputfile.read(40)
+            if len(tag) < 40:
+                raise ValueError("{0} has no Header_End tag".format(originalfile))
+            tagIdent = tag[:32].decode("utf-8").strip('\0')
+            tagTyp = struct.unpack("<i", tag[36:40])[0]
+            offsets.setdefault(tagIdent, []).append((inputfile.tell(), tagTyp))
+            tagInt = struct.unpack("<q", inputfile.read(8))[0]
+            if tagTyp in (tyAnsiString, tyWideString, tyFloat8Array, tyBinaryBlob):
+                if tagInt < 0:
+                    raise ValueError("Invalid length {0} of the tag {1} in {2}".format(
+                        tagInt, tagIdent, originalfile))
+                inputfile.seek(tagInt, os.SEEK_CUR)
+            if tagIdent == "Header_End":
+                return offsets, inputfile.tell()
+
+
+# Tags of the header template that write_ptuheader can modify,
+# with the tag type they must have to be modified.
+PATCHABLE_TAGS = {
+    "MeasDesc_AcquisitionTime": tyInt8,
+    "TTResult_StopAfter": tyInt8,
+    "TTResult_SyncRate": tyInt8,
+    "TTResult_InputRate": tyInt8,
+    "TTResult_NumberOfRecords": tyInt8,
+    "MeasDesc_GlobalResolution": tyFloat8,
+    "MeasDesc_Resolution": tyFloat8,
+}
+# Packing of the values of PATCHABLE_TAGS, by tag type
+_PATCH_FORMATS = {tyInt8: "<q", tyFloat8: "<d"}
+# Tags (tyInt8) giving the record type, see PTUHeaderTemplate.with_record_type
+RECORD_TYPE_TAGS = ("TTResultFormat_TTTRRecType", "Measurement_Mode")
+
+
+def header_patches(offsets, acquisition_time_ms=None, total_records=None, counts0=None, counts1=None,
+                   global_resolution=None, resolution=None):
+    """
+    Values to write to modify a header as write_ptuheader does (TDateTime excepted).
+    offsets : dict mapping tags of PATCHABLE_TAGS to the list of byte offsets of their value.
+    counts1 can be a single value, written to every TTResult_InputRate(i), or a list with the rate
+    of each input channel: TTResult_InputRate(i) gets counts1[i] (the indexed tags being in the
+    order of their index in the header), the channels beyond the list are not modified.
+    Output :
+    list of (offset, packed value). The values left to None are not modified.
+    """
+    patches = (
+        ("MeasDesc_AcquisitionTime", acquisition_time_ms),
+        ("TTResult_StopAfter", acquisition_time_ms),
+        ("TTResult_SyncRate", counts0),
+        ("TTResult_InputRate", counts1),
+        ("TTResult_NumberOfRecords", total_records),
+        ("MeasDesc_GlobalResolution", global_resolution),
+        ("MeasDesc_Resolution", resolution),
+    )
+    packed = []
+    for ident, value in patches:
+        if value is None:
+            continue
+        tag_offsets = offsets.get(ident, ())
+        values = value if np.ndim(value) else [value] * len(tag_offsets)
+        packed += [(offset, struct.pack(_PATCH_FORMATS[PATCHABLE_TAGS[ident]], item))
+                   for offset, item in zip(tag_offsets, values) if item is not None]
+    return packed
+
+
+# Number of compiled header templates kept in memory
+HEADER_TEMPLATE_CACHE_SIZE = 8
+
+
+def timestamp_to_tdatetime(t):
+    """
+    Convert a unix timestamp (s) to the TDateTime value (days since 30/12/1899) used in the ptu header.
+    """
+    return t / 86400 + 25569
+
+
+def tdatetime_to_timestamp(t):
     """
-    def timestamp_to_unix(t): return t / 86400 + 25569
-    data = np.load(header, allow_pickle=True)
-    _ident = data["ident"]
-    _tagIdx = data["tagIdx"]
-    _tagTyp = data["tagTyp"]
-    _val = data["tagValues"]
-    magic = "PQTTTR"
-    empty = ""
-    version = "1.0.00"
-    with open(inputfile, "wb") as file:
-        file.write(struct.pack("<8s", magic.encode("ascii")))
-        file.write(struct.pack("<8s", version.encode("ascii")))
+    Convert a TDateTime value of the ptu header to a unix timestamp (s).
+    """
+    return (t - 25569) * 86400
+
+
+class PTUHeaderTemplate:
+    """
+    The ptu header stored in a .npz file (see read_ptuheader), compiled once into
+    a single bytes buffer, together with the byte offsets of the values that can be patched.
+    Input :
+    header : .npz file with the header tags.
+    Attributes :
+    buffer : the complete header, as found in the .npz file.
+    offsets : dict mapping each tag of PATCHABLE_TAGS and of RECORD_TYPE_TAGS (and 'TDateTime' for all the
+    TDateTime tags) to the list of byte offsets of its value in buffer.
+    tags : dict of the tag values, keyed as in read_ptuheader.
+    """
+
+    def __init__(self, header):
+        data = np.load(header, allow_pickle=True)
+        _ident = data["ident"]
+        _tagIdx = data["tagIdx"]
+        _tagTyp = data["tagTyp"]
+        _val = data["tagValues"]
+        magic = "PQTTTR"
+        empty = ""
+        version = "1.0.00"
+        buffer = bytearray()
+        offsets = {ident: [] for ident in tuple(PATCHABLE_TAGS) + RECORD_TYPE_TAGS}
+        offsets["TDateTime"] = []
+        tags = {}
+        buffer += struct.pack("<8s", magic.encode("ascii"))
+        buffer += struct.pack("<8s", version.encode("ascii"))
         for j in range(len(_ident)):
-            file.write(struct.pack("<32s", _ident[j].encode("ascii")))
-            file.write(struct.pack("<i", _tagIdx[j]))
-            file.write(struct.pack("<i", _tagTyp[j]))
+            buffer += struct.pack("<32s", _ident[j].encode("ascii"))
+            buffer += struct.pack("<i", _tagIdx[j])
+            buffer += struct.pack("<i", _tagTyp[j])
+            if _tagIdx[j] > -1:
+                evalName = _ident[j] + '(' + str(_tagIdx[j]) + ')'
+            else:
+                evalName = str(_ident[j])
+            if _tagTyp[j] in (tyAnsiString, tyWideString):
+                tags[evalName] = _val[j][1]
+            else:
+                tags[evalName] = _val[j]
 
+            if PATCHABLE_TAGS.get(_ident[j]) == _tagTyp[j] or (_ident[j] in RECORD_TYPE_TAGS
+                                                               and _tagTyp[j] == tyInt8):
+                offsets[_ident[j]].append(len(buffer))
             if _tagTyp[j] == tyEmpty8:
-                file.write(struct.pack("<8s", empty.encode("ascii")))
-            elif _tagTyp[j] == tyBool8:
-                file.write(struct.pack("<q", _val[j]))
-            elif _tagTyp[j] == tyInt8:
-                if _ident[j] == "MeasDesc_AcquisitionTime" and acquisition_time_ms is not None:
-                    file.write(struct.pack("<q", acquisition_time_ms))
-                elif (
-                    _ident[j] == "TTResult_StopAfter"
-                    and acquisition_time_ms is not None
-                ):
-                    file.write(struct.pack("<q", acquisition_time_ms))
-                elif (
-                    _ident[j] == "TTResult_SyncRate"
-                    and counts0 is not None
-                ):
-                    file.write(struct.pack("<q", counts0))
-                elif (
-                    _ident[j] == "TTResult_InputRate"
-                    and counts1 is not None
-                ):
-                    file.write(struct.pack("<q", counts1))
-                elif (
-                    _ident[j] == "TTResult_NumberOfRecords"
-                    and total_records is not None
-                ):
-                    file.write(struct.pack("<q", total_records))
-                else:
-                    file.write(struct.pack("<q", _val[j]))
-            elif _tagTyp[j] == tyBitSet64:
-                file.write(struct.pack("<q", _val[j]))
-            elif _tagTyp[j] == tyColor8:
-                file.write(struct.pack("<q", _val[j]))
+                buffer += struct.pack("<8s", empty.encode("ascii"))
+            elif _tagTyp[j] in (tyBool8, tyInt8, tyBitSet64, tyColor8,
+                                tyFloat8Array, tyBinaryBlob):
+                buffer += struct.pack("<q", _val[j])
             elif _tagTyp[j] == tyFloat8:
-                file.write(struct.pack("<d", _val[j]))
-            elif _tagTyp[j] == tyFloat8Array:
-                file.write(struct.pack("<q", _val[j]))
+                buffer += struct.pack("<d", _val[j])
             elif _tagTyp[j] == tyTDateTime:
-                if timestamp is None:
-                    cur_time = timestamp_to_unix(time.time())
-                else:
-                    cur_time = timestamp_to_unix(timestamp)
-                file.write(struct.pack("<d", cur_time))
-            elif _tagTyp[j] == tyAnsiString:
-                file.write(struct.pack("<q", _val[j][0]))
-                file.write(
-                    struct.pack(
-                        "<{0:.0f}s".format(
-                            _val[j][0]), _val[j][1].encode("ascii")
-                    )
+                offsets["TDateTime"].append(len(buffer))
+                buffer += struct.pack("<d", _val[j])
+            elif _tagTyp[j] in (tyAnsiString, tyWideString):
+                buffer += struct.pack("<q", _val[j][0])
+                buffer += struct.pack(
+                    "<{0:.0f}s".format(_val[j][0]), _val[j][1].encode("ascii")
                 )
-            elif _tagTyp[j] == tyWideString:
-                file.write(struct.pack("<q", _val[j][0]))
-                file.write(
-                    struct.pack(
-                        "<{0:.0f}s".format(
-                            _val[j][0]), _val[j][1].encode("ascii")
-                    )
-                )
-            elif _tagTyp[j] == tyBinaryBlob:
-                file.write(struct.pack("<q", _val[j]))
             else:
-                print("ERROR: Unknown tag type")
+                logger.error("Unknown tag type %#010x of %s in %s", int(_tagTyp[j]) & 0xFFFFFFFF,
+                             evalName, header)
+        self.header = header
+        self.buffer = bytes(buffer)
+        self.offsets = offsets
+        self.tags = tags
+
+    def with_record_type(self, rec_type):
+        """
+        Copy of the template for another record type of the same device,
+        e.g. a T3 header built from the T2 header of a PicoHarp 300.
+        TTResultFormat_TTTRRecType is set to rec_type and Measurement_Mode to its mode (2 for T2, 3 for T3).
+        The other tags, e.g. the resolutions, are kept and have to be patched (see render).
+        """
+        # the third byte of the record type is the measurement mode, e.g. 0x00010303 for PicoHarp T3
+        values = {"TTResultFormat_TTTRRecType": rec_type, "Measurement_Mode": (rec_type >> 8) & 0xFF}
+        buffer = bytearray(self.buffer)
+        template = copy.copy(self)
+        template.tags = dict(self.tags)
+        for ident, value in values.items():
+            for position in self.offsets[ident]:
+                struct.pack_into("<q", buffer, position, value)
+            if ident in template.tags:
+                template.tags[ident] = value
+        template.buffer = bytes(buffer)
+        return template
+
+    def render(self, acquisition_time_ms=None, total_records=None,
+               timestamp=None, counts0=None, counts1=None,
+               global_resolution=None, resolution=None):
+        """
+        Return the header as a bytearray, with the same modifications as write_ptuheader.
+        """
+        buffer = bytearray(len(self.buffer))
+        self.render_into(buffer, 0, acquisition_time_ms=acquisition_time_ms,
+                         total_records=total_records, timestamp=timestamp,
+                         counts0=counts0, counts1=counts1,
+                         global_resolution=global_resolution, resolution=resolution)
+        return buffer
+
+    def render_into(self, buffer, offset=0, acquisition_time_ms=None, total_records=None,
+                    timestamp=None, counts0=None, counts1=None,
+                    global_resolution=None, resolution=None):
+        """
+        Write the header, modified as by render, into the writable buffer (bytearray, memoryview,
+        mmap, np.ndarray, ...) at offset, without intermediate copies.
+        Output :
+        number of bytes written, i.e. len(self.buffer).
+        """
+        view = _byte_view(buffer)
+        end = offset + len(self.buffer)
+        if end > len(view):
+            raise ValueError("The buffer is too small for the header ({0} bytes needed at offset {1})".format(
+                len(self.buffer), offset))
+        view[offset:end] = self.buffer
+        for position, value in header_patches(self.offsets, acquisition_time_ms=acquisition_time_ms,
+                                              total_records=total_records, counts0=counts0,
+                                              counts1=counts1, global_resolution=global_resolution,
+                                              resolution=resolution):
+            view[offset + position:offset + position + len(value)] = value
+        if timestamp is None:
+            timestamp = time.time()
+        for position in self.offsets["TDateTime"]:
+            struct.pack_into("<d", view, offset + position,
+                             timestamp_to_tdatetime(timestamp))
+        return len(self.buffer)
+
+
+@functools.lru_cache(maxsize=HEADER_TEMPLATE_CACHE_SIZE)
+def _load_header_template(path, mtime_ns):
+    return PTUHeaderTemplate(path)
+
+
+def load_header_template(header='picoharp_ptu_header_parameter.npz'):
+    """
+    Return the compiled PTUHeaderTemplate of the .npz file header.
+    Templates are cached by path and modification time, so the .npz file
+    is only loaded again when it changes.
+    header can also be a PTUHeaderTemplate (e.g. from PTUHeaderTemplate.with_record_type), returned as is.
+    """
+    if isinstance(header, PTUHeaderTemplate):
+        return header
+    path = os.path.abspath(header)
+    return _load_header_template(path, os.stat(path).st_mtime_ns)
+
+
+def write_ptuheader(inputfile, acquisition_time_ms=None, total_records=None,
+                    timestamp=None, counts0=None, counts1=None,
+                    header='picoharp_ptu_header_parameter.npz', compression='auto',
+                    global_resolution=None, resolution=None):
+    """
+    Create a blank file : inputfile
+    Write the ptuheader from the npz file, with the only major changes being 
+    the acquisition time in ms and the total records.
+    The npz file is compiled once into a PTUHeaderTemplate (see load_header_template),
+    so writing a header is a few in-buffer patches and a single write.
+    inputfile can also be an open binary file, the header is then written at its current position
+    (e.g. at the start of a compressed file, before the time tags).
+    compression : 'auto' (from the extension of inputfile), 'gzip', 'zstd' or None, see compressed_io.open_file.
+    counts1 : a single input rate, or a list with the rate of each input channel, see header_patches.
+    global_resolution, resolution : default None, i.e. as in the npz file. MeasDesc_GlobalResolution and
+    MeasDesc_Resolution (s), to be given when the time tags were not recorded with the settings of the npz file.
+    Output :
+    inputfile containing the header.
+    """
+    with stage("header_write", file=getattr(inputfile, "name", inputfile)) as event:
+        template = load_header_template(header)
+        buffer = template.render(acquisition_time_ms=acquisition_time_ms,
+                                 total_records=total_records,
+                                 timestamp=timestamp, counts0=counts0,
+                                 counts1=counts1, global_resolution=global_resolution,
+                                 resolution=resolution)
+        if hasattr(inputfile, "write"):
+            event["bytes"] = inputfile.write(buffer)
+        else:
+            with open_file(inputfile, "wb", compression=compression) as file:
+                event["bytes"] = file.write(buffer)
+
+
+def _byte_view(buffer):
+    # flat unsigned byte view of any C-contiguous buffer, without copy
+    return memoryview(buffer).cast("B")
+
+
+def encode_ptuheader(acquisition_time_ms=None, total_records=None, timestamp=None,
+                     counts0=None, counts1=None, header='picoharp_ptu_header_parameter.npz',
+                     out=None, offset=0, global_resolution=None, resolution=None):
+    """
+    In-memory write_ptuheader: the header with the same modifications, as a buffer.
+    out : default None. Writable buffer (bytearray, memoryview, mmap, np.ndarray, shared memory, ...)
+    receiving the header at offset.
+    Output :
+    the header as a bytearray if out is None, else the number of bytes written to out.
+    """
+    template = load_header_template(header)
+    patches = dict(acquisition_time_ms=acquisition_time_ms, total_records=total_records,
+                   timestamp=timestamp, counts0=counts0, counts1=counts1,
+                   global_resolution=global_resolution, resolution=resolution)
+    if out is None:
+        return template.render(**patches)
+    return template.render_into(out, offset, **patches)
+
+
+def decode_ptuheader(buffer, names=None):
+    """
+    In-memory read_ptuheader: parse the header at the start of buffer (bytes, bytearray, memoryview,
+    mmap, np.ndarray, ...), without copying it.
+    names : default None, i.e. all the tags. Tag names (without index) to decode, see scan_ptuheader.
+    Output :
+    tags, header_end : see read_ptuheader.
+    """
+    view = _byte_view(buffer)
+    tags, header_end = _parse_header(view, names)
+    if header_end is None:
+        raise ValueError("The buffer ends before the Header_End tag")
+    return tags, header_end
+
+
+def ptu_size(records, header='picoharp_ptu_header_parameter.npz'):
+    """
+    Size in bytes of the ptu content made of header and records (see assemble_ptu),
+    to preallocate its buffer.
+    """
+    return len(load_header_template(header).buffer) + _byte_view(records).nbytes
+
+
+def assemble_ptu(records, acquisition_time_ms=None, total_records=None, timestamp=None,
+                 counts0=None, counts1=None, header='picoharp_ptu_header_parameter.npz', out=None,
+                 global_resolution=None, resolution=None):
+    """
+    In-memory combine_time_tags_header: build the ptu content from the header template and the time tags.
+    records : time tags, any C-contiguous buffer (bytes, memoryview, np.ndarray of uint32, ...).
+    total_records : default None, i.e. the number of records in records. See write_ptuheader for the other values.
+    out : default None. Writable buffer of at least ptu_size(records, header) bytes
+    (e.g. the buf of a multiprocessing.shared_memory.SharedMemory) receiving the ptu content.
+    The records are copied once, straight into their place in the output.
+    Output :
+    the ptu content as a bytearray if out is None, else the number of bytes written to out.
+    """
+    payload = _byte_view(records)
+    if total_records is None:
+        total_records = payload.nbytes // 4
+    template = load_header_template(header)
+    size = len(template.buffer) + payload.nbytes
+    if out is not None and _byte_view(out).nbytes < size:
+        raise ValueError("The buffer is too small for the ptu content ({0} bytes needed)".format(size))
+    buffer = bytearray(size) if out is None else out
+    template.render_into(buffer, 0, acquisition_time_ms=acquisition_time_ms,
+                         total_records=total_records, timestamp=timestamp,
+                         counts0=counts0, counts1=counts1,
+                         global_resolution=global_resolution, resolution=resolution)
+    _byte_view(buffer)[len(template.buffer):size] = payload
+    return buffer if out is None else size
+
+
+def decode_ptu(buffer):
+    """
+    Parse ptu content held in memory (bytes, bytearray, memoryview, mmap, np.ndarray, ...).
+    Output :
+    tags : see read_ptuheader.
+    records : np.ndarray of the records (uint32), a view into buffer (no copy).
+    A partial record at the end of buffer is left out.
+    """
+    view = _byte_view(buffer)
+    tags, header_end = decode_ptuheader(view)
+    return tags, np.frombuffer(view, dtype="<u4", count=(view.nbytes - header_end) // 4,
+                               offset=header_end)
+
+
+def patch_ptuheader(inputfile, acquisition_time_ms=None, total_records=None,
+                    counts0=None, counts1=None, global_resolution=None, resolution=None):
+    """
+    Modify in place the header of an existing ptu file : inputfile.
+    The same tags as in write_ptuheader are modified, the time tags are left untouched.
+    Compressed files cannot be modified in place.
+    """
+    if detect_compression(inputfile) is not None:
+        raise ValueError("{0} is compressed, its header cannot be modified in place".format(inputfile))
+    with stage("header_patch", file=inputfile) as event:
+        offsets, header_end = read_ptuheader_offsets(inputfile)
+        # only the values with the expected tag type are modified
+        offsets = {ident: [offset for offset, tagTyp in offsets.get(ident, [])
+                           if tagTyp == PATCHABLE_TAGS[ident]]
+                   for ident in PATCHABLE_TAGS}
+        event["bytes"] = 0
+        with open(inputfile, "r+b") as file:
+            for offset, value in header_patches(offsets, acquisition_time_ms=acquisition_time_ms,
+                                                total_records=total_records, counts0=counts0,
+                                                counts1=counts1, global_resolution=global_resolution,
+                                                resolution=resolution):
+                file.seek(offset)
+                event["bytes"] += file.write(value)
+
+
+def copy_records(source, destination, offset=0, length=None,
+                 chunk_size=COPY_CHUNK_SIZE, observer=None):
+    """
+    Append length bytes of the open binary file source, starting at offset,
+    to the end of the open binary file destination.
+    The copy is done in chunks of at most chunk_size bytes, so the memory used
+    does not depend on the file size. The kernel copy (copy_file_range, then
+    sendfile) is used where the platform supports it, otherwise a single
+    reusable buffer of chunk_size bytes.
+    If length is None, copy up to the end of source.
+    Compressed files (see compressed_io.open_file) are streamed through the buffer.
+    observer : default None. Called with each chunk copied (a memoryview only valid during the call),
+    e.g. to check the records in the same pass. The copy then goes through the buffer.
+    Output :
+    number of bytes copied.
+    """
+    with stage("payload_copy", file=getattr(destination, "name", None)) as event:
+        event["bytes"] = _copy_records(source, destination, offset, length, chunk_size, observer)
+    return event["bytes"]
+
+
+def _copy_records(source, destination, offset, length, chunk_size, observer=None):
+    if observer is not None or not (is_plain_file(source) and is_plain_file(destination)):
+        return _copy_stream(source, destination, offset, length, chunk_size, observer)
+    destination.flush()
+    src_fd = source.fileno()
+    dst_fd = destination.fileno()
+    if length is None:
+        length = max(os.fstat(src_fd).st_size - offset, 0)
+    dst_offset = destination.seek(0, os.SEEK_END)
+    use_copy_file_range = hasattr(os, "copy_file_range")
+    use_sendfile = hasattr(os, "sendfile")
+    buffer = None
+    copied = 0
+    while copied < length:
+        count = min(chunk_size, length - copied)
+        n = None
+        if use_copy_file_range:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, count,
+                                       offset + copied, dst_offset + copied)
+            except OSError:
+                use_copy_file_range = False
+        if n is None and use_sendfile:
+            try:
+                os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+                n = os.sendfile(dst_fd, src_fd, offset + copied, count)
+            except OSError:
+                use_sendfile = False
+        if n is None:
+            if buffer is None:
+                buffer = memoryview(bytearray(chunk_size))
+            source.seek(offset + copied)
+            n = source.readinto(buffer[:count])
+            destination.seek(dst_offset + copied)
+            destination.write(buffer[:n])
+            destination.flush()
+        if n == 0:
+            break
+        copied += n
+    destination.seek(0, os.SEEK_END)
+    return copied
+
+
+def _copy_stream(source, destination, offset, length, chunk_size, observer=None):
+    source.seek(offset)
+    buffer = memoryview(bytearray(chunk_size))
+    copied = 0
+    while length is None or copied < length:
+        count = chunk_size if length is None else min(chunk_size, length - copied)
+        n = source.readinto(buffer[:count])
+        if not n:
+            break
+        destination.write(buffer[:n])
+        if observer is not None:
+            observer(buffer[:n])
+        copied += n
+    return copied
 
 
 def combine_time_tags_header(headerfile, timetags, outputfile):
@@ -249,18 +698,22 @@ def combine_time_tags_header(headerfile, timetags, outputfile):
     Tested on 
     device :PicoHarp 300  : 2 channels.
     timetag analysis software : readPTU library : https://github.com/QuantumPhotonicsLab/readPTU
+    The inputs can be compressed, the output is compressed according to its extension (see compressed_io.py).
     """
 
-    with open(headerfile, "rb") as original, open(timetags, "rb") as _timetags, open(
-        outputfile, "wb+"
-    ) as _output:
-        header = original.read()
-        _output.write(header)
-        tags = _timetags.read()
-        _output.write(tags)
+    with stage("combine", file=outputfile) as event, open_file(headerfile) as original, open_file(
+        timetags
+    ) as _timetags, open_file(outputfile, "wb") as _output:
+        event["bytes"] = copy_records(original, _output)
+        payload = copy_records(_timetags, _output)
+        event["bytes"] += payload
+        event["records"] = payload // 4
+        with stage("cleanup", file=outputfile):
+            _output.close()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     filename1 = r'hydraharp_ptu_header_parameter.npz'
     filename2 = r'picoharp_ptu_header_parameter.npz'
     write_ptuheader("test.bin", acquisition_time_ms=600000,